@@ -3,12 +3,17 @@ from flask_cors import CORS
 from flask_bcrypt import Bcrypt
 from flask_jwt_extended import JWTManager
 from .extensions import db
+from .logs import configure_logging
+from .metrics import init_metrics
+from .models import upgrade_schema
+from .persistence import configure_sqlite
 from config import Config
 import os
 
 def create_app(config_class=Config):
     app = Flask(__name__)
-    app.config.from_object(Config)
+    app.config.from_object(config_class)
+    configure_logging(app.config['LOG_LEVEL'], app.config['LOG_FORMAT'])
 
     # Initialize extensions
     CORS(app)
@@ -20,8 +25,15 @@ def create_app(config_class=Config):
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
     os.makedirs(app.config['GRADCAM_FOLDER'], exist_ok=True)
 
+    # Create Database Tables (before init_model replays the write-behind spool)
+    with app.app_context():
+        configure_sqlite(db.engine)
+        db.create_all()
+        upgrade_schema()
+
     # Register blueprints
-    from .auth import auth as auth_blueprint
+    from .auth import auth as auth_blueprint, init_auth
+    init_auth(app)
     app.register_blueprint(auth_blueprint, url_prefix='/api/auth')
 
     from .main import main as main_blueprint
@@ -31,9 +43,6 @@ def create_app(config_class=Config):
     init_model(app)
     
     app.register_blueprint(main_blueprint)
-
-    # Create Database Tables
-    with app.app_context():
-        db.create_all()
+    init_metrics(app)
 
     return app
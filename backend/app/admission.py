@@ -0,0 +1,196 @@
+"""
+Admission control and deadlines for prediction requests.
+
+At most ADMISSION_MAX_CONCURRENT requests are in the pipeline (decode and
+inference) at once, and at most ADMISSION_MAX_QUEUE more wait for a slot.
+A request beyond that is shed straight away, before its upload is read,
+rather than slowing every other request down. Every request carries a
+deadline; one still waiting or still queued for the model when its
+deadline passes is dropped before inference starts.
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Overloaded(Exception):
+    """
+    Raised when a request is shed; `retry_after` is a hint in seconds.
+    """
+
+    def __init__(self, message="Server busy, retry shortly", retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Overloaded):
+    """
+    Raised for work whose deadline passed before inference started.
+    """
+
+    def __init__(self, message="Deadline passed before inference started", retry_after=1):
+        super().__init__(message, retry_after)
+
+
+class Deadline:
+    """
+    Absolute point on the monotonic clock (shared by every process on the
+    host, so it can be handed to the inference process as-is).
+    """
+
+    def __init__(self, expires_at):
+        self.expires_at = expires_at
+
+    @classmethod
+    def after(cls, seconds):
+        return cls(time.monotonic() + seconds)
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+    def check(self):
+        if self.expired():
+            raise DeadlineExceeded()
+
+
+def request_deadline(headers, default_ms, max_ms):
+    """
+    Deadline for a request: `X-Deadline-Ms` from the client if it sent a
+    valid one, capped at `max_ms`, else `default_ms`.
+    """
+    try:
+        ms = float(headers.get('X-Deadline-Ms', default_ms))
+    except ValueError:
+        ms = default_ms
+    if not ms > 0:
+        ms = default_ms
+    return Deadline.after(min(ms, max_ms) / 1000.0)
+
+
+class Ticket:
+    """
+    A held admission slot; releasing it twice is harmless, so a streamed
+    response can release it when it closes.
+    """
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.started = time.monotonic()
+        self._released = False
+        self._lock = threading.Lock()
+
+    def release(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self.controller._release(time.monotonic() - self.started)
+
+
+class AdmissionController:
+    """
+    Bounded concurrency with a bounded wait queue.
+
+    `acquire(deadline)` takes one slot (`admit` is the context-manager
+    form). It raises Overloaded at once when `max_queue` requests are
+    already waiting, and DeadlineExceeded when no slot frees up before the
+    deadline. Retry-After hints are estimated from recent time in the
+    pipeline.
+    """
+
+    def __init__(self, max_concurrent, max_queue, degrade_depth=0):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.degrade_depth = degrade_depth
+        self._slots = threading.Semaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._active = 0
+        # Exponentially weighted mean seconds a request holds a slot
+        self._service_time = 0.1
+        self._stats = {"admitted": 0, "rejected": 0, "expired": 0, "degraded": 0}
+
+    def retry_after(self):
+        """
+        Seconds until the current backlog should have drained.
+        """
+        with self._lock:
+            backlog = self._waiting + self._active
+            service_time = self._service_time
+        return max(1, math.ceil(backlog * service_time / self.max_concurrent))
+
+    def depth(self):
+        """
+        Requests waiting for a slot.
+        """
+        with self._lock:
+            return self._waiting
+
+    def should_degrade(self, extra_depth=0):
+        """
+        True when degraded mode is on and the backlog (waiting requests plus
+        `extra_depth`, e.g. the inference queue) has reached its threshold.
+        """
+        if not self.degrade_depth or self.depth() + extra_depth < self.degrade_depth:
+            return False
+        with self._lock:
+            self._stats["degraded"] += 1
+        return True
+
+    def acquire(self, deadline):
+        """
+        Take a slot, waiting at most until `deadline`. Returns a Ticket whose
+        `release()` gives the slot back.
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                full = self._waiting >= self.max_queue
+                if full:
+                    self._stats["rejected"] += 1
+                else:
+                    self._waiting += 1
+            if full:
+                raise Overloaded("Too many prediction requests queued", self.retry_after())
+            try:
+                acquired = self._slots.acquire(timeout=deadline.remaining())
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+            if not acquired:
+                with self._lock:
+                    self._stats["expired"] += 1
+                raise DeadlineExceeded("Deadline passed while queued", self.retry_after())
+
+        with self._lock:
+            self._active += 1
+            self._stats["admitted"] += 1
+        return Ticket(self)
+
+    def _release(self, elapsed):
+        with self._lock:
+            self._active -= 1
+            self._service_time = 0.9 * self._service_time + 0.1 * elapsed
+        self._slots.release()
+
+    @contextmanager
+    def admit(self, deadline):
+        ticket = self.acquire(deadline)
+        try:
+            yield ticket
+        finally:
+            ticket.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._stats,
+                "max_concurrent": self.max_concurrent,
+                "max_queue": self.max_queue,
+                "active": self._active,
+                "waiting": self._waiting,
+                "mean_service_ms": round(self._service_time * 1000, 3),
+            }
@@ -0,0 +1,377 @@
+"""
+ASGI serving for the Flask app.
+
+Request bodies are received on the event loop, so a slow client uploading
+a large scan costs a socket and a spooled buffer rather than a thread.
+Auth and history requests are handled natively: their database work runs
+on a small DB executor and bcrypt on the password pool, and both are
+awaited without holding a thread. Every other route runs the Flask app on
+a request executor once its body has fully arrived, so decode, inference
+and persistence stay off the event loop and a thread is only held while
+there is work to do.
+
+Runs under any ASGI server, e.g. `uvicorn asgi:app`, or `python serve.py
+--asgi` to share one inference process between workers.
+"""
+import asyncio
+import json
+import logging
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+from flask_jwt_extended import decode_token
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt import ExpiredSignatureError, PyJWTError
+from werkzeug.datastructures import MultiDict
+
+from . import auth, main, metrics
+from .passwords import HasherBusy
+
+logger = logging.getLogger(__name__)
+
+# Responses up to this size are read in one executor hop; larger or
+# streamed ones are sent chunk by chunk as the app produces them
+EAGER_RESPONSE_BYTES = 1024 * 1024
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class AsgiRequest:
+    """
+    What a native handler sees of a request: `method`, `path`, query
+    `args`, lower-cased `headers` and the `body` bytes.
+    """
+
+    def __init__(self, scope, body):
+        self.scope = scope
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = MultiDict(parse_qsl(scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True))
+        self.headers = {}
+        for name, value in scope.get('headers', ()):
+            name, value = name.decode('latin-1').lower(), value.decode('latin-1')
+            self.headers[name] = f"{self.headers[name]},{value}" if name in self.headers else value
+        self.body = body
+
+    def json(self):
+        try:
+            return json.loads(self.body) if self.body else None
+        except ValueError:
+            return None
+
+    @property
+    def host_url(self):
+        host = self.headers.get('host')
+        if host is None:
+            server = self.scope.get('server') or ('localhost', None)
+            host = server[0] if server[1] is None else f"{server[0]}:{server[1]}"
+        return f"{self.scope.get('scheme', 'http')}://{host}{self.scope.get('root_path', '')}/"
+
+    @property
+    def base_url(self):
+        return self.host_url.rstrip('/') + self.path
+
+
+class AsgiApp:
+    """
+    ASGI application serving a Flask app built by create_app().
+
+    `request_threads` run Flask for routes without a native handler and
+    `db_threads` run the native handlers' database work (ASGI_REQUEST_THREADS
+    and ASGI_DB_THREADS by default).
+    """
+
+    def __init__(self, flask_app, request_threads=None, db_threads=None):
+        config = flask_app.config
+        self.flask_app = flask_app
+        self.max_body = config['ASGI_MAX_BODY_BYTES']
+        self.spool_bytes = config['ASGI_SPOOL_BYTES']
+        self.request_executor = ThreadPoolExecutor(request_threads or config['ASGI_REQUEST_THREADS'],
+                                                   thread_name_prefix='asgi-request')
+        self.db_executor = ThreadPoolExecutor(db_threads or config['ASGI_DB_THREADS'], thread_name_prefix='asgi-db')
+        self.native = {
+            ('POST', '/api/auth/register'): ('auth.register', self.register),
+            ('POST', '/api/auth/login'): ('auth.login', self.login),
+            ('GET', '/api/auth/profile'): ('auth.profile', self.profile),
+            ('GET', '/api/history'): ('main.history', self.history),
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError(f"Unsupported ASGI scope type {scope['type']!r}")
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await asyncio.get_running_loop().run_in_executor(None, self.close)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def close(self):
+        """
+        Finish in-flight work and flush queued prediction writes.
+        """
+        self.request_executor.shutdown(wait=True)
+        self.db_executor.shutdown(wait=True)
+        if main.persister is not None:
+            main.persister.close()
+
+    async def _http(self, scope, receive, send):
+        declared = _content_length(scope)
+        if declared is not None and declared > self.max_body:
+            await _send_json(send, 413, {"error": "Request body too large"})
+            return
+        # Held in memory up to ASGI_SPOOL_BYTES, then in a temporary file
+        body = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes)
+        try:
+            try:
+                length = await self._receive_body(receive, body)
+            except ClientDisconnected:
+                return
+            if length is None:
+                await _send_json(send, 413, {"error": "Request body too large"})
+                return
+            body.seek(0)
+            native = self.native.get((scope['method'], scope['path']))
+            if native is not None:
+                await self._call_native(*native, scope, body.read(), send)
+            else:
+                await self._call_flask(scope, body, length, send)
+        finally:
+            body.close()
+
+    async def _receive_body(self, receive, body):
+        """
+        Read the request body into `body` as it arrives. Returns its length,
+        or None once it exceeds ASGI_MAX_BODY_BYTES.
+        """
+        length = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                raise ClientDisconnected()
+            chunk = message.get('body', b'')
+            length += len(chunk)
+            if length > self.max_body:
+                return None
+            body.write(chunk)
+            if not message.get('more_body'):
+                return length
+
+    async def run_db(self, fn, *args):
+        """
+        Run `fn(*args)` in an app context on the DB executor.
+        """
+        def call():
+            with self.flask_app.app_context():
+                return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.db_executor, call)
+
+    async def _call_native(self, endpoint, handler, scope, body, send):
+        request = AsgiRequest(scope, body)
+        started = time.perf_counter()
+        measure = self.flask_app.config['METRICS_ENABLED']
+        if measure:
+            metrics.IN_FLIGHT.inc(endpoint)
+        try:
+            try:
+                result = await handler(request)
+            except HasherBusy:
+                result = {"msg": "Too many concurrent sign-ins, retry shortly"}, 503, {"Retry-After": "1"}
+            except Exception:
+                logger.exception("Request failed", extra={"endpoint": endpoint})
+                result = {"error": "Internal server error"}, 500
+            payload, status, headers = (*result, {})[:3]
+            elapsed = time.perf_counter() - started
+            headers = dict(headers)
+            if measure:
+                metrics.REQUEST_SECONDS.observe(elapsed, endpoint, request.method, str(status))
+                headers['Server-Timing'] = metrics.server_timing_header({}, elapsed)
+            await _send_json(send, status, payload, headers, self.flask_app.json.dumps)
+        finally:
+            if measure:
+                metrics.IN_FLIGHT.dec(endpoint)
+
+    async def _call_flask(self, scope, body, length, send):
+        loop = asyncio.get_running_loop()
+        environ = _environ(scope, body, length)
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = headers
+            return _no_write
+
+        def run():
+            iterable = self.flask_app(environ, start_response)
+            chunks = iter(iterable)
+            size = next((int(value) for name, value in response['headers'] if name.lower() == 'content-length'), None)
+            if size is not None and size <= EAGER_RESPONSE_BYTES:
+                return iterable, None, b''.join(chunks)
+            return iterable, chunks, b''
+
+        iterable, chunks, eager = await loop.run_in_executor(self.request_executor, run)
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': response['status'],
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                            for name, value in response['headers']],
+            })
+            if chunks is not None:
+                # Streamed: each chunk is produced on the request executor
+                while True:
+                    chunk = await loop.run_in_executor(self.request_executor, next, chunks, None)
+                    if chunk is None:
+                        break
+                    if chunk:
+                        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': eager, 'more_body': False})
+        finally:
+            if hasattr(iterable, 'close'):
+                # Releases what the response held (e.g. its admission slot)
+                await loop.run_in_executor(self.request_executor, iterable.close)
+
+    def _identity(self, request):
+        """
+        JWT identity of a request, as (identity, None) or (None, error).
+        """
+        header = request.headers.get('authorization')
+        if not header:
+            return None, ({"msg": "Missing Authorization Header"}, 401)
+        scheme, _, token = header.partition(' ')
+        if scheme != 'Bearer' or not token:
+            return None, ({"msg": "Bad Authorization header. Expected 'Authorization: Bearer <JWT>'"}, 422)
+        try:
+            with self.flask_app.app_context():
+                claims = decode_token(token)
+        except ExpiredSignatureError:
+            return None, ({"msg": "Token has expired"}, 401)
+        except (PyJWTError, JWTExtendedException) as e:
+            return None, ({"msg": str(e)}, 422)
+        if claims.get('type') != 'access':
+            return None, ({"msg": "Only non-refresh tokens are allowed"}, 422)
+        return claims[self.flask_app.config['JWT_IDENTITY_CLAIM']], None
+
+    async def register(self, request):
+        data = request.json()
+        error = await self.run_db(auth._registration_error, data)
+        if error is not None:
+            return error
+        hashed_password = await auth.password_hasher.hash_async(data['password'])
+        return await self.run_db(auth._create_user, data, hashed_password)
+
+    async def login(self, request):
+        data = request.json() or {}
+        user = await self.run_db(auth._find_login, data.get('username'))
+        hasher = auth.password_hasher
+        if user is None or not await hasher.check_async(user.password_hash, data.get('password')):
+            return {"msg": "Bad username or password"}, 401
+        if hasher.needs_rehash(user.password_hash):
+            # Move the stored hash to the configured cost
+            await self.run_db(auth._store_password_hash, user.id, await hasher.hash_async(data.get('password')))
+        with self.flask_app.app_context():
+            return auth._login_payload(user), 200
+
+    async def profile(self, request):
+        identity, error = self._identity(request)
+        if error is not None:
+            return error
+        user = auth.identity_cache.peek(identity)
+        if user is None:
+            user = await self.run_db(auth.identity_cache.get, identity, auth._load_profile)
+        if not user:
+            return {"msg": "User not found"}, 404
+        return user, 200
+
+    async def history(self, request):
+        identity, error = self._identity(request)
+        if error is not None:
+            return error
+        try:
+            rows, next_cursor = await self.run_db(main._history_page, identity, request.args, self.flask_app.config)
+        except ValueError as e:
+            return {"error": str(e)}, 400
+        headers = main._history_headers(next_cursor, request.args.to_dict(), request.base_url)
+        host_url = request.host_url
+        return [main._history_item(row, host_url) for row in rows], 200, headers
+
+
+def _no_write(data):
+    raise NotImplementedError("The WSGI write() callable is not supported")
+
+
+def _content_length(scope):
+    for name, value in scope.get('headers', ()):
+        if name.lower() == b'content-length':
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
+
+
+def _environ(scope, body, length):
+    """
+    WSGI environ for an ASGI HTTP scope whose body has been received.
+    """
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'CONTENT_LENGTH': str(length),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', ()):
+        name, value = name.decode('latin-1').upper().replace('-', '_'), value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = name if name == 'CONTENT_TYPE' else f'HTTP_{name}'
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def _send_json(send, status, payload, headers=None, dumps=json.dumps):
+    body = (dumps(payload) + "\n").encode('utf-8')
+    raw_headers = [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode('latin-1')),
+                   # Same policy as Flask-CORS's default on the Flask routes
+                   (b'access-control-allow-origin', b'*')]
+    raw_headers += [(name.lower().encode('latin-1'), str(value).encode('latin-1'))
+                    for name, value in (headers or {}).items()]
+    await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def create_asgi_app(config_class=None, **options):
+    """
+    Build the Flask app with create_app() and serve it over ASGI.
+    """
+    from . import create_app
+    flask_app = create_app(config_class) if config_class is not None else create_app()
+    return AsgiApp(flask_app, **options)
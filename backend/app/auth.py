@@ -1,49 +1,119 @@
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity
-from flask_bcrypt import Bcrypt
+from sqlalchemy import event, or_
+from sqlalchemy.exc import IntegrityError
 from .models import User
 from .extensions import db
+from .identity import IdentityCache
+from .passwords import HasherBusy, PasswordHasher
 
 auth = Blueprint('auth', __name__)
-bcrypt = Bcrypt()
 
-@auth.route('/register', methods=['POST'])
-def register():
-    data = request.get_json()
+# Set up by init_auth()
+password_hasher = None
+identity_cache = None
+
+def init_auth(app):
+    """
+    Create the bcrypt pool and profile cache from the app config.
+    """
+    global password_hasher, identity_cache
+    if password_hasher is not None:
+        password_hasher.close()
+    password_hasher = PasswordHasher(
+        rounds=app.config['BCRYPT_LOG_ROUNDS'],
+        max_workers=app.config['PASSWORD_HASH_WORKERS'],
+        max_queue=app.config['PASSWORD_HASH_QUEUE']
+    )
+    identity_cache = IdentityCache(ttl=app.config['PROFILE_CACHE_TTL'])
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _invalidate_profile(mapper, connection, user):
+    if identity_cache is not None:
+        identity_cache.invalidate(user.id)
+
+@auth.errorhandler(HasherBusy)
+def hasher_busy(e):
+    return jsonify({"msg": "Too many concurrent sign-ins, retry shortly"}), 503, {"Retry-After": "1"}
+
+def _registration_error(data):
+    """
+    Why a registration can't go ahead, as (payload, status), or None.
+    """
     if not data or not data.get('username') or not data.get('password') or not data.get('email'):
-        return jsonify({"msg": "Missing requirements"}), 400
+        return {"msg": "Missing requirements"}, 400
 
-    if User.query.filter_by(username=data['username']).first():
-        return jsonify({"msg": "Username already exists"}), 409
-    
-    if User.query.filter_by(email=data['email']).first():
-        return jsonify({"msg": "Email already exists"}), 409
+    # One round trip for both uniqueness checks
+    taken = db.session.query(User.username, User.email).filter(
+        or_(User.username == data['username'], User.email == data['email'])
+    ).all()
+    if any(username == data['username'] for username, _ in taken):
+        return {"msg": "Username already exists"}, 409
+    if taken:
+        return {"msg": "Email already exists"}, 409
+    return None
 
-    hashed_password = bcrypt.generate_password_hash(data['password']).decode('utf-8')
+def _create_user(data, hashed_password):
     new_user = User(username=data['username'], email=data['email'], password_hash=hashed_password)
-    
     db.session.add(new_user)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Lost a race with a concurrent registration
+        db.session.rollback()
+        return {"msg": "Username or email already exists"}, 409
+    return {"msg": "User created successfully"}, 201
+
+def _find_login(username):
+    return db.session.query(User.id, User.username, User.email, User.password_hash).filter(
+        User.username == username
+    ).first()
+
+def _store_password_hash(user_id, password_hash):
+    db.session.query(User).filter(User.id == user_id).update({User.password_hash: password_hash})
     db.session.commit()
 
-    return jsonify({"msg": "User created successfully"}), 201
+def _login_payload(user):
+    access_token = create_access_token(identity=user.id)
+    return {"access_token": access_token, "user": {"id": user.id, "username": user.username, "email": user.email}}
+
+@auth.route('/register', methods=['POST'])
+def register():
+    data = request.get_json()
+    error = _registration_error(data)
+    if error is not None:
+        payload, status = error
+        return jsonify(payload), status
+
+    payload, status = _create_user(data, password_hasher.hash(data['password']))
+    return jsonify(payload), status
 
 @auth.route('/login', methods=['POST'])
 def login():
     data = request.get_json()
-    user = User.query.filter_by(username=data.get('username')).first()
+    user = _find_login(data.get('username'))
 
-    if user and bcrypt.check_password_hash(user.password_hash, data.get('password')):
-        access_token = create_access_token(identity=user.id)
-        return jsonify(access_token=access_token, user={"id": user.id, "username": user.username, "email": user.email}), 200
+    if user and password_hasher.check(user.password_hash, data.get('password')):
+        if password_hasher.needs_rehash(user.password_hash):
+            # Move the stored hash to the configured cost
+            _store_password_hash(user.id, password_hasher.hash(data.get('password')))
+        return jsonify(_login_payload(user)), 200
     
     return jsonify({"msg": "Bad username or password"}), 401
 
+def _load_profile(identity):
+    row = db.session.query(User.id, User.username, User.email).filter(User.id == identity).first()
+    if row is None:
+        return None
+    return {"id": row.id, "username": row.username, "email": row.email}
+
 @auth.route('/profile', methods=['GET'])
 @jwt_required()
 def profile():
     current_user_id = get_jwt_identity()
-    user = User.query.get(current_user_id)
+    user = identity_cache.get(current_user_id, _load_profile)
     if not user:
         return jsonify({"msg": "User not found"}), 404
         
-    return jsonify({"id": user.id, "username": user.username, "email": user.email}), 200
+    return jsonify(user), 200
@@ -0,0 +1,368 @@
+"""
+Inference backends.
+
+A backend scores preprocessed batches behind the same interface as
+InferenceEngine (`predict`, `explain`, `predict_and_explain`, `warmup`),
+so the batchers and the inference server don't care which runtime is
+underneath. `keras` runs the model as loaded; `tflite` runs a float16 or
+int8 post-training-quantized artifact made offline by
+`python -m scripts.convert_tflite`. TFLite graphs can't be differentiated,
+so Grad-CAM always runs on the Keras graph.
+
+Every backend records per-op latency and reports how far its scores are
+from the Keras model's. Image embeddings (for similar-case search) come
+from the Keras graph too, so a TFLite backend only has them for images it
+explains.
+"""
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import warnings
+
+import numpy as np
+
+from .utils import load_model_safe, model_identity
+
+BACKENDS = ('keras', 'tflite')
+QUANTIZATIONS = ('float16', 'int8')
+
+logger = logging.getLogger(__name__)
+
+
+def tflite_path(model_path, quantization):
+    """
+    Default artifact for a model: `models/model.h5` -> `models/model.float16.tflite`.
+    """
+    return f"{os.path.splitext(model_path)[0]}.{quantization}.tflite"
+
+
+def report_path(artifact_path):
+    """
+    Conversion report written next to a `.tflite` artifact.
+    """
+    return artifact_path + '.json'
+
+
+def resolve_artifact(config, model_path=None):
+    """
+    The `.tflite` file the config asks for, or None when the Keras backend
+    is selected or the artifact hasn't been converted yet. TFLITE_MODEL_PATH
+    only applies to MODEL_PATH; a registry model (`model_path`) uses the
+    artifact next to it.
+    """
+    if config['INFERENCE_BACKEND'] != 'tflite':
+        return None
+    if model_path is None or model_path == config['MODEL_PATH']:
+        path = config['TFLITE_MODEL_PATH'] or tflite_path(config['MODEL_PATH'], config['TFLITE_QUANTIZATION'])
+    else:
+        path = tflite_path(model_path, config['TFLITE_QUANTIZATION'])
+    return path if os.path.exists(path) else None
+
+
+def backend_identity(config, model_path=None):
+    """
+    Identify the scores a config produces, for caches keyed on the model.
+    """
+    model_path = model_path or config['MODEL_PATH']
+    artifact = resolve_artifact(config, model_path)
+    if artifact is None:
+        return model_identity(model_path)
+    stat = os.stat(artifact)
+    return f"{model_identity(model_path)}|tflite:{os.path.abspath(artifact)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def convert(model, quantization, representative_images=None):
+    """
+    Post-training quantization of a Keras model to a TFLite flatbuffer.
+
+    `float16` halves the weights; `int8` also quantizes activations, using
+    `representative_images` (a float32 batch, preprocessed like requests)
+    to calibrate their ranges. Inputs and outputs stay float32 either way,
+    so preprocessing is unchanged.
+    """
+    import tensorflow as tf
+
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization {quantization!r}, expected one of {QUANTIZATIONS}")
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    else:
+        if representative_images is None or not len(representative_images):
+            raise ValueError("int8 quantization needs representative images")
+
+        def representative_dataset():
+            for image in representative_images:
+                yield [image[np.newaxis].astype(np.float32)]
+
+        converter.representative_dataset = representative_dataset
+    return converter.convert()
+
+
+def compare(reference, candidate):
+    """
+    Accuracy delta of `candidate` scores against `reference` scores for the
+    same images: top-1 agreement and absolute score differences.
+    """
+    reference, candidate = np.asarray(reference), np.asarray(candidate)
+    diff = np.abs(reference.astype(np.float64) - candidate)
+    return {
+        "images": int(len(reference)),
+        "top1_agreement": float(np.mean(reference.argmax(axis=1) == candidate.argmax(axis=1))),
+        "max_abs_diff": float(diff.max()) if diff.size else 0.0,
+        "mean_abs_diff": float(diff.mean()) if diff.size else 0.0,
+    }
+
+
+def _interpreter_class():
+    # LiteRT is the standalone TFLite runtime; TensorFlow still ships one
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+    return Interpreter
+
+
+class LatencyStats:
+    """
+    Per-op batch latency totals for a backend.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ops = {}
+
+    def record(self, op, images, seconds):
+        with self._lock:
+            entry = self._ops.setdefault(op, {"batches": 0, "images": 0, "total": 0.0, "max": 0.0})
+            entry["batches"] += 1
+            entry["images"] += images
+            entry["total"] += seconds
+            entry["max"] = max(entry["max"], seconds)
+
+    def stats(self):
+        with self._lock:
+            return {
+                op: {
+                    "batches": entry["batches"],
+                    "images": entry["images"],
+                    "mean_batch_ms": round(entry["total"] / entry["batches"] * 1000, 3),
+                    "mean_image_ms": round(entry["total"] / entry["images"] * 1000, 3),
+                    "max_batch_ms": round(entry["max"] * 1000, 3),
+                }
+                for op, entry in self._ops.items()
+            }
+
+
+class Backend:
+    """
+    Common timing and Grad-CAM plumbing around an InferenceEngine.
+
+    `explainer` is the Keras InferenceEngine; subclasses provide `_predict`
+    for classification-only batches.
+    """
+
+    name = None
+
+    def __init__(self, explainer):
+        self.explainer = explainer
+        self.model = explainer.model
+        self.last_conv_layer_name = explainer.last_conv_layer_name
+        self.input_shape = explainer.input_shape
+        self.latency = LatencyStats()
+        self.accuracy = None
+
+    def _predict(self, images):
+        raise NotImplementedError
+
+    def _predict_embed(self, images):
+        return self._predict(images), None
+
+    def _timed(self, op, fn, images):
+        started = time.perf_counter()
+        result = fn(images)
+        self.latency.record(op, len(images), time.perf_counter() - started)
+        return result
+
+    def warmup(self, default_size=224):
+        self.explainer.warmup(default_size)
+        shape = tuple(default_size if dim is None else dim for dim in self.input_shape)
+        self._predict(np.zeros((1,) + shape, dtype=np.float32))
+
+    def predict(self, images, embed=False):
+        """
+        Class scores for a preprocessed batch (shape: (N, H, W, 3)), plus
+        embeddings (or None) with `embed`.
+        """
+        return self._timed('predict', self._predict_embed if embed else self._predict, images)
+
+    def explain(self, images):
+        """
+        Top-class Grad-CAM heatmaps, always from the Keras graph.
+        """
+        return self._timed('explain', self.explainer.explain, images)
+
+    def predict_and_explain(self, images, embed=False):
+        """
+        Scores and heatmaps (and embeddings with `embed`) from one Keras
+        pass, so the heatmap explains exactly the scores returned; scores
+        only when there is nothing to explain.
+        """
+        if self.explainer.grad_model is None:
+            if embed:
+                predictions, embeddings = self.predict(images, embed=True)
+                return predictions, None, embeddings
+            return self.predict(images), None
+        return self._timed('predict_and_explain',
+                           functools.partial(self.explainer.predict_and_explain, embed=embed), images)
+
+    def stats(self):
+        return {"backend": self.name, "latency": self.latency.stats(), "accuracy": self.accuracy}
+
+
+class KerasBackend(Backend):
+    """
+    The Keras model as loaded; the reference other backends are measured against.
+    """
+
+    name = 'keras'
+
+    def __init__(self, explainer):
+        super().__init__(explainer)
+        self.accuracy = {"reference": True}
+
+    def _predict(self, images):
+        return self.explainer.predict(images)
+
+    def _predict_embed(self, images):
+        return self.explainer.predict(images, embed=True)
+
+
+class TFLiteBackend(Backend):
+    """
+    Classification on a quantized TFLite interpreter (XNNPACK on CPU).
+
+    The interpreter is resized to each batch size it sees; it is not
+    thread-safe, so calls are serialised.
+    """
+
+    name = 'tflite'
+
+    def __init__(self, artifact_path, explainer, num_threads=None, quantization=None):
+        super().__init__(explainer)
+        self.artifact_path = artifact_path
+        self.quantization = quantization
+        with warnings.catch_warnings():
+            # tf.lite.Interpreter warns that it moved to LiteRT
+            warnings.simplefilter('ignore')
+            self.interpreter = _interpreter_class()(model_path=artifact_path, num_threads=num_threads or None)
+        self._input = self.interpreter.get_input_details()[0]['index']
+        self._output = self.interpreter.get_output_details()[0]['index']
+        self._shape = None
+        self._lock = threading.Lock()
+        self.offline_accuracy = None
+        if os.path.exists(report_path(artifact_path)):
+            with open(report_path(artifact_path)) as f:
+                self.offline_accuracy = json.load(f).get("accuracy")
+
+    def _predict(self, images):
+        images = np.asarray(images, dtype=np.float32)
+        with self._lock:
+            if self._shape != images.shape:
+                self.interpreter.resize_tensor_input(self._input, images.shape)
+                self.interpreter.allocate_tensors()
+                self._shape = images.shape
+            self.interpreter.set_tensor(self._input, images)
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self._output).copy()
+
+    def verify(self, images):
+        """
+        Measure the accuracy delta against the Keras model on `images`.
+        """
+        self.accuracy = compare(self.explainer.predict(images), self._predict(images))
+        return self.accuracy
+
+    def stats(self):
+        return {
+            **super().stats(),
+            "quantization": self.quantization,
+            "artifact": os.path.basename(self.artifact_path),
+            "offline_accuracy": self.offline_accuracy,
+        }
+
+
+def batch_runner(engine, op):
+    """
+    The MicroBatcher function for `op` on a backend (or InferenceEngine).
+
+    `predict` and `predict_and_explain` resolve to (scores, heatmap,
+    embedding) per image, with None for what the op doesn't compute;
+    `explain` resolves to (heatmap,). Given an `explain` mask (groups from
+    MicroBatcher.submit_many), `predict_and_explain` scores the whole batch
+    and computes heatmaps only for the masked images, leaving zeros for
+    the rest.
+    """
+    if op == 'predict':
+        def run(images, explain=None):
+            predictions, embeddings = engine.predict(images, embed=True)
+            return predictions, None, embeddings
+        return run
+    if op == 'predict_and_explain':
+        def run(images, explain=None):
+            if explain is None or explain.all():
+                return engine.predict_and_explain(images, embed=True)
+            predictions, embeddings = engine.predict(images, embed=True)
+            heatmaps = None
+            if explain.any():
+                explained = engine.explain(images[explain])
+                heatmaps = np.zeros((len(images),) + explained.shape[1:], explained.dtype)
+                heatmaps[explain] = explained
+            return predictions, heatmaps, embeddings
+        return run
+    if op == 'explain':
+        return engine.explain
+    raise ValueError(f"Unknown inference op {op!r}")
+
+
+def load_backend(config, model_path=None, last_conv_layer_name=None, input_size=None):
+    """
+    Load the model and wrap it in the backend `INFERENCE_BACKEND` selects.
+
+    Loads MODEL_PATH unless a registry model is given (`model_path` with its
+    Grad-CAM layer and input size). Returns None when the model can't be
+    loaded. The TFLite backend falls back to Keras when its artifact hasn't
+    been converted; at load it is checked against Keras on
+    TFLITE_VERIFY_IMAGES synthetic images (the conversion report has the
+    delta on real images).
+    """
+    # TensorFlow is only imported here, off the app factory path
+    from .inference import InferenceEngine
+
+    if config['INFERENCE_BACKEND'] not in BACKENDS:
+        raise ValueError(f"Unknown INFERENCE_BACKEND {config['INFERENCE_BACKEND']!r}, expected one of {BACKENDS}")
+    model_path = model_path or config['MODEL_PATH']
+    model, last_conv_layer_name = load_model_safe(model_path, last_conv_layer_name)
+    if model is None:
+        return None
+    explainer = InferenceEngine(model, last_conv_layer_name, explain_classes=config['GRADCAM_CLASSES'])
+    if config['INFERENCE_BACKEND'] == 'keras':
+        return KerasBackend(explainer)
+
+    artifact = resolve_artifact(config, model_path)
+    if artifact is None:
+        logger.warning("No TFLite artifact found (run `python -m scripts.convert_tflite`), using the Keras backend")
+        return KerasBackend(explainer)
+    backend = TFLiteBackend(artifact, explainer, num_threads=config['INFERENCE_INTRA_OP_THREADS'],
+                            quantization=config['TFLITE_QUANTIZATION'])
+    if config['TFLITE_VERIFY_IMAGES']:
+        size = input_size or config['MODEL_INPUT_SIZE']
+        shape = tuple(size if dim is None else dim for dim in backend.input_shape)
+        images = np.random.default_rng(0).uniform(-1, 1, (config['TFLITE_VERIFY_IMAGES'],) + shape)
+        backend.verify(images.astype(np.float32))
+    return backend
@@ -0,0 +1,178 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from .admission import DeadlineExceeded, Overloaded
+
+
+class MicroBatcher:
+    """
+    Gathers preprocessed images from concurrent requests into batches.
+
+    A single worker thread owns the model: it waits for the first pending
+    image, keeps collecting until `max_batch_size` images are queued or
+    `max_wait_ms` has passed, runs one batched call to `run_batch` and hands
+    each caller its own slice of the result through a Future.
+
+    `run_batch` takes an (N, H, W, C) array and returns a tuple of per-image
+    arrays (or None), e.g. InferenceEngine.predict_and_explain.
+
+    `submit_many` queues several images as a group that always lands in
+    the same batch.
+
+    With `max_queue`, submitting to a queue that long raises Overloaded.
+    Images whose deadline has passed by the time their batch is formed are
+    dropped with DeadlineExceeded instead of being run.
+    """
+
+    def __init__(self, run_batch, max_batch_size=16, max_wait_ms=10, max_queue=None):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.max_queue = max_queue
+
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._full_batches = 0
+        self._expired = 0
+        self._rejected = 0
+        self._closed = False
+
+        self._worker = threading.Thread(target=self._run, name='inference-batcher', daemon=True)
+        self._worker.start()
+
+    def submit(self, image, deadline=None):
+        """
+        Queue a single preprocessed image (shape: (H, W, C)), optionally
+        with an admission.Deadline.
+
+        Returns a Future resolving to the per-image slice of each output of
+        `run_batch`.
+        """
+        return self._put(np.asarray(image)[None], deadline, None, single=True)
+
+    def submit_many(self, images, deadline=None, explain=None):
+        """
+        Queue (N, H, W, C) images as one group, run in a single batch (which
+        may then exceed `max_batch_size`).
+
+        With `explain`, only the group's first `explain` images need every
+        output; `run_batch` is then called with an `explain` mask over the
+        batch (see backends.batch_runner). Returns a Future resolving to the
+        group's slice of each output of `run_batch`.
+        """
+        return self._put(np.asarray(images), deadline, explain, single=False)
+
+    def _put(self, images, deadline, explain, single):
+        if self._closed:
+            raise RuntimeError("Batcher is closed")
+        if self.max_queue and self._queue.qsize() >= self.max_queue:
+            with self._stats_lock:
+                self._rejected += 1
+            raise Overloaded("Inference queue full")
+        future = Future()
+        self._queue.put((images, future, deadline, explain, single))
+        return future
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def close(self):
+        self._closed = True
+        self._queue.put(None)
+        self._worker.join()
+
+    def stats(self):
+        with self._stats_lock:
+            batches = self._batches
+            items = self._items
+            full = self._full_batches
+            expired = self._expired
+            rejected = self._rejected
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "batches": batches,
+            "items": items,
+            "full_batches": full,
+            "mean_batch_size": items / batches if batches else 0.0,
+            "fill_ratio": items / (batches * self.max_batch_size) if batches else 0.0,
+            "queue_depth": self._queue.qsize(),
+            "max_queue": self.max_queue,
+            "expired": expired,
+            "rejected": rejected,
+        }
+
+    def _collect(self, first):
+        batch = [first]
+        count = len(first[0])
+        deadline = time.monotonic() + self.max_wait
+        while count < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+            count += len(item[0])
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+
+            batch = []
+            for item in self._collect(first):
+                images, future, deadline = item[:3]
+                if not future.set_running_or_notify_cancel():
+                    continue
+                if deadline is not None and deadline.expired():
+                    future.set_exception(DeadlineExceeded())
+                    with self._stats_lock:
+                        self._expired += len(images)
+                    continue
+                batch.append(item)
+            if not batch:
+                continue
+
+            sizes = [len(images) for images, *_ in batch]
+            try:
+                kwargs = {}
+                if any(explain is not None for _, _, _, explain, _ in batch):
+                    mask = np.ones(sum(sizes), bool)
+                    lo = 0
+                    for size, (_, _, _, explain, _) in zip(sizes, batch):
+                        if explain is not None:
+                            mask[lo + explain:lo + size] = False
+                        lo += size
+                    kwargs['explain'] = mask
+                outputs = self.run_batch(np.concatenate([images for images, *_ in batch]), **kwargs)
+                if not isinstance(outputs, tuple):
+                    outputs = (outputs,)
+            except Exception as e:
+                for _, future, *_ in batch:
+                    future.set_exception(e)
+            else:
+                lo = 0
+                for size, (_, future, _, _, single) in zip(sizes, batch):
+                    if single:
+                        future.set_result(tuple(None if out is None else out[lo] for out in outputs))
+                    else:
+                        future.set_result(tuple(None if out is None else out[lo:lo + size] for out in outputs))
+                    lo += size
+
+            with self._stats_lock:
+                self._batches += 1
+                self._items += sum(sizes)
+                if sum(sizes) >= self.max_batch_size:
+                    self._full_batches += 1
@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def image_digest(img_bytes):
+    """
+    Content hash of raw upload bytes, used to name stored uploads.
+    """
+    return hashlib.sha256(img_bytes).hexdigest()
+
+
+def cache_key(digest, model_identity):
+    """
+    Cache key for an image digest scored by a particular model.
+    """
+    return hashlib.sha256(f"{model_identity}\0{digest}".encode('utf-8')).hexdigest()
+
+
+class PredictionCache:
+    """
+    Content-addressed cache of prediction results.
+
+    Entries live in a size-bounded in-memory LRU in front of an on-disk
+    SQLite index, so results survive restarts without holding every entry in
+    memory. The index remembers which model produced its entries and is
+    wiped when a different model is loaded.
+    """
+
+    def __init__(self, index_path, max_entries=1024):
+        self.index_path = index_path
+        self.max_entries = max(1, int(max_entries))
+        self.model_identity = None
+        self.hits = 0
+        self.misses = 0
+
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+        self._conn = sqlite3.connect(index_path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+
+    def set_model(self, model_identity):
+        """
+        Bind the cache to a model, dropping entries produced by any other.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE name = 'model'").fetchone()
+            if row is None or row[0] != model_identity:
+                self._clear_locked()
+                with self._conn:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO meta (name, value) VALUES ('model', ?)", (model_identity,)
+                    )
+            self.model_identity = model_identity
+
+    def key_for(self, digest, model_identity=None):
+        """
+        Key for an upload scored by `model_identity` (default: the bound model).
+        """
+        return cache_key(digest, model_identity or self.model_identity)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is not None:
+                self._lru.move_to_end(key)
+                self.hits += 1
+                return entry
+
+            row = self._conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            entry = json.loads(row[0])
+            self._remember(key, entry)
+            with self._conn:
+                self._conn.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._remember(key, entry)
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO entries (key, value, last_used) VALUES (?, ?, ?)",
+                    (key, json.dumps(entry), time.time())
+                )
+
+    def update(self, key, **fields):
+        """
+        Merge fields into an existing entry without counting a lookup.
+        """
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is None:
+                row = self._conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return
+                entry = json.loads(row[0])
+            entry = dict(entry, **fields)
+            if key in self._lru:
+                self._lru[key] = entry
+            with self._conn:
+                self._conn.execute("UPDATE entries SET value = ? WHERE key = ?", (json.dumps(entry), key))
+
+    def discard(self, key):
+        with self._lock:
+            self._lru.pop(key, None)
+            with self._conn:
+                self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def clear(self):
+        with self._lock:
+            self._clear_locked()
+
+    def stats(self):
+        with self._lock:
+            disk_entries = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "memory_entries": len(self._lru),
+                "max_memory_entries": self.max_entries,
+                "disk_entries": disk_entries,
+                "model": self.model_identity,
+            }
+
+    def _remember(self, key, entry):
+        self._lru[key] = entry
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+    def _clear_locked(self):
+        self._lru.clear()
+        with self._conn:
+            self._conn.execute("DELETE FROM entries")
@@ -0,0 +1,662 @@
+"""
+Similar-case search over prediction embeddings.
+
+Every scored image's embedding (its pooled penultimate-layer activations,
+computed in the same forward pass as its scores) is L2-normalised and
+appended as float16 to a record file per model version, under
+EMBEDDING_FOLDER/<name>/<version>/, next to its Prediction id and owner.
+Each append is a single O_APPEND write, so every worker process can add
+to the same file; readers memory-map it, and index each record's id and
+owner in memory as it is mapped, so looking up a prediction or a user's
+records doesn't scan the file.
+
+A version's records are searched exactly (blocked matrix-vector products)
+until there are EMBEDDING_IVF_MIN_SIZE of them. Past that an IVF-PQ index
+is trained: a coarse k-means quantizer picks the lists to probe, product-
+quantized residual codes score their members approximately, and the best
+candidates are re-ranked exactly from the float16 vectors. Records added
+since the index was last extended are scanned exactly, and are encoded
+into it (only the new ones) in the background every
+EMBEDDING_IVF_UPDATE_EVERY records. The index is retrained once the
+version has grown to four times the size it was trained on.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Rows of float32 converted per block by the exact scan (bounds its memory)
+EXACT_BLOCK_BYTES = 16 * 1024 * 1024
+# Product quantizer: at most this many sub-vectors, 256 centroids each
+PQ_SUBVECTORS = 32
+PQ_CENTROIDS = 256
+KMEANS_ITERATIONS = 10
+# Candidates re-ranked exactly per result requested
+RERANK_FACTOR = 32
+RETRAIN_GROWTH = 4
+# A lock left behind by a crashed process is taken over after this long
+LOCK_STALE_SECONDS = 3600
+NO_OWNER = -1
+
+
+def record_dtype(dim):
+    return np.dtype([('id', '<i8'), ('owner', '<i8'), ('vector', '<f2', (dim,))])
+
+
+def normalize(vectors):
+    """
+    Unit-length float32 rows, so inner product is cosine similarity.
+    """
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _write_json_atomic(path, payload):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(payload, f)
+    os.replace(tmp_path, path)
+
+
+def _top_k(scores, positions, k):
+    """
+    The k best (scores, positions), best first.
+    """
+    if len(scores) > k:
+        keep = np.argpartition(-scores, k - 1)[:k]
+        scores, positions = scores[keep], positions[keep]
+    order = np.argsort(-scores, kind='stable')
+    return scores[order], positions[order]
+
+
+def _among(positions, allowed):
+    """
+    Mask of the `positions` found in the sorted array `allowed`.
+    """
+    if not len(allowed):
+        return np.zeros(len(positions), bool)
+    at = np.searchsorted(allowed, positions).clip(max=len(allowed) - 1)
+    return allowed[at] == positions
+
+
+class _Positions:
+    """
+    Growable int64 array of record positions, appended in order.
+    """
+
+    def __init__(self):
+        self._data = np.empty(16, np.int64)
+        self._size = 0
+
+    def extend(self, positions):
+        end = self._size + len(positions)
+        if end > len(self._data):
+            grown = np.empty(max(end, 2 * len(self._data)), np.int64)
+            grown[:self._size] = self._data[:self._size]
+            self._data = grown
+        self._data[self._size:end] = positions
+        self._size = end
+
+    def view(self):
+        return self._data[:self._size]
+
+
+def exact_search(records, query, k, owner=None, exclude_id=None, positions=None):
+    """
+    Exact top-k by inner product over `positions` (every record by
+    default), scanned in blocks.
+
+    Returns (scores, positions) best first.
+    """
+    best_scores = np.empty(0, np.float32)
+    best_positions = np.empty(0, np.int64)
+    total = len(records) if positions is None else len(positions)
+    block = max(1, EXACT_BLOCK_BYTES // (query.shape[0] * 4))
+    for lo in range(0, total, block):
+        if positions is None:
+            chunk_positions = np.arange(lo, min(lo + block, total))
+            chunk = records[lo:lo + block]
+        else:
+            chunk_positions = positions[lo:lo + block]
+            chunk = records[chunk_positions]
+        scores = chunk['vector'].astype(np.float32) @ query
+        mask = chunk['id'] != exclude_id
+        if owner is not None:
+            mask &= chunk['owner'] == owner
+        best_scores, best_positions = _top_k(
+            np.concatenate([best_scores, scores[mask]]), np.concatenate([best_positions, chunk_positions[mask]]), k
+        )
+    return best_scores, best_positions
+
+
+def _nearest(x, centroids, spherical):
+    """
+    Index of the nearest centroid per row (largest inner product when
+    `spherical`, else smallest Euclidean distance).
+    """
+    bias = None if spherical else -0.5 * np.einsum('ij,ij->i', centroids, centroids)
+    block = max(1, EXACT_BLOCK_BYTES // (len(centroids) * 4))
+    assign = np.empty(len(x), np.int64)
+    for lo in range(0, len(x), block):
+        scores = x[lo:lo + block] @ centroids.T
+        if bias is not None:
+            scores += bias
+        assign[lo:lo + block] = scores.argmax(axis=1)
+    return assign
+
+
+def kmeans(x, k, rng, iterations=KMEANS_ITERATIONS, spherical=False):
+    """
+    Lloyd's k-means on float32 rows; `spherical` keeps unit-length
+    centroids for inner-product assignment.
+    """
+    k = min(k, len(x))
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = _nearest(x, centroids, spherical)
+        order = np.argsort(assign, kind='stable')
+        counts = np.bincount(assign, minlength=k)
+        filled = counts > 0
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[filled]
+        centroids[filled] = np.add.reduceat(x[order], starts, axis=0) / counts[filled, None]
+        # Reseed empty clusters from random rows
+        empty = np.flatnonzero(~filled)
+        if len(empty):
+            centroids[empty] = x[rng.choice(len(x), len(empty), replace=False)]
+        if spherical:
+            centroids = normalize(centroids)
+    return centroids
+
+
+def pq_subvectors(dim):
+    """
+    Number of PQ sub-vectors for a dimension: the largest divisor of `dim`
+    up to PQ_SUBVECTORS.
+    """
+    return max(m for m in range(1, min(dim, PQ_SUBVECTORS) + 1) if dim % m == 0)
+
+
+class EmbeddingStore:
+    """
+    Append-only, memory-mapped (id, owner, float16 vector) records for one
+    model version.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, 'records.bin')
+        self.meta_path = os.path.join(folder, 'store.json')
+        self.dim = None
+        self.dtype = None
+        self._records = None
+        self._fd = None
+        self._lock = threading.Lock()
+        # Prediction id -> position of its latest record, owner -> positions
+        # of its records; cover the first `_indexed` records
+        self._positions = {}
+        self._owned = {}
+        self._indexed = 0
+        if os.path.exists(self.meta_path):
+            self._set_dim(self._read_meta()["dim"])
+
+    def _read_meta(self):
+        with open(self.meta_path) as f:
+            return json.load(f)
+
+    def _set_dim(self, dim):
+        self.dim = int(dim)
+        self.dtype = record_dtype(self.dim)
+
+    def _create(self, dim):
+        # Another process may create the store at the same time; the first
+        # metadata file to land wins
+        os.makedirs(self.folder, exist_ok=True)
+        tmp_path = f"{self.meta_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"dim": dim}, f)
+        try:
+            os.link(tmp_path, self.meta_path)
+        except FileExistsError:
+            dim = self._read_meta()["dim"]
+        finally:
+            os.remove(tmp_path)
+        self._set_dim(dim)
+
+    def add(self, ids, owners, vectors):
+        """
+        Append embeddings for Prediction ids (owners: user ids, None for
+        anonymous predictions).
+        """
+        vectors = normalize(vectors)
+        with self._lock:
+            if self.dim is None:
+                self._create(vectors.shape[1])
+            if vectors.shape[1] != self.dim:
+                raise ValueError(f"Expected {self.dim}-dimensional embeddings, got {vectors.shape[1]}")
+            records = np.empty(len(vectors), self.dtype)
+            records['id'] = ids
+            records['owner'] = [NO_OWNER if owner is None else int(owner) for owner in owners]
+            records['vector'] = vectors
+            if self._fd is None:
+                self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            os.write(self._fd, records.tobytes())
+
+    def records(self):
+        """
+        Memory-mapped view of every complete record, remapped (and the new
+        records indexed) when the file has grown.
+        """
+        if self.dim is None:
+            if not os.path.exists(self.meta_path):
+                return np.empty(0, record_dtype(1))
+            self._set_dim(self._read_meta()["dim"])
+        try:
+            count = os.path.getsize(self.path) // self.dtype.itemsize
+        except FileNotFoundError:
+            count = 0
+        records = self._records
+        if records is None or len(records) != count:
+            with self._lock:
+                records = (np.memmap(self.path, self.dtype, 'r', shape=(count,)) if count
+                           else np.empty(0, self.dtype))
+                if count > self._indexed:
+                    self._index(records)
+                self._records = records
+        return records
+
+    def _index(self, records):
+        # Records are only ever appended, so only the new ones are read
+        start = self._indexed
+        ids = np.asarray(records['id'][start:])
+        owners = np.asarray(records['owner'][start:])
+        self._positions.update(zip(ids.tolist(), range(start, len(records))))
+        order = np.argsort(owners, kind='stable')
+        found, starts = np.unique(owners[order], return_index=True)
+        for owner, group in zip(found.tolist(), np.split(order + start, starts[1:])):
+            self._owned.setdefault(owner, _Positions()).extend(group)
+        self._indexed = len(records)
+
+    def position(self, prediction_id):
+        """
+        Position of a prediction's latest record, or None.
+        """
+        self.records()
+        return self._positions.get(int(prediction_id))
+
+    def owner_positions(self, owner):
+        """
+        Positions of an owner's records (NO_OWNER for anonymous ones), in
+        file order.
+        """
+        self.records()
+        positions = self._owned.get(int(owner))
+        return positions.view() if positions is not None else np.empty(0, np.int64)
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            self._records = None
+
+
+class IvfPq:
+    """
+    Inverted-file index with product-quantized residuals over the first
+    `count` records of a store.
+
+    Files: `ivf.json` names the current generation and how many records
+    it covers; `ivf.<generation>.npz` holds the coarse centroids and PQ
+    codebooks, and `ivf.<generation>.codes` each covered record's list
+    and codes, appended as records are encoded.
+    """
+
+    def __init__(self, folder, generation, count, centroids, codebooks, trained_on):
+        self.folder = folder
+        self.generation = generation
+        self.count = count
+        self.centroids = centroids
+        self.codebooks = codebooks
+        self.trained_on = trained_on
+        m = codebooks.shape[0]
+        self.code_dtype = np.dtype([('list', '<i4'), ('code', 'u1', (m,))])
+        self.codes = np.empty(0, self.code_dtype)
+        self._order = None
+        self._offsets = None
+
+    @staticmethod
+    def meta_path(folder):
+        return os.path.join(folder, 'ivf.json')
+
+    def codes_path(self):
+        return os.path.join(self.folder, f'ivf.{self.generation}.codes')
+
+    @classmethod
+    def load(cls, folder):
+        """
+        The current index in `folder`, or None before one is trained.
+        """
+        try:
+            with open(cls.meta_path(folder)) as f:
+                meta = json.load(f)
+            arrays = np.load(os.path.join(folder, f"ivf.{meta['generation']}.npz"))
+        except FileNotFoundError:
+            return None
+        index = cls(folder, meta['generation'], meta['count'], arrays['centroids'], arrays['codebooks'],
+                    meta['trained_on'])
+        index._map_codes()
+        return index
+
+    @classmethod
+    def train(cls, folder, records, generation, rng):
+        """
+        Train the coarse quantizer (about sqrt(n) lists) and PQ codebooks
+        on a sample of the records.
+        """
+        lists = int(np.clip(np.sqrt(len(records)), 8, 4096))
+        picked = np.sort(rng.choice(len(records), min(len(records), 64 * lists), replace=False))
+        sample = normalize(records['vector'][picked])
+        centroids = kmeans(sample, lists, rng, spherical=True)
+        residuals = sample - centroids[_nearest(sample, centroids, spherical=True)]
+        m = pq_subvectors(sample.shape[1])
+        sub = residuals.reshape(len(residuals), m, -1)
+        codebooks = np.stack([kmeans(np.ascontiguousarray(sub[:, j]), PQ_CENTROIDS, rng) for j in range(m)])
+        if codebooks.shape[1] < PQ_CENTROIDS:
+            # Tiny samples: pad so every code indexes a centroid
+            pad = np.repeat(codebooks[:, -1:], PQ_CENTROIDS - codebooks.shape[1], axis=1)
+            codebooks = np.concatenate([codebooks, pad], axis=1)
+        return cls(folder, generation, 0, centroids.astype(np.float32), codebooks.astype(np.float32),
+                   int(len(records)))
+
+    def save(self):
+        """
+        Write the quantizers and an empty code file for this generation.
+        """
+        path = os.path.join(self.folder, f'ivf.{self.generation}.npz')
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, centroids=self.centroids, codebooks=self.codebooks)
+        os.replace(tmp_path, path)
+        open(self.codes_path(), 'wb').close()
+
+    def encode(self, vectors):
+        """
+        (list, codes) records for unit vectors (float32).
+        """
+        assign = _nearest(vectors, self.centroids, spherical=True)
+        residuals = vectors - self.centroids[assign]
+        m = self.codebooks.shape[0]
+        sub = residuals.reshape(len(vectors), m, -1)
+        encoded = np.empty(len(vectors), self.code_dtype)
+        encoded['list'] = assign
+        for j in range(m):
+            encoded['code'][:, j] = _nearest(np.ascontiguousarray(sub[:, j]), self.codebooks[j], spherical=False)
+        return encoded
+
+    def extend(self, records, block=65536):
+        """
+        Encode records[self.count:] and append their codes, then publish the
+        new count. Returns how many were added.
+        """
+        start = self.count
+        with open(self.codes_path(), 'ab') as f:
+            for lo in range(start, len(records), block):
+                chunk = records[lo:lo + block]
+                f.write(self.encode(normalize(chunk['vector'])).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        self.count = len(records)
+        _write_json_atomic(self.meta_path(self.folder), {
+            "generation": self.generation, "count": self.count, "trained_on": self.trained_on,
+            "lists": len(self.centroids), "subvectors": self.codebooks.shape[0],
+        })
+        self._map_codes()
+        return self.count - start
+
+    def _map_codes(self):
+        count = self.count
+        self.codes = (np.memmap(self.codes_path(), self.code_dtype, 'r', shape=(count,))
+                      if count else np.empty(0, self.code_dtype))
+        # Inverted lists: record positions grouped by list
+        lists = np.asarray(self.codes['list'])
+        self._order = np.argsort(lists, kind='stable')
+        self._offsets = np.concatenate([[0], np.cumsum(np.bincount(lists, minlength=len(self.centroids)))])
+
+    def search(self, records, query, k, probes, allowed=None, exclude_id=None):
+        """
+        Approximate top-k over the covered records (only those whose
+        positions are in the sorted array `allowed`, when given), re-ranked
+        exactly.
+
+        Returns (scores, positions) best first.
+        """
+        coarse = self.centroids @ query
+        probes = min(probes, len(coarse))
+        probed = np.argpartition(-coarse, probes - 1)[:probes]
+        sizes = self._offsets[probed + 1] - self._offsets[probed]
+        positions = np.concatenate([self._order[self._offsets[l]:self._offsets[l + 1]] for l in probed])
+        if not len(positions):
+            return np.empty(0, np.float32), np.empty(0, np.int64)
+        base = np.repeat(coarse[probed], sizes)
+        if allowed is not None:
+            mask = _among(positions, allowed)
+            positions, base = positions[mask], base[mask]
+        m = self.codebooks.shape[0]
+        # Inner products of each query sub-vector with each PQ centroid
+        table = np.einsum('jcs,js->jc', self.codebooks, query.reshape(m, -1))
+        codes = self.codes['code'][positions]
+        approx = base + table[np.arange(m), codes].sum(axis=1)
+
+        _, candidates = _top_k(approx, positions, k * RERANK_FACTOR)
+        # Sorted positions read the memory map in file order
+        candidates = np.sort(candidates)
+        rows = records[candidates]
+        keep = rows['id'] != exclude_id
+        exact = rows['vector'][keep].astype(np.float32) @ query
+        return _top_k(exact, candidates[keep], k)
+
+    def stats(self):
+        return {"generation": self.generation, "indexed": int(self.count), "trained_on": self.trained_on,
+                "lists": int(len(self.centroids)), "subvectors": int(self.codebooks.shape[0])}
+
+
+class EmbeddingIndex:
+    """
+    Embeddings of one model version and the index over them.
+
+    Only the process holding `index.lock` trains or extends the IVF-PQ
+    index; every process picks up the result the next time it searches.
+    """
+
+    def __init__(self, folder, ivf_min_size=50000, probes=16, update_every=10000, background=True):
+        self.folder = folder
+        self.store = EmbeddingStore(folder)
+        self.ivf_min_size = ivf_min_size
+        self.probes = probes
+        self.update_every = update_every
+        self.background = background
+        self.lock_path = os.path.join(folder, 'index.lock')
+        self._ivf = None
+        self._ivf_stamp = None
+        self._updating = False
+        self._lock = threading.Lock()
+
+    def add(self, ids, owners, vectors):
+        self.store.add(ids, owners, vectors)
+        if self.background and self._needs_update():
+            with self._lock:
+                if self._updating:
+                    return
+                self._updating = True
+            threading.Thread(target=self._update_in_background, name='embedding-index', daemon=True).start()
+
+    def ivf(self):
+        """
+        The current IVF-PQ index, reloaded when another process changed it.
+        """
+        try:
+            stamp = os.stat(IvfPq.meta_path(self.folder)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        if stamp != self._ivf_stamp:
+            self._ivf = IvfPq.load(self.folder)
+            self._ivf_stamp = stamp
+        return self._ivf
+
+    def _needs_update(self):
+        count = len(self.store.records())
+        ivf = self.ivf()
+        if ivf is None:
+            return count >= self.ivf_min_size
+        return count - ivf.count >= self.update_every or count >= RETRAIN_GROWTH * ivf.trained_on
+
+    def _update_in_background(self):
+        try:
+            self.update()
+        except Exception:
+            logger.exception("Embedding index update failed", extra={"folder": self.folder})
+        finally:
+            with self._lock:
+                self._updating = False
+
+    def _acquire_file_lock(self):
+        try:
+            if time.time() - os.stat(self.lock_path).st_mtime > LOCK_STALE_SECONDS:
+                os.remove(self.lock_path)
+        except FileNotFoundError:
+            pass
+        try:
+            os.close(os.open(self.lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+            return True
+        except FileExistsError:
+            return False
+
+    def update(self):
+        """
+        Train, retrain or extend the IVF-PQ index as the record count calls
+        for. Returns what was done, or None (nothing to do, or another
+        process is at it).
+        """
+        if not self._acquire_file_lock():
+            return None
+        try:
+            records = self.store.records()
+            ivf = self.ivf()
+            if ivf is None and len(records) < self.ivf_min_size:
+                return None
+            action = 'extend'
+            if ivf is None or len(records) >= RETRAIN_GROWTH * ivf.trained_on:
+                action = 'train'
+                started = time.monotonic()
+                generation = ivf.generation + 1 if ivf is not None else 1
+                ivf = IvfPq.train(self.folder, records, generation, np.random.default_rng(generation))
+                ivf.save()
+                logger.info("Trained embedding index", extra={
+                    "folder": self.folder, "records": len(records), "lists": len(ivf.centroids),
+                    "seconds": round(time.monotonic() - started, 3),
+                })
+            ivf.extend(records)
+            # Drop older generations once the new one is published
+            for name in os.listdir(self.folder):
+                if name.startswith('ivf.') and name.split('.')[1].isdigit() and int(name.split('.')[1]) < ivf.generation:
+                    os.remove(os.path.join(self.folder, name))
+            self._ivf, self._ivf_stamp = None, None
+            return action
+        finally:
+            os.remove(self.lock_path)
+
+    def search(self, prediction_id, k=10, owner=None):
+        """
+        The k most similar other predictions to `prediction_id` (restricted
+        to `owner`'s when given), as a list of (prediction id, cosine
+        similarity) best first; None when the prediction has no embedding.
+        """
+        position = self.store.position(prediction_id)
+        if position is None:
+            return None
+        records = self.store.records()
+        query = records['vector'][position].astype(np.float32)
+
+        ivf = self.ivf()
+        covered = min(ivf.count, len(records)) if ivf is not None else 0
+        owned = None if owner is None else self.store.owner_positions(owner)
+        if not covered or (owned is not None and len(owned) < self.ivf_min_size):
+            # Small corpora, and users with few predictions, are scanned exactly
+            scores, positions = exact_search(records, query, k, None, prediction_id, owned)
+        else:
+            if owned is None:
+                tail = np.arange(covered, len(records))
+            else:
+                tail = owned[np.searchsorted(owned, covered):]
+            scores, positions = exact_search(records, query, k, None, prediction_id, tail)
+            ivf_scores, ivf_positions = ivf.search(records, query, k, self.probes, owned, prediction_id)
+            scores, positions = _top_k(np.concatenate([scores, ivf_scores]),
+                                       np.concatenate([positions, ivf_positions]), k)
+        # A prediction re-indexed (e.g. a cache hit) appears once
+        results, seen = [], set()
+        for score, prediction in zip(scores, records['id'][positions]):
+            if int(prediction) not in seen:
+                seen.add(int(prediction))
+                results.append((int(prediction), float(score)))
+        return results
+
+    def stats(self):
+        ivf = self.ivf()
+        count = len(self.store.records())
+        return {
+            "records": count,
+            "dim": self.store.dim,
+            "index": "ivfpq" if ivf is not None else "exact",
+            "ivf": ivf.stats() if ivf is not None else None,
+            "exact_tail": count - (ivf.count if ivf is not None else 0),
+        }
+
+    def close(self):
+        self.store.close()
+
+
+class EmbeddingIndexes:
+    """
+    Per-model-version embedding indexes under one folder, opened on first
+    use and kept open.
+    """
+
+    def __init__(self, folder, ivf_min_size=50000, probes=16, update_every=10000, background=True):
+        self.folder = folder
+        self.options = dict(ivf_min_size=ivf_min_size, probes=probes, update_every=update_every,
+                            background=background)
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def folder_for(self, key):
+        name, _, version = key.partition('@')
+        return os.path.join(self.folder, name, version or '_')
+
+    def get(self, key):
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is None:
+                index = self._indexes[key] = EmbeddingIndex(self.folder_for(key), **self.options)
+            return index
+
+    def add(self, key, prediction_ids, owners, vectors):
+        """
+        Index embeddings of predictions scored by model version `key`.
+        """
+        self.get(key).add(prediction_ids, owners, vectors)
+
+    def stats(self):
+        with self._lock:
+            indexes = dict(self._indexes)
+        return {key: index.stats() for key, index in indexes.items()}
+
+    def close(self):
+        with self._lock:
+            for index in self._indexes.values():
+                index.close()
+            self._indexes.clear()
@@ -0,0 +1,144 @@
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .extensions import db
+from .heatmaps import heatmap_count
+from .models import Prediction
+
+logger = logging.getLogger(__name__)
+
+
+def update_rows(prediction_ids, fields):
+    """
+    Default GradcamJobs store: update the rows in place and commit.
+    """
+    Prediction.query.filter(Prediction.id.in_(prediction_ids)).update(fields, synchronize_session=False)
+    db.session.commit()
+
+
+class GradcamJob:
+    """
+    A pending Grad-CAM render for one upload.
+
+    `prediction_ids` lists every Prediction row waiting for this heatmap: the
+    row that scheduled it plus any cache hits for the same upload that
+    arrived while it was still rendering.
+    """
+
+    def __init__(self, prediction_id, payload, on_complete=None):
+        self.id = prediction_id
+        self.prediction_ids = [prediction_id]
+        self.payload = payload
+        self.on_complete = on_complete
+        self.status = "pending"
+        self.gradcam_path = None
+        # Per-class heatmaps rendered, best class first
+        self.classes = 0
+        self.error = None
+        self.closed = False
+        self.done = threading.Event()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "gradcam_path": self.gradcam_path,
+            "error": self.error,
+        }
+
+
+class GradcamJobs:
+    """
+    Background worker pool that renders Grad-CAM overlays off the request path.
+
+    `render(payload)` computes the heatmap and returns the Prediction fields to
+    store (`gradcam_path`, `heatmap`), or an empty dict when the model has
+    nothing to explain. Once it returns, `on_complete(fields)` runs and every
+    waiting Prediction row is updated through `store(prediction_ids, fields)`
+    before the job is reported done. Jobs are keyed by prediction id; finished jobs are
+    kept in a bounded registry so status polls after completion still work.
+    """
+
+    def __init__(self, app, render, max_workers=2, max_jobs=10000, store=update_rows):
+        self.app = app
+        self.render = render
+        self.store = store
+        self.max_jobs = max_jobs
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='gradcam')
+
+    def submit(self, prediction_id, payload, on_complete=None):
+        job = GradcamJob(prediction_id, payload, on_complete)
+        with self._lock:
+            self._jobs[prediction_id] = job
+            self._evict()
+        self._executor.submit(self._run, job)
+        return job
+
+    def follow(self, job_id, prediction_id):
+        """
+        Attach another Prediction row to a job still in flight.
+
+        Returns False when the job is unknown or already finished.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.closed:
+                return False
+            job.prediction_ids.append(prediction_id)
+            self._jobs[prediction_id] = job
+            self._evict()
+            return True
+
+    def get(self, prediction_id):
+        with self._lock:
+            return self._jobs.get(prediction_id)
+
+    def wait(self, prediction_id, timeout):
+        job = self.get(prediction_id)
+        if job is not None:
+            job.done.wait(timeout)
+        return job
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def _evict(self):
+        while len(self._jobs) > self.max_jobs:
+            oldest = next(iter(self._jobs))
+            if not self._jobs[oldest].done.is_set():
+                break
+            self._jobs.pop(oldest)
+
+    def _run(self, job):
+        job.status = "running"
+        try:
+            fields = self.render(job.payload)
+            if fields and job.on_complete:
+                job.on_complete(fields)
+
+            with self._lock:
+                job.closed = True
+                prediction_ids = list(job.prediction_ids)
+
+            if fields:
+                with self.app.app_context():
+                    self.store(prediction_ids, fields)
+                    db.session.remove()
+                job.gradcam_path = fields["gradcam_path"]
+                job.classes = heatmap_count(fields["heatmap"])
+                job.status = "done"
+            else:
+                job.status = "failed"
+                job.error = "Grad-CAM unavailable for this model"
+        except Exception as e:
+            logger.exception("Grad-CAM job failed", extra={"job_id": job.id})
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            job.closed = True
+            job.payload = None
+            job.done.set()
@@ -0,0 +1,225 @@
+import hashlib
+import os
+import struct
+import threading
+
+import cv2
+import numpy as np
+
+from .storage import shard_path, write_atomic
+from .utils import overlay_heatmap
+
+COLORMAPS = {
+    'jet': cv2.COLORMAP_JET,
+    'turbo': cv2.COLORMAP_TURBO,
+    'inferno': cv2.COLORMAP_INFERNO,
+    'magma': cv2.COLORMAP_MAGMA,
+    'plasma': cv2.COLORMAP_PLASMA,
+    'viridis': cv2.COLORMAP_VIRIDIS,
+    'hot': cv2.COLORMAP_HOT,
+    'bone': cv2.COLORMAP_BONE,
+}
+
+# format -> (extension, mimetype, cv2.imencode params)
+FORMATS = {
+    'jpeg': ('.jpg', 'image/jpeg', [cv2.IMWRITE_JPEG_QUALITY, 90]),
+    'webp': ('.webp', 'image/webp', [cv2.IMWRITE_WEBP_QUALITY, 90]),
+    'png': ('.png', 'image/png', []),
+}
+EXTENSION_FORMATS = {'.jpg': 'jpeg', '.jpeg': 'jpeg', '.webp': 'webp', '.png': 'png'}
+
+DEFAULT_SIZE = 224
+MAX_SIZE = 4096
+
+
+def encode_heatmap(heatmap):
+    """
+    Pack a 2D heatmap as float16 with a (rows, cols) header.
+
+    A 7x7 MobileNetV2 heatmap takes 102 bytes. A (count, rows, cols) stack
+    of per-class heatmaps gets a (0, count, rows, cols) header instead;
+    rows is never 0, so single heatmaps stored before keep decoding.
+    """
+    heatmap = np.asarray(heatmap, dtype=np.float16)
+    if heatmap.ndim == 3:
+        return struct.pack('<HHHH', 0, *heatmap.shape) + heatmap.tobytes()
+    return struct.pack('<HH', *heatmap.shape) + heatmap.tobytes()
+
+
+def _heatmap_layout(blob):
+    rows, cols = struct.unpack_from('<HH', blob)
+    if rows:
+        return 1, rows, cols, 4
+    count, rows, cols = struct.unpack_from('<HHH', blob, 2)
+    return count, rows, cols, 8
+
+
+def heatmap_count(blob):
+    """
+    Number of class heatmaps in an encoded blob.
+    """
+    return _heatmap_layout(blob)[0]
+
+
+def decode_heatmap(blob, index=0):
+    """
+    The `index`-th class heatmap (0 for the top class) of an encoded blob.
+    """
+    count, rows, cols, offset = _heatmap_layout(blob)
+    if not 0 <= index < count:
+        raise IndexError(f"heatmap {index} out of range for {count}")
+    offset += index * rows * cols * 2
+    return np.frombuffer(blob, np.float16, count=rows * cols, offset=offset).reshape(rows, cols).astype(np.float32)
+
+
+class OverlayParams:
+    """
+    Rendering options for a Grad-CAM overlay, parsed from query parameters.
+
+    size: omitted for the legacy 224x224 square, `original` for the upload
+    resolution, or an integer for the longest edge (aspect preserved).
+    class_index: which of the stored per-class heatmaps to draw, by rank in
+    the prediction's differential (0, the top class, by default).
+    """
+
+    def __init__(self, size=None, colormap='jet', intensity=0.5, fmt='jpeg', class_index=0):
+        self.size = size
+        self.colormap = colormap
+        self.intensity = intensity
+        self.fmt = fmt
+        self.class_index = class_index
+
+    @classmethod
+    def from_args(cls, args, filename):
+        default_fmt = EXTENSION_FORMATS.get(os.path.splitext(filename)[1].lower(), 'jpeg')
+
+        size = args.get('size')
+        if size is not None and size != 'original':
+            try:
+                size = int(size)
+            except ValueError:
+                raise ValueError("size must be an integer or 'original'")
+            if not 1 <= size <= MAX_SIZE:
+                raise ValueError(f"size must be between 1 and {MAX_SIZE}")
+
+        colormap = args.get('colormap', 'jet').lower()
+        if colormap not in COLORMAPS:
+            raise ValueError(f"colormap must be one of {', '.join(sorted(COLORMAPS))}")
+
+        try:
+            intensity = float(args.get('intensity', 0.5))
+        except ValueError:
+            raise ValueError("intensity must be a number")
+        if not 0.0 <= intensity <= 1.0:
+            raise ValueError("intensity must be between 0 and 1")
+
+        fmt = args.get('format', default_fmt).lower()
+        fmt = 'jpeg' if fmt == 'jpg' else fmt
+        if fmt not in FORMATS:
+            raise ValueError(f"format must be one of {', '.join(sorted(FORMATS))}")
+
+        try:
+            class_index = int(args.get('class', 0))
+        except ValueError:
+            raise ValueError("class must be an integer")
+        if class_index < 0:
+            raise ValueError("class must not be negative")
+
+        return cls(size, colormap, intensity, fmt, class_index)
+
+    @property
+    def mimetype(self):
+        return FORMATS[self.fmt][1]
+
+    def cache_key(self, heatmap_blob, image_path):
+        params = f"{self.size}|{self.colormap}|{self.intensity:.3f}|{self.fmt}|{image_path}"
+        if self.class_index:
+            # Top-class keys predate per-class heatmaps; keep them stable
+            params += f"|{self.class_index}"
+        return hashlib.sha256(params.encode('utf-8') + b'\0' + heatmap_blob).hexdigest()
+
+
+def render_overlay(heatmap, base_image, params):
+    """
+    Render an encoded Grad-CAM overlay of `heatmap` on a BGR base image.
+    """
+    if params.size is None:
+        base_image = cv2.resize(base_image, (DEFAULT_SIZE, DEFAULT_SIZE))
+    elif params.size != 'original':
+        height, width = base_image.shape[:2]
+        scale = params.size / max(height, width)
+        target = (max(1, round(width * scale)), max(1, round(height * scale)))
+        interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+        base_image = cv2.resize(base_image, target, interpolation=interpolation)
+
+    overlay = overlay_heatmap(heatmap, base_image, params.intensity, COLORMAPS[params.colormap])
+    ext, _, encode_params = FORMATS[params.fmt]
+    ok, encoded = cv2.imencode(ext, overlay, encode_params)
+    if not ok:
+        raise ValueError(f"Could not encode overlay as {params.fmt}")
+    return encoded.tobytes()
+
+
+class OverlayCache:
+    """
+    Bounded on-disk cache of rendered overlay variants.
+
+    Files live in hash-sharded subdirectories, are written atomically and
+    are evicted least-recently-used first (by mtime, refreshed on every hit)
+    once the folder exceeds `max_bytes`.
+    """
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self._total = sum(os.path.getsize(path) for path in self._files())
+
+    def _files(self):
+        for root, _, names in os.walk(self.folder):
+            for name in names:
+                if not name.endswith('.tmp'):
+                    yield os.path.join(root, name)
+
+    def path_for(self, key, fmt):
+        return shard_path(self.folder, key + FORMATS[fmt][0])
+
+    def get(self, key, fmt):
+        path = self.path_for(key, fmt)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, fmt, data):
+        path = self.path_for(key, fmt)
+        write_atomic(path, data)
+        with self._lock:
+            self._total += len(data)
+            if self._total > self.max_bytes:
+                self._evict()
+        return path
+
+    def _evict(self):
+        entries = []
+        for path in self._files():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        # Trim to 90% so a full cache doesn't rescan on every write
+        target = self.max_bytes * 0.9
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        self._total = total
@@ -0,0 +1,70 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class IdentityCache:
+    """
+    Short-TTL cache of user profiles keyed on the JWT identity.
+
+    Entries expire after `ttl` seconds and are dropped as soon as the user
+    row changes in this process; other processes see the change within
+    the TTL.
+    """
+
+    def __init__(self, ttl=30.0, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, identity, load):
+        """
+        Cached profile for `identity`, calling `load(identity)` on a miss.
+
+        `load` returns a dict or None; unknown users are not cached.
+        """
+        key = str(identity)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        profile = load(identity)
+        if profile is not None and self.ttl > 0:
+            with self._lock:
+                self._entries[key] = (now + self.ttl, profile)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return profile
+
+    def peek(self, identity):
+        """
+        Cached profile for `identity` without loading it on a miss (None).
+        """
+        with self._lock:
+            entry = self._entries.get(str(identity))
+            if entry is None or entry[0] <= time.monotonic():
+                return None
+            self._entries.move_to_end(str(identity))
+            self.hits += 1
+            return entry[1]
+
+    def invalidate(self, identity):
+        with self._lock:
+            self._entries.pop(str(identity), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses, "ttl": self.ttl}
@@ -0,0 +1,161 @@
+import numpy as np
+import tensorflow as tf
+
+
+def find_conv_layer(model, last_conv_layer_name=None):
+    """
+    Return the name of the layer Grad-CAM should explain.
+
+    Uses the requested layer when the model has it, otherwise falls back to
+    the last layer with a 4D (batch, height, width, channels) output.
+    """
+    if last_conv_layer_name:
+        try:
+            model.get_layer(last_conv_layer_name)
+            return last_conv_layer_name
+        except ValueError:
+            pass
+
+    for layer in reversed(model.layers):
+        try:
+            shape = layer.output.shape
+        except (AttributeError, ValueError):
+            continue
+        if len(shape) == 4:
+            return layer.name
+    return None
+
+
+def find_embedding_tensor(model):
+    """
+    The pooled penultimate activations (the input to the classifier head)
+    used as the image's embedding, or None when the head's input isn't a
+    flat (batch, features) vector.
+    """
+    try:
+        tensor = model.layers[-1].input
+    except (AttributeError, ValueError):
+        return None
+    if isinstance(tensor, (list, tuple)) or len(tensor.shape) != 2:
+        return None
+    return tensor
+
+
+class InferenceEngine:
+    """
+    Single-pass classification + Grad-CAM for a loaded Keras model.
+
+    The conv-output/prediction grad model is built once per model and the
+    forward/backward pass is traced into a tf.function, so a request costs
+    one forward pass and one gradient computation instead of two
+    `model.predict` calls and a fresh graph. The same pass also yields the
+    image embeddings (see find_embedding_tensor) for `embed=True` callers.
+
+    With `explain_classes` k > 1 every image gets heatmaps for its k best
+    classes, best first, shaped (N, k, h, w) instead of (N, h, w); all k
+    come from the same forward pass and one vectorised backward pass.
+    """
+
+    def __init__(self, model, last_conv_layer_name=None, explain_classes=1):
+        self.model = model
+        self.last_conv_layer_name = find_conv_layer(model, last_conv_layer_name)
+        self.explain_classes = max(1, min(int(explain_classes), int(model.output_shape[-1])))
+        embedding = find_embedding_tensor(model)
+        self.embedding_dim = int(embedding.shape[-1]) if embedding is not None else None
+        # Every graph outputs (conv, embedding, predictions), minus what the model lacks
+        self._embed_model = None
+        if embedding is not None:
+            self._embed_model = tf.keras.models.Model(model.inputs, [embedding, model.output])
+        self.grad_model = None
+        if self.last_conv_layer_name:
+            conv = model.get_layer(self.last_conv_layer_name).output
+            outputs = [conv, embedding, model.output] if embedding is not None else [conv, model.output]
+            self.grad_model = tf.keras.models.Model(model.inputs, outputs)
+
+        # A batch-polymorphic signature traces each function once for every
+        # batch size the micro-batcher produces
+        self.input_shape = tuple(model.input_shape[1:])
+        signature = [tf.TensorSpec((None,) + self.input_shape, tf.float32)]
+        self._predict_fn = tf.function(self._predict, input_signature=signature)
+        self._fused_fn = tf.function(self._predict_and_explain, input_signature=signature)
+
+    def warmup(self, default_size=224):
+        """
+        Trace the inference graphs with a dummy batch before taking traffic.
+        """
+        shape = tuple(default_size if dim is None else dim for dim in self.input_shape)
+        images = np.zeros((1,) + shape, dtype=np.float32)
+        self.predict(images)
+        if self.grad_model is not None:
+            self.predict_and_explain(images)
+
+    def _predict(self, images):
+        if self._embed_model is None:
+            return self.model(images, training=False), None
+        embeddings, predictions = self._embed_model(images, training=False)
+        return predictions, embeddings
+
+    def _predict_and_explain(self, images):
+        with tf.GradientTape() as tape:
+            outputs = self.grad_model(images, training=False)
+            conv_outputs, predictions = outputs[0], outputs[-1]
+            top_scores = tf.math.top_k(predictions, k=self.explain_classes).values
+
+        if self.explain_classes == 1:
+            # Images in a batch are independent, so the gradient of the summed
+            # top scores gives each image the gradient of its own top class.
+            grads = tape.gradient(top_scores, conv_outputs)[:, tf.newaxis]
+        else:
+            # (N, k, h, w, c): the k scores of each image against its own
+            # activations, vectorised over classes rather than k tapes
+            grads = tape.batch_jacobian(top_scores, conv_outputs)
+        weights = tf.reduce_mean(grads, axis=(2, 3))
+        heatmaps = tf.einsum('bhwc,bkc->bkhw', conv_outputs, weights)
+        heatmaps = tf.nn.relu(heatmaps)
+        heatmaps /= tf.reduce_max(heatmaps, axis=(2, 3), keepdims=True) + 1e-10
+        if self.explain_classes == 1:
+            heatmaps = heatmaps[:, 0]
+        embeddings = outputs[1] if len(outputs) == 3 else None
+        return predictions, heatmaps, embeddings
+
+    def predict(self, images, embed=False):
+        """
+        Class scores for a preprocessed batch (shape: (N, H, W, 3)).
+
+        With `embed`, returns (predictions, embeddings); embeddings is None
+        when the model has no flat penultimate layer.
+        """
+        predictions, embeddings = self._predict_fn(tf.convert_to_tensor(images, tf.float32))
+        if not embed:
+            return predictions.numpy()
+        return predictions.numpy(), _numpy(embeddings)
+
+    def explain(self, images):
+        """
+        Grad-CAM heatmaps of the top class (or top `explain_classes`) for a
+        preprocessed batch, or None when the model has no conv layer to explain.
+        """
+        return self.predict_and_explain(images)[1]
+
+    def predict_and_explain(self, images, embed=False):
+        """
+        Class scores and top-class (or top `explain_classes`) Grad-CAM
+        heatmaps for a preprocessed batch.
+
+        Returns (predictions, heatmaps), plus embeddings with `embed`;
+        heatmaps is None when the model has no conv layer to explain.
+        """
+        if self.grad_model is None:
+            if embed:
+                predictions, embeddings = self.predict(images, embed=True)
+                return predictions, None, embeddings
+            return self.predict(images), None
+
+        predictions, heatmaps, embeddings = self._fused_fn(tf.convert_to_tensor(images, tf.float32))
+        if embed:
+            return predictions.numpy(), heatmaps.numpy(), _numpy(embeddings)
+        return predictions.numpy(), heatmaps.numpy()
+
+
+def _numpy(tensor):
+    return None if tensor is None else tensor.numpy()
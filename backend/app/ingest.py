@@ -0,0 +1,674 @@
+"""
+Ingestion of high-bit-depth and very large images.
+
+Radiographs arrive as 12/16-bit grayscale (DICOM, 16-bit PNG, TIFF) and can
+run to hundreds of megabytes, which `cv2.imdecode(..., IMREAD_COLOR)` would
+either squash to 8 bits or decode whole. Here uncompressed pixel data
+(native DICOM, stripped TIFF) is read in bands of rows straight from the
+file, area-averaged down as it goes and only then windowed to 8 bits, so
+neither the full-resolution pixels nor a float copy of them is ever held.
+Compressed high-bit-depth files have to be decoded whole; they are decoded
+in their own dtype and refused past `max_decode_bytes`.
+
+Everything else (8-bit JPEG, PNG, WebP...) is decoded by OpenCV: JPEGs
+at reduced resolution where the caller's edge limits allow, and anything
+whose header says it would decode past `max_decode_bytes` is refused.
+Very large images can also be scored tile by tile (`tile_boxes`,
+`stitch_heatmaps`) so findings smaller than the model input survive.
+"""
+import math
+import os
+import struct
+
+import cv2
+import numpy as np
+
+from .preprocess import HEADER_BYTES, REDUCED_FLAGS, jpeg_size
+
+DICOM_MAGIC_OFFSET = 128
+
+# Transfer syntaxes whose pixel data is stored as plain little-endian arrays
+IMPLICIT_LITTLE = '1.2.840.10008.1.2'
+EXPLICIT_LITTLE = '1.2.840.10008.1.2.1'
+
+# Explicit-VR value representations with a 4-byte length
+LONG_VRS = frozenset((b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'))
+
+ITEM_END = (0xFFFE, 0xE00D)
+SEQUENCE_END = (0xFFFE, 0xE0DD)
+UNDEFINED_LENGTH = 0xFFFFFFFF
+
+# Image pixel module attributes read from a DICOM header
+DICOM_TAGS = {
+    (0x0002, 0x0010): 'transfer_syntax',
+    (0x0028, 0x0002): 'samples',
+    (0x0028, 0x0004): 'photometric',
+    (0x0028, 0x0006): 'planar',
+    (0x0028, 0x0010): 'rows',
+    (0x0028, 0x0011): 'columns',
+    (0x0028, 0x0100): 'bits_allocated',
+    (0x0028, 0x0101): 'bits_stored',
+    (0x0028, 0x0103): 'signed',
+    (0x0028, 0x1050): 'window_center',
+    (0x0028, 0x1051): 'window_width',
+    (0x0028, 0x1052): 'intercept',
+    (0x0028, 0x1053): 'slope',
+}
+PIXEL_DATA = (0x7FE0, 0x0010)
+
+# TIFF tags: ImageWidth, ImageLength, BitsPerSample, Compression,
+# PhotometricInterpretation, StripOffsets, SamplesPerPixel, RowsPerStrip,
+# StripByteCounts, PlanarConfiguration, TileWidth, SampleFormat
+TIFF_TAGS = {256: 'width', 257: 'height', 258: 'bits', 259: 'compression', 262: 'photometric',
+             273: 'strip_offsets', 277: 'samples', 278: 'rows_per_strip', 279: 'strip_counts',
+             284: 'planar', 322: 'tile_width', 339: 'sample_format'}
+# TIFF field type -> struct code
+TIFF_TYPES = {1: 'B', 3: 'H', 4: 'I', 8: 'h', 9: 'i', 16: 'Q'}
+
+
+class IngestError(ValueError):
+    """
+    An image that was recognised but can't be ingested within the limits.
+    """
+
+
+class ImageTooLarge(IngestError):
+    """
+    An image that would need more memory to decode than the limits allow.
+    """
+
+
+class IngestLimits:
+    """
+    Memory bounds for ingesting one image.
+
+    `band_bytes` caps the rows read (and their float32 copy) at a time;
+    `max_decode_bytes` caps compressed images that must be decoded whole;
+    `window_percent` clips that much of each tail when a file carries no
+    window of its own.
+    """
+
+    def __init__(self, band_bytes=32 * 1024 * 1024, max_decode_bytes=512 * 1024 * 1024, window_percent=0.5):
+        self.band_bytes = band_bytes
+        self.max_decode_bytes = max_decode_bytes
+        self.window_percent = window_percent
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['INGEST_BAND_BYTES'], config['INGEST_MAX_DECODE_BYTES'], config['INGEST_WINDOW_PERCENT'])
+
+
+class RawPixels:
+    """
+    Uncompressed pixel rows in a file, as contiguous strips of rows.
+
+    `strips` lists the file offset of each strip of `rows_per_strip` rows.
+    Rows are read with readinto into one reused band buffer.
+    """
+
+    def __init__(self, path, height, width, samples, dtype, strips, rows_per_strip):
+        self.path = path
+        self.shape = (height, width, samples)
+        self.dtype = np.dtype(dtype)
+        self.strips = strips
+        self.rows_per_strip = rows_per_strip
+        self.row_bytes = width * samples * self.dtype.itemsize
+
+    def bands(self, band_rows):
+        """
+        Yield (first_row, rows) in bands of at most `band_rows` rows; each
+        band reuses the previous one's buffer.
+        """
+        height = self.shape[0]
+        buffer = np.empty((min(band_rows, height),) + self.shape[1:], self.dtype)
+        with open(self.path, 'rb', buffering=0) as f:
+            for start in range(0, height, band_rows):
+                stop = min(start + band_rows, height)
+                view = memoryview(buffer[:stop - start]).cast('B')
+                row = start
+                while row < stop:
+                    strip, offset = divmod(row, self.rows_per_strip)
+                    count = min(stop - row, self.rows_per_strip - offset)
+                    f.seek(self.strips[strip] + offset * self.row_bytes)
+                    begin = (row - start) * self.row_bytes
+                    end = begin + count * self.row_bytes
+                    if f.readinto(view[begin:end]) != end - begin:
+                        raise IngestError("Pixel data is truncated")
+                    row += count
+                yield start, buffer[:stop - start]
+
+
+class ArrayPixels:
+    """
+    Pixels already decoded into memory, served in the same bands as RawPixels.
+    """
+
+    def __init__(self, array):
+        if array.ndim == 2:
+            array = array[:, :, np.newaxis]
+        self.array = array
+        self.shape = array.shape
+        self.dtype = array.dtype
+
+    def bands(self, band_rows):
+        for start in range(0, self.shape[0], band_rows):
+            yield start, self.array[start:start + band_rows]
+
+
+class Image:
+    """
+    A recognised image: its pixel source plus how to display it.
+
+    `rescale` is (slope, intercept) to modality values, `window` an explicit
+    (center, width) or None for percentiles, `invert` is set for
+    MONOCHROME1 and `bits` is the significant bits per sample.
+    """
+
+    def __init__(self, pixels, bits=None, signed=False, rescale=(1.0, 0.0), window=None, invert=False, rgb=False):
+        self.pixels = pixels
+        self.bits = bits or pixels.dtype.itemsize * 8
+        self.signed = signed
+        self.rescale = rescale
+        self.window = window
+        self.invert = invert
+        self.rgb = rgb
+
+    @property
+    def shape(self):
+        return self.pixels.shape
+
+
+def is_dicom(head):
+    return head[DICOM_MAGIC_OFFSET:DICOM_MAGIC_OFFSET + 4] == b'DICM'
+
+
+def _png_bit_depth(head):
+    if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR':
+        return head[24]
+    return None
+
+
+def open_image(path, limits):
+    """
+    Recognise a file this module ingests, or None to leave it to the
+    ordinary 8-bit decoder. Raises IngestError for files it can't read.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(HEADER_BYTES)
+    if is_dicom(head):
+        return _open_dicom(path, limits)
+    if head[:4] in (b'II*\x00', b'MM\x00*'):
+        return _open_tiff(path, limits)
+    if _png_bit_depth(head) == 16:
+        width, height = struct.unpack_from('>II', head, 16)
+        channels = {0: 1, 2: 3, 4: 2, 6: 4}.get(head[25], 4)
+        _check_decode(height * width * channels * 2, limits)
+        return _decoded(cv2.imread(path, cv2.IMREAD_UNCHANGED))
+    return None
+
+
+def _check_decode(size, limits):
+    if size > limits.max_decode_bytes:
+        raise ImageTooLarge(f"Compressed image needs {size >> 20} MiB to decode, over the "
+                          f"{limits.max_decode_bytes >> 20} MiB limit; upload it uncompressed")
+
+
+def _decoded(array):
+    """
+    Image for a cv2-decoded array (BGR or BGRA channel order).
+    """
+    if array is None:
+        return None
+    if array.ndim == 3 and array.shape[2] == 4:
+        array = array[:, :, :3]
+    elif array.ndim == 3 and array.shape[2] == 2:
+        # Gray + alpha
+        array = array[:, :, 0]
+    return Image(ArrayPixels(array))
+
+
+def _read_tiff_fields(path):
+    """
+    The TIFF_TAGS fields of a TIFF file's first image, plus its byte `order`.
+    """
+    with open(path, 'rb') as f:
+        order = '<' if f.read(2) == b'II' else '>'
+        f.seek(4)
+        ifd, = struct.unpack(order + 'I', f.read(4))
+        f.seek(ifd)
+        count, = struct.unpack(order + 'H', f.read(2))
+        entries = f.read(count * 12)
+        fields = {'order': order}
+        for i in range(count):
+            tag, kind, n = struct.unpack_from(order + 'HHI', entries, i * 12)
+            if tag not in TIFF_TAGS or kind not in TIFF_TYPES:
+                continue
+            size = struct.calcsize(TIFF_TYPES[kind]) * n
+            if size <= 4:
+                raw = entries[i * 12 + 8:i * 12 + 8 + size]
+            else:
+                f.seek(struct.unpack_from(order + 'I', entries, i * 12 + 8)[0])
+                raw = f.read(size)
+            fields[TIFF_TAGS[tag]] = struct.unpack(f'{order}{n}{TIFF_TYPES[kind]}', raw)
+    return fields
+
+
+def _open_tiff(path, limits):
+    try:
+        fields = _read_tiff_fields(path)
+        height, width = fields['height'][0], fields['width'][0]
+    except (struct.error, KeyError) as e:
+        raise IngestError(f"Unreadable TIFF header: {e}")
+    samples = fields.get('samples', (1,))[0]
+    bits = fields.get('bits', (1,))[0]
+    raw = (fields.get('compression', (1,))[0] == 1 and 'tile_width' not in fields and 'strip_offsets' in fields
+           and fields.get('planar', (1,))[0] == 1 and samples in (1, 3) and bits in (8, 16, 32))
+    if not raw:
+        # Compressed or tiled: only OpenCV can read it, and only whole
+        _check_decode(height * width * samples * max(1, bits // 8), limits)
+        return _decoded(cv2.imread(path, cv2.IMREAD_UNCHANGED))
+
+    kind = {1: 'u', 2: 'i', 3: 'f'}.get(fields.get('sample_format', (1,))[0], 'u')
+    rows_per_strip = min(fields.get('rows_per_strip', (height,))[0], height)
+    pixels = RawPixels(path, height, width, samples, f"{fields['order']}{kind}{bits // 8}",
+                       fields['strip_offsets'], rows_per_strip)
+    return Image(pixels, invert=fields.get('photometric', (1,))[0] == 0, rgb=samples == 3)
+
+
+def _read_element(f, explicit):
+    """
+    Next (tag, vr, length) of a little-endian data set, or None at the end.
+    """
+    header = f.read(8)
+    if len(header) < 8:
+        return None
+    group, element = struct.unpack_from('<HH', header)
+    if group == 0xFFFE or not explicit:
+        # Item and delimiter tags never carry a VR
+        return (group, element), None, struct.unpack_from('<I', header, 4)[0]
+    vr = header[4:6]
+    if vr in LONG_VRS:
+        return (group, element), vr, struct.unpack('<I', f.read(4))[0]
+    return (group, element), vr, struct.unpack_from('<H', header, 6)[0]
+
+
+def _skip_undefined(f, explicit):
+    """
+    Skip the rest of an undefined-length sequence or item.
+    """
+    while True:
+        element = _read_element(f, explicit)
+        if element is None or element[0] in (SEQUENCE_END, ITEM_END):
+            return
+        if element[2] == UNDEFINED_LENGTH:
+            _skip_undefined(f, explicit)
+        else:
+            f.seek(element[2], os.SEEK_CUR)
+
+
+def _dicom_number(value, vr, kind):
+    """
+    First value of a numeric DICOM attribute (US binary or DS/IS text).
+    """
+    if vr == b'US' or (vr is None and kind == 'us'):
+        return struct.unpack_from('<H', value)[0]
+    text = value.decode('ascii', 'replace').strip('\x00 ').split('\\')[0].strip()
+    return float(text) if text else None
+
+
+def read_dicom_header(path):
+    """
+    The image pixel attributes of a DICOM file and where its pixel data
+    starts: a dict of DICOM_TAGS names plus `pixel_offset` and `pixel_length`.
+    """
+    header = {}
+    with open(path, 'rb') as f:
+        f.seek(DICOM_MAGIC_OFFSET + 4)
+        # File meta information is always explicit VR little endian
+        explicit, meta = True, True
+        while True:
+            position = f.tell()
+            element = _read_element(f, explicit)
+            if element is None:
+                break
+            tag, vr, length = element
+            if meta and tag[0] != 0x0002:
+                meta = False
+                syntax = header.setdefault('transfer_syntax', EXPLICIT_LITTLE)
+                if syntax not in (IMPLICIT_LITTLE, EXPLICIT_LITTLE):
+                    # Compressed, deflated or big endian: left to pydicom
+                    break
+                if syntax == IMPLICIT_LITTLE:
+                    f.seek(position)
+                    explicit = False
+                    continue
+            if tag == PIXEL_DATA:
+                header['pixel_offset'] = f.tell()
+                header['pixel_length'] = length
+                break
+            if length == UNDEFINED_LENGTH:
+                _skip_undefined(f, explicit)
+                continue
+            name = DICOM_TAGS.get(tag)
+            if name is None:
+                f.seek(length, os.SEEK_CUR)
+                continue
+            value = f.read(length)
+            if name in ('transfer_syntax', 'photometric'):
+                header[name] = value.decode('ascii', 'replace').strip('\x00 ')
+            else:
+                kind = 'ds' if name in ('window_center', 'window_width', 'intercept', 'slope') else 'us'
+                header[name] = _dicom_number(value, vr, kind)
+    return header
+
+
+def _open_dicom(path, limits):
+    try:
+        header = read_dicom_header(path)
+    except (struct.error, ValueError) as e:
+        raise IngestError(f"Unreadable DICOM header: {e}")
+    if header.get('pixel_length', UNDEFINED_LENGTH) == UNDEFINED_LENGTH:
+        # Compressed (JPEG, JPEG 2000, RLE...) pixel data needs a codec
+        return _open_dicom_codec(path, header, limits)
+    samples = int(header.get('samples') or 1)
+    bits_allocated = int(header.get('bits_allocated') or 16)
+    if bits_allocated not in (8, 16, 32) or (samples > 1 and header.get('planar')):
+        return _open_dicom_codec(path, header, limits)
+    signed = bool(header.get('signed'))
+    dtype = f"<{'i' if signed else 'u'}{bits_allocated // 8}"
+    rows = int(header['rows'])
+    # Only the first frame of a multi-frame file is read
+    pixels = RawPixels(path, rows, int(header['columns']), samples, dtype, (header['pixel_offset'],), rows)
+    return Image(pixels, **_dicom_display(header, bits_allocated))
+
+
+def _dicom_display(header, bits_allocated):
+    window = None
+    if header.get('window_center') is not None and header.get('window_width'):
+        window = (header['window_center'], header['window_width'])
+    slope = header.get('slope')
+    intercept = header.get('intercept')
+    photometric = header.get('photometric', 'MONOCHROME2')
+    return dict(bits=int(header.get('bits_stored') or bits_allocated), signed=bool(header.get('signed')),
+                rescale=(1.0 if slope is None else slope, intercept or 0.0), window=window,
+                invert=photometric == 'MONOCHROME1', rgb=photometric == 'RGB')
+
+
+def _open_dicom_codec(path, header, limits):
+    try:
+        import pydicom
+    except ImportError:
+        raise IngestError(f"DICOM transfer syntax {header.get('transfer_syntax')} needs pydicom "
+                          "(and its pixel codecs) to read")
+    # Large values are read on access, so the size check precedes the decode
+    dataset = pydicom.dcmread(path, defer_size='1 MB')
+    samples = int(dataset.get('SamplesPerPixel', 1))
+    bits_allocated = int(dataset.get('BitsAllocated', 16))
+    _check_decode(int(dataset.Rows) * int(dataset.Columns) * samples * max(1, bits_allocated // 8), limits)
+    array = dataset.pixel_array
+    if array.ndim == (4 if samples > 1 else 3):
+        array = array[0]
+    header = {
+        **header,
+        'window_center': _first(dataset.get('WindowCenter')),
+        'window_width': _first(dataset.get('WindowWidth')),
+        'slope': _first(dataset.get('RescaleSlope')),
+        'intercept': _first(dataset.get('RescaleIntercept')),
+        'bits_stored': dataset.get('BitsStored'),
+        'signed': dataset.get('PixelRepresentation', 0),
+        'photometric': str(dataset.get('PhotometricInterpretation', 'MONOCHROME2')),
+    }
+    display = _dicom_display(header, bits_allocated)
+    if display['rgb'] or samples > 1:
+        # pydicom returns RGB, converting YBR to it
+        array, display['rgb'] = array[:, :, ::-1], False
+    return Image(ArrayPixels(np.ascontiguousarray(array)), **display)
+
+
+def _first(value):
+    if value is None:
+        return None
+    try:
+        return float(value[0])
+    except TypeError:
+        return float(value)
+
+
+def downsample_factor(shape, min_edge=None, max_edge=None):
+    """
+    Integer area-averaging factor for a (height, width) image: the largest
+    that keeps the short edge at least `min_edge`, raised until the long
+    edge fits `max_edge`.
+    """
+    height, width = shape[:2]
+    factor = max(1, min(height, width) // min_edge) if min_edge else 1
+    if max_edge:
+        factor = max(factor, math.ceil(max(height, width) / max_edge))
+    return factor
+
+
+def downsample(image, factor, limits):
+    """
+    Area-average the pixels by `factor` into a float32 (h, w, samples)
+    array of modality values, a band of rows at a time.
+    """
+    height, width, samples = image.shape
+    out_height, out_width = max(1, height // factor), max(1, width // factor)
+    out = np.empty((out_height, out_width, samples), np.float32)
+    factor_rows, factor_cols = min(factor, height), min(factor, width)
+    row_floats = width * samples * 4
+    band_rows = max(1, limits.band_bytes // (row_floats + width * samples * image.pixels.dtype.itemsize))
+    band_rows = max(factor_rows, band_rows // factor_rows * factor_rows)
+
+    stored_mask = None
+    if image.bits < image.pixels.dtype.itemsize * 8:
+        stored_mask = image.bits
+    for start, band in image.pixels.bands(band_rows):
+        first = start // factor_rows
+        count = min(len(band) // factor_rows, out_height - first)
+        if count <= 0:
+            continue
+        band = band[:count * factor_rows, :out_width * factor_cols]
+        if stored_mask is not None:
+            band = _stored_bits(band, stored_mask, image.signed)
+        values = band.astype(np.float32)
+        out[first:first + count] = values.reshape(
+            count, factor_rows, out_width, factor_cols, samples
+        ).mean(axis=(1, 3))
+    slope, intercept = image.rescale
+    if slope != 1 or intercept:
+        out *= np.float32(slope)
+        out += np.float32(intercept)
+    return out
+
+
+def _stored_bits(band, bits, signed):
+    """
+    Drop bits above BitsStored (overlays, padding), sign-extending signed data.
+    """
+    unused = band.dtype.itemsize * 8 - bits
+    if signed:
+        return (band << unused) >> unused
+    return band & band.dtype.type((1 << bits) - 1)
+
+
+def window_uint8(values, image, limits):
+    """
+    Window float modality values to uint8 BGR.
+
+    Uses the file's window when it has one, the full range for 8-bit
+    data, and otherwise clips `window_percent` of each tail.
+    """
+    if image.window is not None:
+        center, width = image.window
+        low, high = center - width / 2, center + width / 2
+    elif image.bits <= 8 and image.rescale == (1.0, 0.0):
+        low, high = 0.0, 255.0
+    else:
+        low, high = np.percentile(values, (limits.window_percent, 100 - limits.window_percent))
+    scale = np.float32(255.0 / max(high - low, 1e-6))
+    values -= np.float32(low)
+    values *= scale
+    np.clip(values, 0, 255, out=values)
+    pixels = values.astype(np.uint8)
+    if image.invert:
+        np.subtract(255, pixels, out=pixels)
+    if pixels.shape[2] == 1:
+        return cv2.cvtColor(pixels, cv2.COLOR_GRAY2BGR)
+    if image.rgb:
+        return np.ascontiguousarray(pixels[:, :, ::-1])
+    return pixels
+
+
+def read(path, limits, min_edge=None, max_edge=None):
+    """
+    Read an image file as uint8 BGR, reduced so its short edge stays at
+    least `min_edge` and its long edge fits `max_edge`.
+
+    High-bit-depth and very large files are ingested band by band; the rest
+    are decoded by OpenCV (JPEGs at reduced resolution, see _decode_flag)
+    once their header shows the decode fits `limits`. Returns (image, (height, width)
+    of the file, or of its reduced JPEG decode), or (None, None) when the
+    file is not an image; raises IngestError when it can't be read within
+    `limits`.
+    """
+    image = open_image(path, limits)
+    if image is None:
+        size = image_size(path)
+        flag, factor = cv2.IMREAD_COLOR, 1
+        if size is not None:
+            with open(path, 'rb') as f:
+                flag, factor = _decode_flag(f.read(4), size, min_edge, max_edge)
+            # An 8-bit BGR decode has no band-by-band path; bound it up front
+            _check_decode(-(-size[0] // factor) * -(-size[1] // factor) * 3, limits)
+        img = cv2.imread(path, flag)
+        if img is None:
+            return None, None
+        size = img.shape[:2]
+        if max_edge and max(size) > max_edge:
+            scale = max_edge / max(size)
+            img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return img, size
+    factor = downsample_factor(image.shape, min_edge, max_edge)
+    return window_uint8(downsample(image, factor, limits), image, limits), image.shape[:2]
+
+
+def _decode_flag(head, size, min_edge=None, max_edge=None):
+    """
+    (cv2.imread flag, scale factor) for an 8-bit file of (height, width)
+    `size`: the coarsest reduced JPEG decode that leaves the short edge at
+    least `min_edge` and the long edge at least `max_edge`. Other formats
+    (and calls without either limit) are decoded at full size.
+    """
+    if head.startswith(b'\xff\xd8\xff') and (min_edge or max_edge):
+        for factor, flag in REDUCED_FLAGS:
+            if min(size) // factor >= (min_edge or 0) and max(size) // factor >= (max_edge or 0):
+                return flag, factor
+    return cv2.IMREAD_COLOR, 1
+
+
+def load(path, limits, min_edge=None, max_edge=None):
+    """
+    Like `read`, for the image alone.
+    """
+    return read(path, limits, min_edge, max_edge)[0]
+
+
+def image_size(path):
+    """
+    (height, width) from an image file's header, or None when the format
+    (or a damaged header) doesn't say without decoding.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(HEADER_BYTES)
+    try:
+        if is_dicom(head):
+            header = read_dicom_header(path)
+            return (int(header['rows']), int(header['columns'])) if 'rows' in header else None
+        if head[:4] in (b'II*\x00', b'MM\x00*'):
+            fields = _read_tiff_fields(path)
+            return fields['height'][0], fields['width'][0]
+    except (struct.error, KeyError, ValueError):
+        return None
+    if _png_bit_depth(head) is not None:
+        width, height = struct.unpack_from('>II', head, 16)
+        return height, width
+    if head.startswith(b'\xff\xd8\xff'):
+        size = jpeg_size(head)
+        return (size[1], size[0]) if size else None
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return _webp_size(head)
+    if head[:2] == b'BM' and len(head) >= 26:
+        width, height = struct.unpack_from('<ii', head, 18)
+        return abs(height), width
+    return None
+
+
+def _webp_size(head):
+    chunk = head[12:16]
+    if chunk == b'VP8X' and len(head) >= 30:
+        width = int.from_bytes(head[24:27], 'little') + 1
+        height = int.from_bytes(head[27:30], 'little') + 1
+    elif chunk == b'VP8 ' and len(head) >= 30:
+        width, height = (value & 0x3FFF for value in struct.unpack_from('<HH', head, 26))
+    elif chunk == b'VP8L' and len(head) >= 25:
+        bits, = struct.unpack_from('<I', head, 21)
+        width, height = (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    else:
+        return None
+    return height, width
+
+
+def tile_boxes(shape, tile, overlap):
+    """
+    (top, left, bottom, right) tiles of `tile` pixels covering a (height,
+    width) image, overlapping by at least `overlap`; edge tiles are shifted
+    inwards rather than padded.
+    """
+    def starts(length):
+        if length <= tile:
+            return [0]
+        step = max(1, tile - overlap)
+        count = math.ceil((length - tile) / step) + 1
+        return [min(i * step, length - tile) for i in range(count)]
+
+    height, width = shape[:2]
+    return [(top, left, min(top + tile, height), min(left + tile, width))
+            for top in starts(height) for left in starts(width)]
+
+
+def stitch_heatmaps(shape, boxes, heatmaps, weights=None):
+    """
+    Blend per-tile heatmaps into one heatmap of a (height, width) image.
+
+    The canvas keeps the tiles' heatmap resolution. Overlaps are feathered
+    so seams don't show, and `weights` (one per tile, e.g. the tile's score
+    for the predicted class) keep weak tiles from looking as hot as the
+    strongest. Returns a float32 map in [0, 1], or None without heatmaps.
+    """
+    tiles = [(box, heatmap, 1.0 if weights is None else weights[i])
+             for i, (box, heatmap) in enumerate(zip(boxes, heatmaps)) if heatmap is not None]
+    if not tiles:
+        return None
+    box, heatmap, _ = tiles[0]
+    scale = heatmap.shape[0] / max(1, box[2] - box[0])
+    canvas = np.zeros((max(1, round(shape[0] * scale)), max(1, round(shape[1] * scale))), np.float32)
+    total = np.zeros_like(canvas)
+    for (top, left, bottom, right), heatmap, weight in tiles:
+        y0, x0 = round(top * scale), round(left * scale)
+        y1 = min(canvas.shape[0], max(y0 + 1, round(bottom * scale)))
+        x1 = min(canvas.shape[1], max(x0 + 1, round(right * scale)))
+        resized = cv2.resize(np.asarray(heatmap, np.float32), (x1 - x0, y1 - y0), interpolation=cv2.INTER_LINEAR)
+        feather = np.outer(_ramp(y1 - y0), _ramp(x1 - x0))
+        canvas[y0:y1, x0:x1] += resized * feather * np.float32(weight)
+        total[y0:y1, x0:x1] += feather
+    canvas /= np.maximum(total, 1e-6)
+    peak = canvas.max()
+    if peak > 0:
+        canvas /= peak
+    return canvas
+
+
+def _ramp(length):
+    # Tent window, highest mid-tile and never zero at the edges
+    return (1.0 - np.abs(np.linspace(-1, 1, length, dtype=np.float32)) * 0.9) if length > 1 else np.ones(1, np.float32)
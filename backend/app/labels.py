@@ -0,0 +1,147 @@
+"""
+Class labels and severity scoring, without TensorFlow or network access.
+
+A LabelMap is built once per model load from the bundled ImageNet class
+index, or from a class index shipped next to a custom model. Top-k and
+severity are computed for whole batches with numpy.
+"""
+import json
+import logging
+import os
+
+import numpy as np
+
+BUNDLED_CLASS_INDEX = os.path.join(os.path.dirname(__file__), 'data', 'imagenet_class_index.json')
+
+SEVERITIES = np.array(['normal', 'mild', 'moderate', 'severe'])
+# Confidence (%) upper bounds for normal, mild and moderate
+SEVERITY_THRESHOLDS = np.array([20.0, 50.0, 80.0])
+# Classes whose name contains one of these are always reported as normal
+NORMAL_KEYWORDS = ('normal', 'monitor')
+
+logger = logging.getLogger(__name__)
+
+
+def class_index_candidates(model_path):
+    """
+    Class index files looked for next to a model, most specific first:
+    `<model>.labels.json`, then `class_index.json` in the same folder.
+    """
+    if not model_path:
+        return []
+    stem = os.path.splitext(model_path)[0]
+    return [stem + '.labels.json', os.path.join(os.path.dirname(model_path), 'class_index.json')]
+
+
+class LabelMap:
+    """
+    Per-class synset ids, names and fixed severities, indexed by class id.
+
+    `fixed_severity[i]` is the severity class i always gets, or '' when it
+    is graded by confidence. Classes without an explicit entry are fixed
+    at normal when their name matches NORMAL_KEYWORDS.
+    """
+
+    def __init__(self, synsets, names, fixed_severity=None, source=None):
+        self.synsets = np.asarray(synsets, dtype=object)
+        self.names = np.asarray(names, dtype=object)
+        fixed_severity = fixed_severity or [None] * len(names)
+        self.fixed_severity = np.asarray([
+            severity if severity is not None else
+            'normal' if any(keyword in name.lower() for keyword in NORMAL_KEYWORDS) else ''
+            for name, severity in zip(names, fixed_severity)
+        ], dtype=object)
+        self.source = source
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def from_class_index(cls, path):
+        """
+        Read a class index: Keras' `{"0": ["n01440764", "tench"], ...}`, a
+        list of names, or `{"0": {"name": ..., "synset": ..., "severity": ...}}`
+        where `severity` optionally pins a class to one severity.
+        """
+        with open(path) as f:
+            data = json.load(f)
+        if isinstance(data, list):
+            entries = [[f"class_{i}", name] for i, name in enumerate(data)]
+        else:
+            entries = [data[str(i)] for i in range(len(data))]
+
+        synsets, names, fixed = [], [], []
+        for i, entry in enumerate(entries):
+            if isinstance(entry, dict):
+                name = entry['name']
+                synsets.append(entry.get('synset', f"class_{i}"))
+                severity = entry.get('severity')
+                if severity is not None and severity not in SEVERITIES:
+                    raise ValueError(f"{path}: unknown severity {severity!r} for class {i}")
+            else:
+                synsets.append(entry[0])
+                name = entry[1]
+                severity = None
+            names.append(name)
+            fixed.append(severity)
+        return cls(synsets, names, fixed, source=path)
+
+    @classmethod
+    def placeholder(cls, num_classes):
+        return cls([f"class_{i}" for i in range(num_classes)], [f"class_{i}" for i in range(num_classes)],
+                   source='placeholder')
+
+    @classmethod
+    def for_model(cls, model_path, num_classes=None, class_index=None):
+        """
+        Labels for a model: `class_index` when given, else its own class
+        index if one sits next to it, else the bundled ImageNet index, else
+        numbered placeholders when the model's class count doesn't match.
+        """
+        candidates = [class_index] if class_index else []
+        for path in candidates + class_index_candidates(model_path) + [BUNDLED_CLASS_INDEX]:
+            if not os.path.exists(path):
+                continue
+            labels = cls.from_class_index(path)
+            if num_classes is None or len(labels) == num_classes:
+                return labels
+            logger.warning("Ignoring class index with the wrong class count",
+                           extra={"path": path, "classes": len(labels), "model_classes": num_classes})
+        return cls.placeholder(num_classes or 0)
+
+    def top_k(self, predictions, k=3):
+        """
+        (indices, scores) of the k best classes per row, best first.
+        """
+        predictions = np.atleast_2d(np.asarray(predictions))
+        k = min(k, predictions.shape[1])
+        # O(n) selection of the top k, then sort only those k
+        candidates = np.argpartition(predictions, -k, axis=1)[:, -k:]
+        candidate_scores = np.take_along_axis(predictions, candidates, axis=1)
+        order = np.argsort(-candidate_scores, axis=1)
+        return np.take_along_axis(candidates, order, axis=1), np.take_along_axis(candidate_scores, order, axis=1)
+
+    def severity(self, class_ids, confidences):
+        """
+        Severity per prediction: the class's fixed severity if it has one,
+        otherwise graded from confidence (in %).
+        """
+        graded = SEVERITIES[np.searchsorted(SEVERITY_THRESHOLDS, np.asarray(confidences), side='left')]
+        fixed = self.fixed_severity[np.asarray(class_ids)]
+        return np.where(fixed != '', fixed, graded)
+
+    def interpret(self, predictions, k=3):
+        """
+        Interpret a batch of class score vectors.
+
+        Returns one (decoded_preds, class_name, confidence, severity) per
+        row, where decoded_preds lists (synset, name, score) best first.
+        """
+        indices, scores = self.top_k(predictions, k)
+        confidences = scores[:, 0].astype(np.float64) * 100
+        severities = self.severity(indices[:, 0], confidences)
+        results = []
+        for row_indices, row_scores, confidence, severity in zip(indices, scores, confidences, severities):
+            decoded = [(self.synsets[i], self.names[i], float(score)) for i, score in zip(row_indices, row_scores)]
+            results.append((decoded, decoded[0][1], float(confidence), str(severity)))
+        return results
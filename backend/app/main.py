@@ -1,158 +1,1323 @@
-from flask import Blueprint, request, jsonify, current_app, send_from_directory
+from flask import Blueprint, Response, abort, g, request, jsonify, current_app, send_file, stream_with_context
 from flask_jwt_extended import jwt_required, get_jwt_identity
+from concurrent.futures import ThreadPoolExecutor
+import atexit
+import base64
+import functools
+import json
+import logging
 import os
-import uuid
-import cv2
+import queue
+import threading
+import time
+import zipfile
+from datetime import datetime
+from urllib.parse import urlencode
 import numpy as np
-import tensorflow as tf
+from sqlalchemy import tuple_
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
 from .models import Prediction
 from .extensions import db
-from .utils import generate_gradcam, overlay_heatmap, load_model_safe
+from .backends import backend_identity, batch_runner, load_backend
+from .batching import MicroBatcher
+from .cache import PredictionCache
+from .embeddings import EmbeddingIndexes
+from .gradcam_jobs import GradcamJobs
+from . import serving
+from .heatmaps import MAX_SIZE as MAX_OVERLAY_SIZE
+from .heatmaps import OverlayCache, OverlayParams, decode_heatmap, encode_heatmap, heatmap_count, render_overlay
+from .preprocess import PreprocessStats, StageTimer, TensorPool, normalize, resize_normalize
+from . import ingest
+from . import tta
+from .storage import ContentStore, is_content_name
+from .persistence import WriteBehindPersister
+from .labels import LabelMap
+from .admission import AdmissionController, DeadlineExceeded, Overloaded, request_deadline
+from .registry import ModelRegistry, ModelSpec, ModelVersion, UnknownModel, available_specs, default_spec
+from . import metrics
 
 main = Blueprint('main', __name__)
+logger = logging.getLogger(__name__)
 
-# Global variables for model
-model = None
-last_conv_layer_name = None
+# Model versions are served from the registry; each request leases the
+# version it runs on. Grad-CAM workers are shared by every version.
+registry = None
+admission = None
+gradcam_jobs = None
+prediction_cache = None
+overlay_cache = None
+upload_store = None
+persister = None
+ingest_limits = None
+# Views scored when test-time augmentation is on (see tta.TTAConfig)
+tta_config = None
+# Per-version embedding indexes for similar-case search (None when disabled)
+embedding_indexes = None
+preprocess_stats = PreprocessStats()
+
+# Model loading runs in the background (or on first use) so workers serve
+# auth traffic without waiting for TensorFlow: idle -> loading -> ready/failed
+model_state = "idle"
+model_timings = {}
+_model_lock = threading.Lock()
+
+# Decode/preprocess workers for bulk uploads (cv2 releases the GIL)
+preprocess_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix='preprocess')
+
+@atexit.register
+def _flush_on_exit():
+    if persister is not None:
+        persister.close()
+
+@metrics.REGISTRY.collector
+def _collect_model_state():
+    metrics.set_model_state(model_state, model_timings)
+    if admission is not None:
+        metrics.ADMISSION_WAITING.set(admission.depth())
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp', '.dcm'}
+ZIP_MIMETYPES = {'application/zip', 'application/x-zip-compressed'}
+
+# Uploads and rendered overlays never change under their URL
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
 
 def init_model(app):
-    global model, last_conv_layer_name
-    model, last_conv_layer_name = load_model_safe(app.config['MODEL_PATH'])
+    """
+    Set up caches and start loading the model according to MODEL_LOADING.
+
+    `eager` loads before returning, `background` loads on a daemon thread
+    and `lazy` waits for the first prediction or readiness probe. Workers
+    started by serve.py skip loading and use the shared inference process.
+    """
+    global prediction_cache, overlay_cache, upload_store, persister, model_state, admission, registry
+    global embedding_indexes, ingest_limits, tta_config
+    if registry is not None:
+        registry.close()
+    if persister is not None:
+        persister.close()
+    persister = WriteBehindPersister(
+        app, app.config['PERSIST_SPOOL_FOLDER'],
+        batch_size=app.config['PERSIST_BATCH_SIZE'],
+        interval_ms=app.config['PERSIST_INTERVAL_MS'],
+        id_block=app.config['PERSIST_ID_BLOCK'],
+        fsync=app.config['PERSIST_SPOOL_FSYNC'],
+        write_behind=app.config['PERSIST_WRITE_BEHIND'],
+        max_retries=app.config['PERSIST_MAX_RETRIES']
+    )
+    overlay_cache = OverlayCache(app.config['GRADCAM_VARIANT_FOLDER'], app.config['GRADCAM_VARIANT_CACHE_BYTES'])
+    upload_store = ContentStore(app.config['UPLOAD_FOLDER'])
+    ingest_limits = ingest.IngestLimits.from_config(app.config)
+    tta_config = tta.TTAConfig.from_config(app.config)
+    if embedding_indexes is not None:
+        embedding_indexes.close()
+    embedding_indexes = None
+    if app.config['EMBEDDINGS_ENABLED']:
+        embedding_indexes = EmbeddingIndexes(
+            app.config['EMBEDDING_FOLDER'],
+            ivf_min_size=app.config['EMBEDDING_IVF_MIN_SIZE'],
+            probes=app.config['EMBEDDING_IVF_PROBES'],
+            update_every=app.config['EMBEDDING_IVF_UPDATE_EVERY']
+        )
+    admission = AdmissionController(
+        app.config['ADMISSION_MAX_CONCURRENT'], app.config['ADMISSION_MAX_QUEUE'],
+        degrade_depth=app.config['DEGRADE_QUEUE_DEPTH']
+    )
+    if prediction_cache is None or prediction_cache.index_path != app.config['PREDICTION_CACHE_PATH']:
+        prediction_cache = PredictionCache(app.config['PREDICTION_CACHE_PATH'], app.config['PREDICTION_CACHE_SIZE'])
+    registry = ModelRegistry(app.config, functools.partial(_build_version, app),
+                             keep=app.config['MODEL_REGISTRY_KEEP'], on_activate=_on_activate)
+    _start_gradcam_jobs(app)
+
+    model_state = "idle"
+    model_timings.clear()
+    model_timings["init_started"] = time.monotonic()
+    if serving.client is not None:
+        # The inference process serves one version; deploying another
+        # means restarting serve.py
+        spec = serving.served_model or default_spec(app.config)
+        registry.activate(_build_version(app, spec, remote=serving.client))
+        model_state = "ready"
+        return
+
+    mode = app.config['MODEL_LOADING']
+    if mode == 'eager':
+        _load_model(app)
+    elif mode == 'background':
+        _ensure_model_loading(app)
+
+def _ensure_model_loading(app, wait=False):
+    """
+    Start loading the model unless it is already loading or loaded.
+    """
+    global model_state
+    with _model_lock:
+        if model_state in ("idle", "failed"):
+            model_state = "loading"
+            if not wait:
+                threading.Thread(target=_load_model, args=(app,), name='model-loader', daemon=True).start()
+                return
+        else:
+            return
+    _load_model(app)
+
+def _load_model(app):
+    """
+    Load the registry's models, then keep watching it for new versions.
+    """
+    global model_state
+    model_state = "loading"
+    started = time.monotonic()
+    try:
+        registry.refresh()
+        entry = registry.active()
+        if entry is None:
+            model_state = "failed"
+            return
+        model_timings.update(entry.timings)
+        model_state = "ready"
+        model_timings["ready_seconds"] = time.monotonic() - model_timings.get("init_started", started)
+        registry.watch(app.config['MODEL_REGISTRY_POLL_SECONDS'])
+    except Exception:
+        logger.exception("Error loading model", extra={"model_path": app.config['MODEL_PATH']})
+        model_state = "failed"
+
+def _model_label(spec, backend):
+    """
+    Short model name for metric labels: the model version and backend.
+    """
+    return f"{spec.key}/{backend}"
+
+def _on_activate(entry):
+    # Cached results and stage metrics follow the default model
+    if entry.spec.name == registry.default_name:
+        prediction_cache.set_model(entry.identity)
+        metrics.set_model(entry.label)
+
+def _model_unavailable():
+    """
+    Error response for prediction requests while no model is serving.
+    """
+    if model_state == "idle" and current_app.config['MODEL_LOADING'] == 'lazy':
+        _ensure_model_loading(current_app._get_current_object(), wait=True)
+        if registry.active() is not None:
+            return None
+    if model_state == "loading":
+        return {"error": "Model loading"}, 503, {"Retry-After": "5"}
+    return {"error": "Model not loaded"}, 500
+
+def _build_version(app, spec, new_engine=None, remote=None):
+    """
+    Load and warm a model version (unless given its engine) and start the
+    batchers around it.
+
+    With `remote` (a serving.InferenceClient) batching happens in the shared
+    inference process instead of a local engine. Returns None when the
+    model can't be loaded.
+    """
+    config = app.config
+    timings = {}
+    if new_engine is None and remote is None:
+        started = time.monotonic()
+        new_engine = load_backend(config, spec.path, spec.last_conv_layer, spec.input_size)
+        if new_engine is None:
+            return None
+        timings["load_seconds"] = time.monotonic() - started
+        if config['MODEL_WARMUP']:
+            warmup_started = time.monotonic()
+            new_engine.warmup(spec.input_size)
+            timings["warmup_seconds"] = time.monotonic() - warmup_started
+
+    num_classes = new_engine.model.output_shape[-1] if new_engine is not None else None
+    backend = getattr(new_engine, 'name', None) or config['INFERENCE_BACKEND']
+    entry = ModelVersion(
+        spec, new_engine,
+        labels=LabelMap.for_model(spec.path, num_classes, spec.class_index),
+        tensor_pool=TensorPool(spec.input_size),
+        identity=f"{spec.key}|{backend_identity(config, spec.path)}",
+        label=_model_label(spec, backend),
+        timings=timings
+    )
+
+    batch_size = config['INFERENCE_BATCH_SIZE']
+    timeout_ms = config['INFERENCE_BATCH_TIMEOUT_MS']
+    max_queue = config['INFERENCE_MAX_QUEUE']
+
+    def batcher_for(op):
+        if remote is not None:
+            return remote.batcher(op)
+        return MicroBatcher(batch_runner(new_engine, op), max_batch_size=batch_size, max_wait_ms=timeout_ms, max_queue=max_queue)
+
+    if config['GRADCAM_ASYNC']:
+        # Classification only on the request path; heatmaps are rendered by
+        # the Grad-CAM workers through their own batcher
+        entry.batcher = batcher_for('predict')
+        entry.explain_batcher = batcher_for('explain')
+    else:
+        entry.batcher = batcher_for('predict_and_explain')
+        # Classification-only batcher for degraded mode
+        if config['DEGRADE_QUEUE_DEPTH']:
+            entry.predict_batcher = batcher_for('predict')
+    return entry
+
+def _start_gradcam_jobs(app):
+    """
+    (Re)start the Grad-CAM workers, after pending renders have finished.
+    """
+    global gradcam_jobs
+    if gradcam_jobs is not None:
+        gradcam_jobs.close()
+    gradcam_jobs = None
+    if app.config['GRADCAM_ASYNC']:
+        gradcam_jobs = GradcamJobs(app, _render_gradcam, max_workers=app.config['GRADCAM_WORKERS'],
+                                   store=persister.update)
+
+def _start_inference(app, new_engine, remote=None, spec=None):
+    """
+    Serve an already loaded engine as the active version of MODEL_NAME
+    (MODEL_PATH unless `spec` says otherwise); None unloads every version
+    once pending Grad-CAM renders are done.
+    """
+    if new_engine is None and remote is None:
+        _start_gradcam_jobs(app)
+        registry.close()
+        return None
+    entry = _build_version(app, spec or ModelSpec.legacy(app.config), new_engine, remote)
+    registry.activate(entry)
+    return entry
+
+def _render_gradcam(payload):
+    """
+    GradcamJobs render: explain one image on the version that scored it.
+    """
+    entry, img_resized, gradcam_name = payload
+    try:
+        tensor = entry.tensor_pool.acquire()
+        started = time.perf_counter()
+        try:
+            image = normalize(img_resized, tensor, entry.spec.preprocessing)
+            heatmap, = entry.explain_batcher.submit(image).result()
+        finally:
+            entry.tensor_pool.release(tensor)
+        metrics.record_stages({'gradcam': time.perf_counter() - started}, model=entry.label)
+        return _gradcam_fields(heatmap, gradcam_name)
+    finally:
+        entry.release()
 
 @main.route("/")
 def home():
     return {"status": "Backend Running", "api_version": "v2"}
 
+@main.route("/api/ready")
+def ready():
+    """
+    Readiness probe: 200 once the model is loaded (and warmed up), 503 before.
+
+    Liveness stays at `/`. In lazy mode the first probe starts loading.
+    """
+    if model_state == "idle" and current_app.config['MODEL_LOADING'] == 'lazy':
+        _ensure_model_loading(current_app._get_current_object())
+    timings = {name: value for name, value in model_timings.items() if name.endswith('_seconds')}
+    entry = registry.active()
+    status = 200 if entry else 503
+    return {"ready": bool(entry), "model_state": model_state, "model": entry and entry.key, "timings": timings}, status
+
 @main.route("/static/gradcam/<path:filename>")
 def serve_gradcam(filename):
-    return send_from_directory(current_app.config['GRADCAM_FOLDER'], filename)
+    """
+    Serve a Grad-CAM overlay, rendering it from the stored heatmap.
+
+    Query parameters pick the variant: `size` (pixels on the longest edge,
+    or `original` for the upload resolution), `colormap`, `intensity`,
+    `format` (jpeg/webp/png) and `class` (rank in the differential, for
+    per-class heatmaps). Rendered variants go to a bounded disk cache.
+    Overlays rendered to disk before heatmaps were stored are served as-is.
+
+    A variant's bytes are fixed by its heatmap and parameters, so the
+    variant cache key doubles as a strong ETag and responses are immutable.
+    """
+    def find_row():
+        return Prediction.query.filter(
+            Prediction.gradcam_path == filename, Prediction.heatmap.isnot(None)
+        ).order_by(Prediction.id.desc()).first()
+
+    row = find_row()
+    if row is None and persister.stats()["queued"]:
+        # The heatmap may still be queued on the write-behind persister
+        persister.sync()
+        row = find_row()
+    if row is None:
+        path = safe_join(current_app.config['GRADCAM_FOLDER'], filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        return _send_immutable(path)
+
+    try:
+        params = OverlayParams.from_args(request.args, filename)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    if params.class_index >= heatmap_count(row.heatmap):
+        abort(404)
+
+    key = params.cache_key(row.heatmap, row.image_path)
+    if key in request.if_none_match:
+        # Revalidation never needs the rendered file
+        return _not_modified(key)
+    path = overlay_cache.get(key, params.fmt)
+    if path is None:
+        upload_path = upload_store.resolve(row.image_path)
+        try:
+            # Windowed to 8 bits and reduced to what an overlay can show
+            base_image = ingest.load(upload_path, ingest_limits, max_edge=MAX_OVERLAY_SIZE) if upload_path else None
+        except ingest.IngestError:
+            base_image = None
+        if base_image is None:
+            abort(404)
+        timer = StageTimer()
+        data = render_overlay(decode_heatmap(row.heatmap, params.class_index), base_image, params)
+        timer.mark('overlay')
+        path = overlay_cache.put(key, params.fmt, data)
+        timer.mark('overlay_store')
+        metrics.record_stages(timer.timings)
+    return _send_immutable(path, mimetype=params.mimetype, etag=key)
 
 @main.route("/static/uploads/<path:filename>")
 def serve_uploads(filename):
-    return send_from_directory(current_app.config['UPLOAD_FOLDER'], filename)
+    """
+    Serve a stored upload. Content-addressed names are their own ETag.
+    """
+    path = upload_store.resolve(filename)
+    if path is None:
+        abort(404)
+    etag = os.path.splitext(filename)[0] if is_content_name(filename) else True
+    return _send_immutable(path, etag=etag)
+
+def _cache_immutable(response):
+    response.cache_control.public = True
+    response.cache_control.max_age = IMMUTABLE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+def _send_immutable(path, mimetype=None, etag=True):
+    """
+    send_file for content that never changes under its URL: conditional
+    requests get 304s and caches may keep the response for a year.
+    """
+    return _cache_immutable(send_file(path, mimetype=mimetype, etag=etag, conditional=True))
+
+def _not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return _cache_immutable(response)
+
+def _store_upload(upload):
+    """
+    Store an upload verbatim under its content hash, so re-uploads of the
+    same bytes share one file. `upload` is bytes or a file-like object,
+    which is streamed to disk in chunks. Returns (filename, digest, created).
+    """
+    if isinstance(upload, bytes):
+        return upload_store.save_bytes(upload)
+    return upload_store.save_stream(upload)
+
+def _read_upload(filename, created, min_edge=None, max_edge=None):
+    """
+    Read a stored upload as uint8 BGR (see ingest.read), removing a file
+    stored by this request again when it can't be read.
+    """
+    try:
+        img, size = ingest.read(upload_store.path_for(filename), ingest_limits, min_edge, max_edge)
+    except ingest.IngestError:
+        if created:
+            upload_store.discard(filename)
+        raise
+    if img is None and created:
+        upload_store.discard(filename)
+    return img, size
+
+def _preprocess_upload(filename, created, spec, out, timer):
+    """
+    Decode a stored upload and write its tensor for the model `spec` into `out`.
+
+    Returns (img_resized, tensor), or None when the file is not a decodable
+    image; a file stored by this request is then removed again. Raises
+    ingest.IngestError for images that can't be read within the limits.
+    """
+    timer.restart()
+    input_size = spec.input_size
+    img, _ = _read_upload(filename, created, min_edge=input_size)
+    timer.mark('decode')
+    if img is None:
+        return None
+
+    img_resized, tensor = resize_normalize(img, input_size, out, preprocessing=spec.preprocessing)
+    timer.mark('resize_normalize')
+    preprocess_stats.record(timer.timings)
+    return img_resized, tensor
+
+def _upload_tiles(filename, created, config, timer):
+    """
+    Read an upload for tiled inference: (working image, tile boxes) when its
+    header puts its long edge at INGEST_TILE_MIN_EDGE or more, else None to
+    score it whole.
+    """
+    timer.restart()
+    size = ingest.image_size(upload_store.path_for(filename))
+    if size is None or max(size) < config['INGEST_TILE_MIN_EDGE']:
+        return None
+    img, _ = _read_upload(filename, created, max_edge=config['INGEST_TILE_MAX_EDGE'])
+    timer.mark('decode')
+    if img is None:
+        raise ingest.IngestError("Invalid image format")
+    return img, ingest.tile_boxes(img.shape, config['INGEST_TILE_SIZE'], config['INGEST_TILE_OVERLAP'])
+
+def _predict_tiles(entry, img, boxes, degraded, timer):
+    """
+    Score a large image tile by tile on model version `entry`.
+
+    Tiles are batched like separate uploads. Their scores are pooled by
+    INGEST_TILE_POOLING and, unless degraded, their Grad-CAM heatmaps are
+    stitched into one for the whole image, weighted by each tile's score
+    for the pooled top class. With per-class heatmaps each of the pooled
+    top classes is stitched from the tiles that explained it, as far as
+    every class has one. Returns (scores, heatmap, embedding).
+    """
+    spec = entry.spec
+    timer.restart()
+    tensors = [entry.tensor_pool.acquire() for _ in boxes]
+    for (top, left, bottom, right), tensor in zip(boxes, tensors):
+        resize_normalize(img[top:bottom, left:right], spec.input_size, tensor, preprocessing=spec.preprocessing)
+    timer.mark('resize_normalize')
+
+    model_batcher = entry.predict_batcher if degraded and entry.predict_batcher else entry.batcher
+    scored = [model_batcher.submit(tensor, g.deadline) for tensor in tensors]
+    explained = None
+    if entry.explain_batcher is not None and not degraded:
+        explained = [entry.explain_batcher.submit(tensor, g.deadline) for tensor in tensors]
+    results = [future.result() for future in scored]
+    heatmaps = [future.result()[0] for future in explained] if explained else [result[1] for result in results]
+    timer.mark('inference')
+    # Only returned once every tile has been copied into its batch; after a
+    # failure they are left to the garbage collector instead
+    for tensor in tensors:
+        entry.tensor_pool.release(tensor)
+
+    scores = np.stack([np.asarray(result[0], np.float32) for result in results])
+    if current_app.config['INGEST_TILE_POOLING'] == 'max':
+        pooled = scores.max(axis=0)
+        pooled /= pooled.sum()
+    else:
+        pooled = scores.mean(axis=0)
+    heatmap = None
+    if not degraded:
+        heatmap = _stitch_class_heatmaps(img.shape, boxes, heatmaps, scores, pooled)
+    embeddings = [result[2] for result in results]
+    embedding = None
+    if all(item is not None for item in embeddings):
+        embedding = np.mean(np.asarray(embeddings, np.float32), axis=0)
+    timer.mark('stitch')
+    return pooled, heatmap, embedding
+
+def _stitch_class_heatmaps(shape, boxes, heatmaps, scores, pooled):
+    """
+    Stitch tile heatmaps for the pooled top classes, best first.
+
+    Tile heatmaps are (h, w) for their top class or (k, h, w) for their k
+    best classes; a tile contributes to a pooled class only if it explained
+    that class. Returns (h, w), (k', h, w) or None.
+    """
+    present = [heatmap for heatmap in heatmaps if heatmap is not None]
+    if not present:
+        return None
+    if np.ndim(present[0]) == 2:
+        return ingest.stitch_heatmaps(shape, boxes, heatmaps, scores[:, int(pooled.argmax())])
+
+    k = len(present[0])
+    tile_classes = np.argsort(-scores, axis=1)[:, :k]
+    stitched = []
+    for class_index in np.argsort(-pooled)[:k]:
+        class_heatmaps = []
+        for heatmap, ranked in zip(heatmaps, tile_classes):
+            rank = np.flatnonzero(ranked == class_index)
+            class_heatmaps.append(heatmap[rank[0]] if heatmap is not None and rank.size else None)
+        class_heatmap = ingest.stitch_heatmaps(shape, boxes, class_heatmaps, scores[:, class_index])
+        if class_heatmap is None:
+            break
+        stitched.append(class_heatmap)
+    return np.stack(stitched) if stitched else None
+
+def _tta_requested():
+    """
+    Whether this request averages augmented views: its `tta` argument
+    (true/false) or TTA_ENABLED when absent.
+    """
+    value = (request.args.get('tta') or request.form.get('tta') or '').lower()
+    if not value:
+        return current_app.config['TTA_ENABLED']
+    if value not in ('1', 'true', 'yes', '0', 'false', 'no'):
+        raise ValueError("tta must be true or false")
+    return value in ('1', 'true', 'yes')
+
+def _predict_views(entry, tensor, timer):
+    """
+    Test-time augmentation on model version `entry`: score a preprocessed
+    tensor together with its augmented views (tta_config) in one batch.
+
+    The tensor and its views are submitted as one group to the version's
+    batcher, so every view is scored in the same forward pass by the same
+    model; only the unaugmented view is explained, and it supplies the
+    heatmap and embedding. Returns (mean scores, heatmap, embedding,
+    uncertainty).
+    """
+    transforms = tta_config.transforms()
+    views = np.empty((len(transforms),) + tensor.shape, np.float32)
+    views[0] = tensor
+    tta.augment(tensor, transforms[1:], out=views[1:])
+    timer.mark('augment')
+    predictions, heatmaps, embeddings = entry.batcher.submit_many(views, g.deadline, explain=1).result()
+    scores, uncertainty = tta.aggregate(predictions)
+    heatmap = None if heatmaps is None else heatmaps[0]
+    embedding = None if embeddings is None else embeddings[0]
+    return scores, heatmap, embedding, uncertainty
+
+def _interpret(labels, prediction):
+    """
+    Turn a class score vector into (decoded_preds, class_name, confidence, severity).
+    """
+    return labels.interpret(prediction, k=3)[0]
+
+def _gradcam_fields(heatmap, filename):
+    """
+    Prediction fields for a computed heatmap.
+
+    Only the raw float16 heatmap is stored; `gradcam_path` names the overlay
+    that serve_gradcam renders from it on demand.
+    """
+    if heatmap is None:
+        return {}
+    return {"gradcam_path": f"gradcam_{filename}", "heatmap": encode_heatmap(heatmap)}
+
+def _build_prediction(entry, filename, prediction, heatmap, user_id, gradcam_name=None):
+    """
+    Interpret the output of model version `entry` and build an unsaved
+    Prediction row.
+
+    Returns (row, differential).
+    """
+    decoded_preds, class_name, confidence, severity = _interpret(entry.labels, prediction)
+
+    row = Prediction(
+        image_path=filename,
+        predicted_class=class_name.replace('_', ' ').title(),
+        confidence=confidence,
+        severity=severity,
+        user_id=user_id,
+        model_version=entry.key,
+        **_gradcam_fields(heatmap, gradcam_name or filename)
+    )
+
+    # Format differential diagnoses
+    differential = []
+    for pred in decoded_preds:
+        differential.append({
+            "condition": pred[1].replace('_', ' ').title(),
+            "confidence": float(pred[2]) * 100,
+            "severity": "unknown"
+        })
+    return row, differential
+
+def _index_embedding(entry, row, embedding):
+    """
+    Add a queued row's embedding to the similar-case index of the model
+    version that scored it.
+    """
+    if embedding_indexes is None or embedding is None:
+        return
+    try:
+        embedding_indexes.add(entry.key, [row.id], [row.user_id], embedding)
+    except (OSError, ValueError):
+        logger.exception("Could not index embedding", extra={"prediction_id": row.id})
+
+def _embedding_blob(embedding):
+    return None if embedding is None else np.asarray(embedding, np.float16).tobytes()
+
+def _class_gradcam_urls(gradcam_url, classes):
+    """
+    Overlay URLs of a prediction's per-class heatmaps, in differential order.
+    """
+    return [gradcam_url] + [f"{gradcam_url}?class={index}" for index in range(1, classes)]
+
+def _prediction_response(row, differential, gradcam_job=None, degraded=False):
+    gradcam_url = None
+    if row.gradcam_path:
+        gradcam_url = f"{request.host_url}static/gradcam/{row.gradcam_path}"
+        if row.heatmap:
+            # Differential entries beyond the explained classes get no overlay
+            urls = _class_gradcam_urls(gradcam_url, heatmap_count(row.heatmap))
+            differential = [
+                dict(item, gradcam_image=urls[index] if index < len(urls) else None)
+                for index, item in enumerate(differential)
+            ]
+    response = {
+        "id": row.id,
+        "predicted_class": row.predicted_class,
+        "confidence": row.confidence,
+        "severity": row.severity,
+        "gradcam_image": gradcam_url,
+        "differential": differential,
+        "model_version": row.model_version
+    }
+    if gradcam_job is not None:
+        response["gradcam_job"] = gradcam_job
+        response["gradcam_status"] = f"{request.host_url}api/gradcam/{gradcam_job}"
+    if row.tta_views:
+        response["tta_views"] = row.tta_views
+        response["uncertainty"] = row.uncertainty
+    if degraded:
+        # Grad-CAM (and test-time augmentation) was skipped to keep up with a burst
+        response["degraded"] = True
+    return response
+
+def _background_gradcam(entry):
+    """
+    True when heatmaps for this version are rendered by the Grad-CAM workers.
+    """
+    return gradcam_jobs is not None and entry.explain_batcher is not None
+
+def _schedule_gradcam(entry, row, img_resized, gradcam_name, key=None):
+    """
+    Queue background Grad-CAM rendering for a saved row; returns the job id.
+    The job holds its own lease on the model version until it has run.
+    """
+    def on_complete(fields):
+        if key is not None:
+            prediction_cache.update(
+                key, gradcam_path=fields["gradcam_path"], heatmap=_b64(fields["heatmap"]), gradcam_job=None
+            )
+
+    entry.acquire()
+    try:
+        return gradcam_jobs.submit(row.id, (entry, img_resized, gradcam_name), on_complete).id
+    except BaseException:
+        entry.release()
+        raise
+
+def _b64(blob):
+    return base64.b64encode(blob).decode('ascii') if blob else None
+
+def _unb64(text):
+    return base64.b64decode(text) if text else None
+
+def _cached_prediction(key):
+    """
+    Look up a cached result whose stored files still exist.
+    """
+    cached = prediction_cache.get(key)
+    if cached is None:
+        return None
+    if not upload_store.exists(cached["image_path"]):
+        prediction_cache.discard(key)
+        return None
+    return cached
+
+def _admitted(view):
+    """
+    Run a prediction view under admission control with a request deadline
+    (in `g.deadline`). The slot, and anything else the view adds to
+    `g.releases`, is released when the response is done; a streamed
+    response keeps them until it closes.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        config = current_app.config
+        g.deadline = request_deadline(request.headers, config['PREDICT_DEADLINE_MS'], config['PREDICT_MAX_DEADLINE_MS'])
+        ticket = admission.acquire(g.deadline)
+        releases = g.releases = [ticket.release]
+
+        def release_all():
+            for release in reversed(releases):
+                release()
+
+        try:
+            response = current_app.make_response(view(*args, **kwargs))
+        except BaseException:
+            release_all()
+            raise
+        if response.is_streamed:
+            response.call_on_close(release_all)
+        else:
+            release_all()
+        return response
+    return wrapper
+
+def _lease_model():
+    """
+    Lease the model version the request asks for (`model`: a name,
+    `name@version` or `@version`; the default model when absent) until the
+    response is done.
+
+    Returns (entry, None), or (None, error response).
+    """
+    selector = request.args.get('model') or request.form.get('model')
+    if not selector and registry.active() is None:
+        unavailable = _model_unavailable()
+        if unavailable:
+            return None, unavailable
+    try:
+        entry = registry.lease(selector)
+    except UnknownModel as e:
+        return None, ({"error": str(e), "models": sorted(registry.stats()["versions"])}, 404)
+    g.releases.append(entry.release)
+    return entry, None
+
+def _degraded(queued_batcher):
+    """
+    True when Grad-CAM should be skipped for this request to absorb a burst.
+    """
+    return admission.should_degrade(queued_batcher.queue_depth())
+
+@main.errorhandler(Overloaded)
+def overloaded(e):
+    reason = 'deadline' if isinstance(e, DeadlineExceeded) else 'overloaded'
+    metrics.SHED.inc(reason)
+    status = 503 if reason == 'deadline' else current_app.config['ADMISSION_REJECT_STATUS']
+    return jsonify({"error": str(e)}), status, {"Retry-After": str(e.retry_after)}
 
 @main.route("/api/predict", methods=["POST"])
 @jwt_required(optional=True) 
+@_admitted
 def predict():
-    global model, last_conv_layer_name
-    if not model:
-        return {"error": "Model not loaded"}, 500
+    entry, unavailable = _lease_model()
+    if unavailable:
+        return unavailable
 
     if "image" not in request.files:
         return {"error": "No image uploaded"}, 400
+    try:
+        use_tta = _tta_requested()
+    except ValueError as e:
+        return {"error": str(e)}, 400
 
     try:
         img_file = request.files["image"]
-        
-        # Save original file
-        filename = str(uuid.uuid4()) + ".jpg" # Ensure jpg extension
-        upload_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-        
-        # Read image
-        img_bytes = img_file.read()
-        nparr = np.frombuffer(img_bytes, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        if img is None:
-             return {"error": "Invalid image format"}, 400
-
-        cv2.imwrite(upload_path, img)
-
-        # Preprocess for model (MobileNetV2 standard)
-        img_resized = cv2.resize(img, (224, 224))
-        img_preprocessed = tf.keras.applications.mobilenet_v2.preprocess_input(img_resized.astype(np.float32))
-        img_expanded = np.expand_dims(img_preprocessed, axis=0)
-
-        # Predict
-        prediction = model.predict(img_expanded)[0]
-        
-        # Get top prediction for ImageNet
-        decoded_preds = tf.keras.applications.mobilenet_v2.decode_predictions(np.array([prediction]), top=3)[0]
-        top_pred = decoded_preds[0] # (class_id, class_name, score)
-        
-        class_name = top_pred[1]
-        confidence = float(top_pred[2]) * 100
-
-        # Severity Logic
-        severity = "normal"
-        if confidence > 80: severity = "severe"
-        elif confidence > 50: severity = "moderate"
-        elif confidence > 20: severity = "mild"
-        
-        if "normal" in class_name.lower() or "monitor" in class_name.lower():
-            severity = "normal"
-
-        # Generate GradCAM
-        gradcam_url = None
-        gradcam_filename = None
-        try:
-            heatmap = generate_gradcam(model, img_expanded, last_conv_layer_name)
-            if heatmap is not None:
-                overlay_img = overlay_heatmap(heatmap, img_resized)
-                gradcam_filename = f"gradcam_{filename}"
-                gradcam_path = os.path.join(current_app.config['GRADCAM_FOLDER'], gradcam_filename)
-                cv2.imwrite(gradcam_path, overlay_img)
-                # Construct URL
-                gradcam_url = f"{request.host_url}static/gradcam/{gradcam_filename}"
-        except Exception as e:
-            print(f"GradCAM generation failed: {e}")
-
-        # Save to DB
-        current_user_id = get_jwt_identity()
-        new_prediction = Prediction(
-            image_path=filename,
-            predicted_class=class_name.replace('_', ' ').title(),
-            confidence=confidence,
-            severity=severity,
-            gradcam_path=gradcam_filename,
-            user_id=current_user_id
+        timer = StageTimer()
+        filename, digest, created = _store_upload(img_file.stream)
+        timer.mark('store')
+
+        # Re-uploads of the same bytes scored by the same model version are
+        # served from the content-addressed cache
+        key = prediction_cache.key_for(digest, f"{entry.identity}|{tta_config.identity}" if use_tta else entry.identity)
+        use_cache = current_app.config['PREDICTION_CACHE_ENABLED']
+        cached = _cached_prediction(key) if use_cache else None
+        timer.mark('cache_lookup')
+        if cached is not None:
+            new_prediction = Prediction(
+                image_path=cached["image_path"],
+                predicted_class=cached["predicted_class"],
+                confidence=cached["confidence"],
+                severity=cached["severity"],
+                gradcam_path=cached["gradcam_path"],
+                heatmap=_unb64(cached.get("heatmap")),
+                tta_views=cached.get("tta_views"),
+                uncertainty=cached.get("uncertainty"),
+                user_id=get_jwt_identity(),
+                model_version=entry.key
+            )
+            persister.add(new_prediction)
+            embedding = _unb64(cached.get("embedding"))
+            _index_embedding(entry, new_prediction, np.frombuffer(embedding, np.float16) if embedding else None)
+            timer.mark('persist')
+
+            # Share a render still in flight for the same upload
+            gradcam_job = None
+            if cached.get("gradcam_job") and gradcam_jobs and gradcam_jobs.follow(cached["gradcam_job"], new_prediction.id):
+                gradcam_job = new_prediction.id
+            response = _prediction_response(new_prediction, cached["differential"], gradcam_job)
+            if use_tta and not new_prediction.tta_views:
+                response["tta_skipped"] = "tiled"
+            return _timed_json(response, timer, entry)
+
+        g.deadline.check()
+        degraded = _degraded(entry.batcher)
+        tta_views = uncertainty = None
+        tiles = _upload_tiles(filename, created, current_app.config, timer) if current_app.config['INGEST_TILED'] else None
+        if tiles is not None:
+            # Tiles are already pooled over; they aren't augmented as well
+            img_resized = None
+            prediction, heatmap, embedding = _predict_tiles(entry, *tiles, degraded, timer)
+        else:
+            tensor = entry.tensor_pool.acquire()
+            try:
+                decoded = _preprocess_upload(filename, created, entry.spec, tensor, timer)
+                if decoded is None:
+                     return {"error": "Invalid image format"}, 400
+                img_resized, _ = decoded
+
+                # Predict (and, unless Grad-CAM runs in the background, explain) in
+                # a single pass, batched together with concurrent requests. The
+                # batcher drops the image if the deadline passes while it waits.
+                timer.restart()
+                model_batcher = entry.predict_batcher if degraded and entry.predict_batcher else entry.batcher
+                if use_tta and not degraded:
+                    prediction, heatmap, embedding, uncertainty = _predict_views(entry, tensor, timer)
+                    tta_views = tta_config.views
+                else:
+                    prediction, heatmap, embedding = model_batcher.submit(tensor, g.deadline).result()
+                timer.mark('inference')
+            finally:
+                entry.tensor_pool.release(tensor)
+
+        gradcam_name = f"{key}.jpg"
+        new_prediction, differential = _build_prediction(
+            entry, filename, prediction, heatmap, get_jwt_identity(), gradcam_name=gradcam_name
         )
-        db.session.add(new_prediction)
-        db.session.commit()
-
-        # Format differential diagnoses
-        differential = []
-        for pred in decoded_preds:
-            differential.append({
-                "condition": pred[1].replace('_', ' ').title(),
-                "confidence": float(pred[2]) * 100,
-                "severity": "unknown"
+        new_prediction.tta_views, new_prediction.uncertainty = tta_views, uncertainty
+        timer.mark('interpret')
+
+        # Queue the insert; the id is reserved up front so the response
+        # doesn't wait on the commit
+        persister.add(new_prediction)
+        _index_embedding(entry, new_prediction, embedding)
+        timer.mark('persist')
+
+        # With background Grad-CAM the job id is the prediction id; record
+        # it before scheduling so cache hits can follow the render. Tiled
+        # heatmaps were already stitched inline.
+        gradcam_job = new_prediction.id if _background_gradcam(entry) and not degraded and tiles is None else None
+        # A degraded result has no Grad-CAM, so it isn't cached for re-uploads
+        if use_cache and not degraded:
+            prediction_cache.put(key, {
+                "image_path": new_prediction.image_path,
+                "gradcam_path": new_prediction.gradcam_path,
+                "heatmap": _b64(new_prediction.heatmap),
+                "embedding": _b64(_embedding_blob(embedding)),
+                "gradcam_job": gradcam_job,
+                "predicted_class": new_prediction.predicted_class,
+                "confidence": new_prediction.confidence,
+                "severity": new_prediction.severity,
+                "tta_views": tta_views,
+                "uncertainty": uncertainty,
+                "differential": differential
             })
+        if gradcam_job is not None:
+            _schedule_gradcam(entry, new_prediction, img_resized, gradcam_name, key)
+        timer.mark('cache_store')
 
-        return jsonify({
-            "id": new_prediction.id,
-            "predicted_class": new_prediction.predicted_class,
-            "confidence": new_prediction.confidence,
-            "severity": new_prediction.severity,
-            "gradcam_image": gradcam_url,
-            "differential": differential
-        })
+        response = _prediction_response(new_prediction, differential, gradcam_job, degraded)
+        if use_tta and tta_views is None:
+            # Requested (or on by default) but not applied to this upload
+            response["tta_skipped"] = "degraded" if degraded else "tiled"
+            logger.info("Test-time augmentation skipped",
+                        extra={"reason": response["tta_skipped"], "prediction_id": new_prediction.id})
+        return _timed_json(response, timer, entry)
 
+    except Overloaded:
+        raise
+    except ingest.ImageTooLarge as e:
+        return {"error": str(e)}, 413
+    except ingest.IngestError as e:
+        return {"error": str(e)}, 400
     except Exception as e:
-        print(f"Prediction Error: {e}")
+        logger.exception("Prediction failed")
+        metrics.ERRORS.inc('predict')
         return {"error": str(e)}, 500
 
-@main.route("/api/history", methods=["GET"])
+def _timed_json(payload, timer, entry=None):
+    """
+    jsonify the response and record the request's stage timings (labelled
+    with the model version `entry`).
+    """
+    response = jsonify(payload)
+    timer.mark('json')
+    metrics.record_stages(timer.timings, model=entry.label if entry else None)
+    return response
+
+def _collect_batch_uploads(max_files):
+    """
+    Store the images from a multipart list and/or zip archives.
+
+    Plain files are streamed to storage and zip members are stored one at
+    a time, so the study is never held in memory. Returns a list of
+    (name, (filename, digest, created), timer).
+    """
+    def store(upload):
+        timer = StageTimer()
+        stored = _store_upload(upload)
+        timer.mark('store')
+        return stored, timer
+
+    uploads = []
+    files = request.files.getlist("images") + request.files.getlist("image")
+    for f in files:
+        name = f.filename or "upload"
+        if name.lower().endswith(".zip") or f.mimetype in ZIP_MIMETYPES:
+            with zipfile.ZipFile(f.stream) as archive:
+                for info in archive.infolist():
+                    if info.is_dir() or os.path.splitext(info.filename)[1].lower() not in IMAGE_EXTENSIONS:
+                        continue
+                    if len(uploads) >= max_files:
+                        raise ValueError(f"Too many images (max {max_files})")
+                    uploads.append((info.filename, *store(archive.read(info))))
+        else:
+            if len(uploads) >= max_files:
+                raise ValueError(f"Too many images (max {max_files})")
+            uploads.append((name, *store(f.stream)))
+    return uploads
+
+@main.route("/api/predict/batch", methods=["POST"])
+@jwt_required(optional=True)
+@_admitted
+def predict_batch():
+    """
+    Score many images in one request.
+
+    Accepts images as a multipart list (`images`) and/or zip archives and
+    streams one JSON object per image as newline-delimited JSON, in
+    completion order. Each row gets its id as soon as it is scored and is
+    queued on the write-behind persister, which writes the study in bulk;
+    the final line maps each `index` to its row id, which also identifies
+    its background Grad-CAM job.
+    """
+    entry, unavailable = _lease_model()
+    if unavailable:
+        return unavailable
+
+    try:
+        uploads = _collect_batch_uploads(current_app.config['BATCH_MAX_FILES'])
+    except (ValueError, zipfile.BadZipFile) as e:
+        return {"error": str(e)}, 400
+    if not uploads:
+        return {"error": "No image uploaded"}, 400
+
+    user_id = get_jwt_identity()
+    tensor_pool = entry.tensor_pool
+    # Images still queued for the model when the deadline passes are dropped
+    deadline = g.deadline
+    results = queue.Queue()
+
+    def on_inferred(index, name, filename, img_resized, degraded, tensor, timer, future):
+        tensor_pool.release(tensor)
+        timer.mark('inference')
+        metrics.record_stages(timer.timings, model=entry.label)
+        try:
+            prediction, heatmap, embedding = future.result()
+            results.put((index, name, (filename, prediction, heatmap, embedding, img_resized, degraded), None))
+        except Exception as e:
+            results.put((index, name, None, str(e)))
+
+    def on_decoded(index, name, filename, tensor, timer, future):
+        try:
+            decoded = future.result()
+        except Exception as e:
+            tensor_pool.release(tensor)
+            results.put((index, name, None, str(e)))
+            return
+        if decoded is None:
+            tensor_pool.release(tensor)
+            results.put((index, name, None, "Invalid image format"))
+            return
+        img_resized, _ = decoded
+        try:
+            timer.restart()
+            degraded = _degraded(entry.batcher)
+            model_batcher = entry.predict_batcher if degraded and entry.predict_batcher else entry.batcher
+            inference = model_batcher.submit(tensor, deadline)
+        except Exception as e:
+            tensor_pool.release(tensor)
+            results.put((index, name, None, str(e)))
+            return
+        inference.add_done_callback(
+            lambda f: on_inferred(index, name, filename, img_resized, degraded, tensor, timer, f)
+        )
+
+    for index, (name, (filename, _, created), timer) in enumerate(uploads):
+        tensor = tensor_pool.acquire()
+        future = preprocess_pool.submit(_preprocess_upload, filename, created, entry.spec, tensor, timer)
+        future.add_done_callback(
+            lambda f, index=index, name=name, filename=filename, tensor=tensor, timer=timer:
+                on_decoded(index, name, filename, tensor, timer, f)
+        )
+
+    def generate():
+        rows = []
+        for _ in range(len(uploads)):
+            index, name, payload, error = results.get()
+            if error is not None:
+                yield json.dumps({"index": index, "filename": name, "error": error}) + "\n"
+                continue
+            try:
+                filename, prediction, heatmap, embedding, img_resized, degraded = payload
+                row, differential = _build_prediction(entry, filename, prediction, heatmap, user_id)
+                persister.add(row)
+                _index_embedding(entry, row, embedding)
+            except Exception as e:
+                logger.exception("Batch prediction failed", extra={"upload": name})
+                metrics.ERRORS.inc('predict_batch')
+                yield json.dumps({"index": index, "filename": name, "error": str(e)}) + "\n"
+                continue
+            rows.append((index, row))
+
+            # Background Grad-CAM jobs are keyed by the row id
+            gradcam_job = None
+            if _background_gradcam(entry) and row.gradcam_path is None and not degraded:
+                gradcam_job = _schedule_gradcam(entry, row, img_resized, row.image_path)
+            line = _prediction_response(row, differential, gradcam_job, degraded)
+            line.update({"index": index, "filename": name})
+            yield json.dumps(line) + "\n"
+
+        ids = {index: row.id for index, row in rows}
+        yield json.dumps({"done": True, "count": len(rows), "ids": ids}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+@main.route("/api/gradcam/<int:prediction_id>", methods=["GET"])
+@jwt_required(optional=True)
+def gradcam_status(prediction_id):
+    """
+    Status of the Grad-CAM render for a prediction.
+
+    Pass `?wait=<seconds>` (at most 30) to long-poll until the render
+    finishes.
+    """
+    pred = db.session.get(Prediction, prediction_id)
+    if pred is None:
+        # May still be queued on the write-behind persister
+        persister.sync()
+        pred = db.session.get(Prediction, prediction_id)
+    if pred is None or (pred.user_id is not None and str(pred.user_id) != str(get_jwt_identity())):
+        return {"error": "Prediction not found"}, 404
+
+    job = None
+    if gradcam_jobs is not None:
+        wait = min(request.args.get("wait", 0, type=float), 30.0)
+        job = gradcam_jobs.wait(prediction_id, wait) if wait > 0 else gradcam_jobs.get(prediction_id)
+
+    if job is not None:
+        status, gradcam_path, classes, error = job.status, job.gradcam_path, job.classes, job.error
+    elif pred.gradcam_path:
+        # Overlays rendered to disk before heatmaps were stored are top-class only
+        classes = heatmap_count(pred.heatmap) if pred.heatmap else 1
+        status, gradcam_path, error = "done", pred.gradcam_path, None
+    else:
+        status, gradcam_path, classes, error = "unavailable", None, 0, None
+
+    gradcam_url = None
+    class_urls = []
+    if status == "done" and gradcam_path:
+        gradcam_url = f"{request.host_url}static/gradcam/{gradcam_path}"
+        class_urls = _class_gradcam_urls(gradcam_url, classes)
+    return jsonify({
+        "id": prediction_id,
+        "status": status,
+        "gradcam_image": gradcam_url,
+        "gradcam_images": class_urls,
+        "error": error
+    })
+
+@main.route("/api/predictions/<int:prediction_id>/similar", methods=["GET"])
 @jwt_required()
-def history():
+def similar_predictions(prediction_id):
+    """
+    The user's past predictions that look most like this one: nearest by
+    cosine similarity of their embeddings, among those scored by the same
+    model version. `k` sets how many (default 10).
+    """
+    if embedding_indexes is None:
+        return {"error": "Similar-case search is disabled"}, 404
     current_user_id = get_jwt_identity()
-    predictions = Prediction.query.filter_by(user_id=current_user_id).order_by(Prediction.date_posted.desc()).all()
-    
-    results = []
-    for pred in predictions:
-        gradcam_url = None
-        if pred.gradcam_path:
-             gradcam_url = f"{request.host_url}static/gradcam/{pred.gradcam_path}"
-             
-        results.append({
-            "id": pred.id,
-            "predicted_class": pred.predicted_class,
-            "confidence": pred.confidence,
-            "severity": pred.severity,
-            "date": pred.date_posted.isoformat(),
-            "gradcam_image": gradcam_url,
-            "image_url": f"{request.host_url}static/uploads/{pred.image_path}"
+    pred = db.session.get(Prediction, prediction_id)
+    if pred is None:
+        # May still be queued on the write-behind persister
+        persister.sync()
+        pred = db.session.get(Prediction, prediction_id)
+    if pred is None or (pred.user_id is not None and str(pred.user_id) != str(current_user_id)):
+        return {"error": "Prediction not found"}, 404
+    k = request.args.get('k', 10, type=int)
+    if k < 1:
+        return {"error": "k must be positive"}, 400
+    k = min(k, current_app.config['SIMILAR_MAX_RESULTS'])
+
+    timer = StageTimer()
+    index = embedding_indexes.get(pred.model_version) if pred.model_version else None
+    matches = index.search(prediction_id, k, owner=current_user_id) if index is not None else None
+    timer.mark('similar_search')
+    if matches is None:
+        return {"error": "No embedding for this prediction"}, 404
+
+    # Matches may still be queued for writing
+    persister.sync()
+    rows = db.session.query(
+        Prediction.id, Prediction.predicted_class, Prediction.confidence, Prediction.severity,
+        Prediction.date_posted, Prediction.gradcam_path, Prediction.image_path
+    ).filter(Prediction.id.in_([match_id for match_id, _ in matches]),
+             Prediction.user_id == current_user_id).all()
+    by_id = {row.id: row for row in rows}
+    timer.mark('similar_rows')
+
+    host_url = request.host_url
+    similar = []
+    for match_id, similarity in matches:
+        row = by_id.get(match_id)
+        if row is None:
+            continue
+        similar.append({
+            "id": row.id,
+            "similarity": round(similarity, 4),
+            "predicted_class": row.predicted_class,
+            "confidence": row.confidence,
+            "severity": row.severity,
+            "date": row.date_posted.isoformat(),
+            "gradcam_image": f"{host_url}static/gradcam/{row.gradcam_path}" if row.gradcam_path else None,
+            "image_url": f"{host_url}static/uploads/{row.image_path}"
         })
-    
-    return jsonify(results)
+    return _timed_json({"id": prediction_id, "model_version": pred.model_version, "similar": similar}, timer)
+
+@main.route("/api/inference/stats", methods=["GET"])
+def inference_stats():
+    entry = registry.active()
+    if entry is None:
+        return {"error": "Model not loaded"}, 500
+    stats = {**entry.batcher.stats(), "preprocess": preprocess_stats.stats()}
+    if hasattr(entry.engine, 'stats'):
+        stats["backend"] = entry.engine.stats()
+    stats["admission"] = admission.stats()
+    stats["models"] = registry.stats()
+    if embedding_indexes is not None:
+        stats["embeddings"] = embedding_indexes.stats()
+    return jsonify(stats)
+
+@main.route("/api/models", methods=["GET"])
+def list_models():
+    """
+    Loaded model versions, which one each name routes to, and every
+    version in the registry folder.
+    """
+    stats = registry.stats()
+    stats["available"] = {name: [spec.version for spec in specs]
+                          for name, specs in available_specs(current_app.config).items()}
+    return jsonify(stats)
+
+@main.route("/api/models/reload", methods=["POST"])
+@jwt_required()
+def reload_models():
+    """
+    Rescan the registry now instead of at the next poll. New versions are
+    loaded and warmed in the background; 202 while that runs.
+    """
+    if serving.client is not None:
+        return {"error": "Restart serve.py to deploy a new model version"}, 409
+    if model_state != "ready":
+        _ensure_model_loading(current_app._get_current_object())
+    else:
+        threading.Thread(target=registry.refresh, name='model-registry-reload', daemon=True).start()
+    return {"status": "reloading", "active": registry.stats()["active"]}, 202
+
+@main.route("/api/cache/stats", methods=["GET"])
+def cache_stats():
+    return jsonify(prediction_cache.stats())
+
+def _encode_cursor(date_posted, prediction_id):
+    raw = f"{date_posted.isoformat()}|{prediction_id}".encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def _decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        date_text, prediction_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(date_text), int(prediction_id)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+
+def _parse_date(args, name):
+    value = args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an ISO 8601 date or datetime")
+
+def _history_page(user_id, args, config):
+    """
+    Query one page of a user's history for the request arguments `args`.
+
+    Returns (rows, next_cursor); raises ValueError for invalid arguments.
+    """
+    # Include this user's predictions still queued for writing
+    persister.sync()
+    limit = int(args.get('limit', config['HISTORY_PAGE_SIZE']))
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    limit = min(limit, config['HISTORY_MAX_PAGE_SIZE'])
+    cursor = args.get('cursor')
+    after = _decode_cursor(cursor) if cursor else None
+    date_from, date_to = _parse_date(args, 'from'), _parse_date(args, 'to')
+
+    # Plain column tuples: no ORM instances (or heatmap blobs) are loaded
+    query = db.session.query(
+        Prediction.id, Prediction.predicted_class, Prediction.confidence, Prediction.severity,
+        Prediction.date_posted, Prediction.gradcam_path, Prediction.image_path, Prediction.uncertainty
+    ).filter(Prediction.user_id == user_id)
+    if args.get('severity'):
+        query = query.filter(Prediction.severity == args['severity'])
+    if args.get('class'):
+        query = query.filter(Prediction.predicted_class == args['class'])
+    if date_from is not None:
+        query = query.filter(Prediction.date_posted >= date_from)
+    if date_to is not None:
+        query = query.filter(Prediction.date_posted < date_to)
+    if after is not None:
+        query = query.filter(tuple_(Prediction.date_posted, Prediction.id) < after)
+    rows = query.order_by(Prediction.date_posted.desc(), Prediction.id.desc()).limit(limit + 1).all()
+
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, _encode_cursor(rows[-1].date_posted, rows[-1].id)
+
+def _history_headers(next_cursor, args, base_url):
+    if next_cursor is None:
+        return {}
+    args = dict(args)
+    args['cursor'] = next_cursor
+    return {'X-Next-Cursor': next_cursor, 'Link': f'<{base_url}?{urlencode(args)}>; rel="next"'}
+
+def _history_item(row, host_url):
+    prediction_id, predicted_class, confidence, severity, date_posted, gradcam_path, image_path, uncertainty = row
+    return {
+        "id": prediction_id,
+        "predicted_class": predicted_class,
+        "confidence": confidence,
+        "severity": severity,
+        "uncertainty": uncertainty,
+        "date": date_posted.isoformat(),
+        "gradcam_image": f"{host_url}static/gradcam/{gradcam_path}" if gradcam_path else None,
+        "image_url": f"{host_url}static/uploads/{image_path}"
+    }
+
+@main.route("/api/history", methods=["GET"])
+@jwt_required()
+def history():
+    """
+    One page of the user's predictions, newest first.
+
+    Keyset-paginated on (date_posted, id): pass the `X-Next-Cursor` header
+    of a response as `cursor` for the next page (also given as a Link
+    header). `limit` sets the page size. Optional filters: `severity`,
+    `class` (exact predicted class) and a `from`/`to` date range, which
+    is inclusive of `from` and exclusive of `to`.
+    """
+    try:
+        rows, next_cursor = _history_page(get_jwt_identity(), request.args, current_app.config)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    headers = _history_headers(next_cursor, request.args.to_dict(), request.base_url)
+    host_url = request.host_url
+
+    def generate():
+        yield "["
+        for i, row in enumerate(rows):
+            yield ("," if i else "") + json.dumps(_history_item(row, host_url))
+        yield "]"
+
+    return Response(generate(), mimetype='application/json', headers=headers)
@@ -0,0 +1,365 @@
+"""
+Prometheus metrics and Server-Timing headers for the request pipeline.
+
+Values live in process memory behind one lock per metric, so an
+observation costs a dict lookup and a bisect and can stay on under full
+load. `/metrics` renders them in the Prometheus text format. Under
+serve.py every HTTP worker also snapshots its values into a shared folder
+every METRICS_SYNC_SECONDS, and the worker that answers a scrape merges
+the other workers' snapshots into its own.
+"""
+import bisect
+import json
+import os
+import threading
+import time
+
+from flask import Response, g, has_request_context, request
+
+from .storage import write_atomic
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+MODEL_STATES = ('idle', 'loading', 'ready', 'failed')
+
+# Folder for per-worker snapshots, set by serve.py in each HTTP worker
+shared_dir = None
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        with self._lock:
+            return {json.dumps(labels): self._copy(value) for labels, value in self._values.items()}
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def _copy(self, value):
+        return value
+
+    def merge(self, values, snapshot):
+        for key, value in snapshot.items():
+            labels = tuple(json.loads(key))
+            values[labels] = self._combine(values.get(labels), value)
+
+    def _combine(self, current, other):
+        return other if current is None else current + other
+
+    def render(self, values):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for labels, value in sorted(values.items()):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. Across workers, `mode='sum'` adds the
+    workers' values and `mode='max'` keeps the largest.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), mode='sum'):
+        super().__init__(name, documentation, labelnames)
+        self.mode = mode
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def _combine(self, current, other):
+        if current is None:
+            return other
+        return max(current, other) if self.mode == 'max' else current + other
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                # Per-bucket counts (the last one is +Inf), then sum
+                entry = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            entry[index] += 1
+            entry[-1] += value
+
+    def _copy(self, value):
+        return list(value)
+
+    def _combine(self, current, other):
+        if current is None:
+            return list(other)
+        return [a + b for a, b in zip(current, other)]
+
+    def render(self, values):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        bounds = self.buckets + (float('inf'),)
+        for labels, entry in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, entry):
+                cumulative += count
+                le = (('le', _format_value(float(bound))),)
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}')
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f'{self.name}_sum{label_text} {_format_value(entry[-1])}')
+            lines.append(f'{self.name}_count{label_text} {cumulative}')
+        return lines
+
+
+class Registry:
+    """
+    The metrics of this process, plus collectors: callables that refresh
+    gauges from app state right before values are read.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, fn):
+        self.collectors.append(fn)
+        return fn
+
+    def collect(self):
+        for fn in self.collectors:
+            fn()
+
+    def snapshot(self):
+        self.collect()
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+    def clear(self):
+        for metric in self.metrics:
+            metric.clear()
+
+    def render(self, others=()):
+        """
+        Text exposition of this process's values merged with `others`
+        (snapshots from other processes).
+        """
+        self.collect()
+        lines = []
+        for metric in self.metrics:
+            values = {}
+            metric.merge(values, metric.snapshot())
+            for other in others:
+                metric.merge(values, other.get(metric.name, {}))
+            lines.extend(metric.render(values))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'medvisor_request_duration_seconds', 'Time to produce a response, by route, method and status.',
+    ('endpoint', 'method', 'status')
+))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'medvisor_stage_duration_seconds', 'Time spent in each stage of the prediction pipeline.', ('stage', 'model')
+))
+IN_FLIGHT = REGISTRY.register(Gauge(
+    'medvisor_requests_in_flight', 'Requests being handled, by route.', ('endpoint',)
+))
+MODEL_STATE = REGISTRY.register(Gauge(
+    'medvisor_model_state', '1 for the current model loading state, 0 otherwise.', ('state',), mode='max'
+))
+MODEL_LOAD_SECONDS = REGISTRY.register(Gauge(
+    'medvisor_model_load_seconds', 'Duration of the last model load, by phase.', ('phase',), mode='max'
+))
+ERRORS = REGISTRY.register(Counter(
+    'medvisor_errors_total', 'Errors caught in the prediction pipeline, by where they happened.', ('where',)
+))
+ADMISSION_WAITING = REGISTRY.register(Gauge(
+    'medvisor_admission_waiting', 'Prediction requests waiting for an admission slot.'
+))
+SHED = REGISTRY.register(Counter(
+    'medvisor_shed_total', 'Prediction requests shed under load, by reason.', ('reason',)
+))
+
+# Model label for stage metrics; set when a model is loaded
+model_label = 'none'
+
+
+def set_model(label):
+    global model_label
+    model_label = label
+
+
+def set_model_state(state, timings=None):
+    for name in MODEL_STATES:
+        MODEL_STATE.set(1 if name == state else 0, name)
+    for name, seconds in (timings or {}).items():
+        if name.endswith('_seconds'):
+            MODEL_LOAD_SECONDS.set(seconds, name[:-len('_seconds')])
+
+
+def record_stages(timings, model=None):
+    """
+    Observe stage durations (seconds, from a StageTimer); inside a request
+    they are also reported in its Server-Timing header.
+    """
+    model = model or model_label
+    for stage, seconds in timings.items():
+        STAGE_SECONDS.observe(seconds, stage, model)
+    if has_request_context():
+        server_timing = g.setdefault('server_timing', {})
+        for stage, seconds in timings.items():
+            server_timing[stage] = server_timing.get(stage, 0.0) + seconds
+
+
+def server_timing_header(timings, total):
+    parts = [f'{stage};dur={seconds * 1000:.2f}' for stage, seconds in timings.items()]
+    parts.append(f'total;dur={total * 1000:.2f}')
+    return ', '.join(parts)
+
+
+def _endpoint():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def _snapshot_path(pid):
+    return os.path.join(shared_dir, f'{pid}.json')
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def write_snapshot():
+    write_atomic(_snapshot_path(os.getpid()), json.dumps(REGISTRY.snapshot()).encode('utf-8'))
+
+
+def other_snapshots():
+    """
+    Snapshots written by the other workers. Gauges of workers that have
+    exited are dropped; their counters and histograms still count.
+    """
+    if shared_dir is None:
+        return []
+    snapshots = []
+    for name in os.listdir(shared_dir):
+        stem, ext = os.path.splitext(name)
+        if ext != '.json' or not stem.isdigit() or int(stem) == os.getpid():
+            continue
+        try:
+            with open(os.path.join(shared_dir, name)) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if not _alive(int(stem)):
+            snapshot = {metric.name: snapshot.get(metric.name, {})
+                        for metric in REGISTRY.metrics if not isinstance(metric, Gauge)}
+        snapshots.append(snapshot)
+    return snapshots
+
+
+def _snapshot_loop(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            write_snapshot()
+        except OSError:
+            pass
+
+
+def metrics_view():
+    return Response(REGISTRY.render(other_snapshots()), content_type=CONTENT_TYPE)
+
+
+def init_metrics(app):
+    """
+    Time every request, add Server-Timing headers and serve `/metrics`.
+    """
+    if not app.config['METRICS_ENABLED']:
+        return
+
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+        g.metrics_endpoint = _endpoint()
+        IN_FLIGHT.inc(g.metrics_endpoint)
+
+    @app.after_request
+    def observe_request(response):
+        started = g.get('request_started')
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+        REQUEST_SECONDS.observe(elapsed, g.metrics_endpoint, request.method, str(response.status_code))
+        # Streamed responses are timed up to their first byte
+        response.headers['Server-Timing'] = server_timing_header(g.get('server_timing', {}), elapsed)
+        return response
+
+    @app.teardown_request
+    def finish_request(exc):
+        endpoint = g.pop('metrics_endpoint', None)
+        if endpoint is not None:
+            IN_FLIGHT.dec(endpoint)
+
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
+
+    if shared_dir is not None:
+        os.makedirs(shared_dir, exist_ok=True)
+        write_snapshot()
+        threading.Thread(target=_snapshot_loop, args=(app.config['METRICS_SYNC_SECONDS'],),
+                         name='metrics-snapshot', daemon=True).start()
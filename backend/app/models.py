@@ -1,5 +1,6 @@
 from .extensions import db
 from datetime import datetime
+from sqlalchemy import inspect
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -18,9 +19,53 @@ class Prediction(db.Model):
     predicted_class = db.Column(db.String(100), nullable=False)
     confidence = db.Column(db.Float, nullable=False)
     severity = db.Column(db.String(50), nullable=False)
-    gradcam_path = db.Column(db.String(200), nullable=True)
+    gradcam_path = db.Column(db.String(200), nullable=True, index=True)
+    heatmap = db.Column(db.LargeBinary, nullable=True)  # float16 Grad-CAM, see heatmaps.encode_heatmap
     date_posted = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    # Registry model that scored the image, as "<name>@<version>"
+    model_version = db.Column(db.String(100), nullable=True)
+    # Test-time augmentation: views averaged, and the variance of the
+    # predicted class's probability across them (None for single-view)
+    tta_views = db.Column(db.Integer, nullable=True)
+    uncertainty = db.Column(db.Float, nullable=True)
+
+    # Keyset pagination for /api/history walks (user_id, date_posted, id)
+    # backwards; the filtered variants keep severity/class filters on an index
+    __table_args__ = (
+        db.Index('ix_prediction_user_date_id', 'user_id', 'date_posted', 'id'),
+        db.Index('ix_prediction_user_severity_date_id', 'user_id', 'severity', 'date_posted', 'id'),
+        db.Index('ix_prediction_user_class_date_id', 'user_id', 'predicted_class', 'date_posted', 'id'),
+    )
 
     def __repr__(self):
         return f'<Prediction {self.predicted_class} - {self.confidence}>'
+
+class IdBlock(db.Model):
+    """
+    Next unreserved id per sequence; ids are handed out in blocks (hi/lo)
+    so rows can be given their id before they are written.
+    """
+    name = db.Column(db.String(50), primary_key=True)
+    next_id = db.Column(db.Integer, nullable=False)
+
+def upgrade_schema():
+    """
+    Bring an existing database up to the current models.
+
+    `db.create_all()` only creates missing tables, so columns and indexes
+    added to existing models are created here. New columns must be nullable.
+    """
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            with db.engine.begin() as conn:
+                conn.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}')
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
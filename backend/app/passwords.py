@@ -0,0 +1,71 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_bcrypt import Bcrypt
+
+
+class HasherBusy(Exception):
+    """
+    Raised when more password hashes are queued than the pool allows.
+    """
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt on a small dedicated thread pool.
+
+    bcrypt releases the GIL, so at most `max_workers` cores go to hashing
+    however many logins arrive at once, leaving the rest for request
+    threads. At most `max_queue` more calls may wait for a worker; beyond
+    that `hash`/`check` raise HasherBusy after `queue_timeout` seconds.
+    The `_async` variants are awaitable from an event loop and raise
+    HasherBusy at once instead of waiting for room in the queue.
+    """
+
+    def __init__(self, rounds=12, max_workers=2, max_queue=32, queue_timeout=2.0):
+        self.rounds = rounds
+        self.queue_timeout = queue_timeout
+        self._bcrypt = Bcrypt()
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='bcrypt')
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise HasherBusy()
+        try:
+            return self._executor.submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    async def _run_async(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            return await asyncio.wrap_future(self._executor.submit(fn, *args))
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(self._bcrypt.generate_password_hash, password, self.rounds).decode('utf-8')
+
+    def check(self, password_hash, password):
+        return self._run(self._bcrypt.check_password_hash, password_hash, password)
+
+    async def hash_async(self, password):
+        return (await self._run_async(self._bcrypt.generate_password_hash, password, self.rounds)).decode('utf-8')
+
+    async def check_async(self, password_hash, password):
+        return await self._run_async(self._bcrypt.check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """
+        True when a stored hash was made with a different cost than configured.
+        """
+        try:
+            return int(password_hash.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return False
+
+    def close(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,436 @@
+"""
+Write-behind persistence for Prediction rows.
+
+Requests hand rows to a WriteBehindPersister and return straight away with
+an id reserved up front; a flusher thread writes queued inserts and updates
+in bulk transactions. Every operation is appended to a local spool file
+first, so rows accepted before a crash are replayed on the next start.
+"""
+import base64
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from sqlalchemy import event, select, update
+
+from . import metrics
+from .extensions import db
+from .models import IdBlock, Prediction
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    # Durable at checkpoints; WAL keeps the database consistent either way
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', 5000),
+    ('temp_store', 'MEMORY'),
+    ('cache_size', -16000),
+    ('wal_autocheckpoint', 1000),
+)
+
+
+def configure_sqlite(engine):
+    """
+    Apply SQLITE_PRAGMAS to every new connection of a file-backed SQLite engine.
+    """
+    if engine.dialect.name != 'sqlite' or engine.url.database in (None, '', ':memory:'):
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in SQLITE_PRAGMAS:
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+
+class IdAllocator:
+    """
+    Hands out Prediction ids from blocks reserved in the `id_block` table
+    (hi/lo), so ids are known before the row is written. Each process
+    reserves its own blocks; ids are unique but not ordered across them.
+    """
+
+    def __init__(self, app, block_size=100, name='prediction'):
+        self.app = app
+        self.block_size = block_size
+        self.name = name
+        self._next = self._end = 0
+        self._lock = threading.Lock()
+
+    def allocate(self):
+        with self._lock:
+            if self._next >= self._end:
+                self._next, self._end = self._reserve()
+            value = self._next
+            self._next += 1
+            return value
+
+    def reset(self):
+        with self._lock:
+            self._next = self._end = 0
+
+    def _reserve(self):
+        with self.app.app_context(), db.engine.begin() as conn:
+            # Taking the write lock first keeps concurrent processes apart
+            bumped = conn.execute(
+                update(IdBlock).where(IdBlock.name == self.name).values(next_id=IdBlock.next_id + self.block_size)
+            ).rowcount
+            if not bumped:
+                start = (conn.execute(select(db.func.max(Prediction.id))).scalar() or 0) + 1
+                conn.execute(IdBlock.__table__.insert().values(name=self.name, next_id=start + self.block_size))
+            end = conn.execute(select(IdBlock.next_id).where(IdBlock.name == self.name)).scalar()
+        return end - self.block_size, end
+
+
+def _encode(value):
+    if isinstance(value, bytes):
+        return {"$b64": base64.b64encode(value).decode('ascii')}
+    if isinstance(value, datetime):
+        return {"$dt": value.isoformat()}
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict):
+        if "$b64" in value:
+            return base64.b64decode(value["$b64"])
+        if "$dt" in value:
+            return datetime.fromisoformat(value["$dt"])
+    return value
+
+
+def _encode_op(op):
+    kind, payload = op
+    if kind == 'insert':
+        return {"op": kind, "rows": [{k: _encode(v) for k, v in row.items()} for row in payload]}
+    ids, fields = payload
+    return {"op": kind, "ids": ids, "fields": {k: _encode(v) for k, v in fields.items()}}
+
+
+def _decode_op(record):
+    if record["op"] == 'insert':
+        return 'insert', [{k: _decode(v) for k, v in row.items()} for row in record["rows"]]
+    return 'update', (record["ids"], {k: _decode(v) for k, v in record["fields"].items()})
+
+
+class SpoolSegment:
+    """
+    Append-only JSON-lines file of operations not yet committed.
+
+    The owning process holds an exclusive flock on it, so a segment that
+    can be locked at startup belongs to a process that died.
+    """
+
+    def __init__(self, folder, fsync):
+        self.path = os.path.join(folder, f'{os.getpid()}-{uuid.uuid4().hex}.spool')
+        self.fsync = fsync
+        self.file = open(self.path, 'ab')
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+
+    def append(self, op):
+        self.file.write(json.dumps(_encode_op(op)).encode('utf-8') + b'\n')
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def remove(self):
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _row_values(row):
+    return {column.name: getattr(row, column.name) for column in Prediction.__table__.columns}
+
+
+def apply_ops(ops):
+    """
+    Write queued operations in one transaction, in order. Inserts skip ids
+    that already exist, so replaying a spool twice is harmless.
+    """
+    table = Prediction.__table__
+    for kind, payload in ops:
+        if kind == 'insert':
+            ids = [row['id'] for row in payload]
+            existing = set(db.session.execute(select(table.c.id).where(table.c.id.in_(ids))).scalars())
+            rows = [row for row in payload if row['id'] not in existing]
+            if rows:
+                db.session.execute(table.insert(), rows)
+        else:
+            ids, fields = payload
+            db.session.execute(table.update().where(table.c.id.in_(ids)).values(**fields))
+    db.session.commit()
+
+
+def recover_spool(app, folder):
+    """
+    Replay spool segments left behind by dead processes; returns the
+    number of operations replayed.
+    """
+    replayed = 0
+    for name in sorted(os.listdir(folder)):
+        if not name.endswith('.spool'):
+            continue
+        path = os.path.join(folder, name)
+        with open(path, 'rb') as f:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Still owned by a live process
+                    continue
+            ops = []
+            for line in f:
+                try:
+                    ops.append(_decode_op(json.loads(line)))
+                except ValueError:
+                    # Torn final line from the crash
+                    break
+            if ops:
+                with app.app_context():
+                    apply_ops(ops)
+                    db.session.remove()
+            os.remove(path)
+            replayed += len(ops)
+    return replayed
+
+
+class WriteBehindPersister:
+    """
+    Queue of Prediction inserts and updates flushed in bulk.
+
+    `add`/`add_all` assign the id (and timestamp) immediately, spool the
+    row and return. A flush runs when `batch_size` operations are queued
+    or `interval_ms` after the first one, whichever comes first. Readers
+    that must see a row just added call `sync()`.
+
+    With `write_behind=False` every call commits before returning.
+
+    When a flush fails its ops are retried one by one, so the rest of the
+    batch commits. An op that fails `max_retries` times in a row is
+    dead-lettered: it is appended to DEAD_LETTER_FILE in the spool folder,
+    which is never replayed, and the error is logged.
+    """
+
+    DEAD_LETTER_FILE = 'dead-letter.jsonl'
+
+    def __init__(self, app, spool_folder, batch_size=256, interval_ms=50, id_block=100, fsync=True,
+                 write_behind=True, max_retries=5):
+        self.app = app
+        self.spool_folder = spool_folder
+        self.batch_size = batch_size
+        self.interval = interval_ms / 1000.0
+        self.max_retries = max_retries
+        self.fsync = fsync
+        self.write_behind = write_behind
+        self.ids = IdAllocator(app, block_size=id_block)
+
+        # Queued ops, the spool segment they are appended to, and older
+        # segments whose ops are still queued after a failed flush
+        self._ops = []
+        self._segment = None
+        self._retired = []
+        # Failed attempts so far of ops queued for a retry, by id(op)
+        self._attempts = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._flushed = threading.Condition(self._lock)
+        self._generation = 0
+        self._flushing = False
+        self._sync_requested = False
+        self._closed = False
+        self._stats = {"flushes": 0, "ops": 0, "failures": 0, "dead_lettered": 0, "last_flush_ms": 0.0}
+
+        os.makedirs(spool_folder, exist_ok=True)
+        self.recovered = recover_spool(app, spool_folder)
+        self._thread = None
+        if write_behind:
+            self._thread = threading.Thread(target=self._run, name='persister', daemon=True)
+            self._thread.start()
+
+    def add(self, row):
+        return self.add_all([row])[0]
+
+    def add_all(self, rows):
+        """
+        Assign ids to unsaved Prediction rows and queue their insert.
+        """
+        now = datetime.utcnow()
+        for row in rows:
+            row.id = self.ids.allocate()
+            if row.date_posted is None:
+                row.date_posted = now
+        self._submit(('insert', [_row_values(row) for row in rows]))
+        return rows
+
+    def update(self, ids, fields):
+        """
+        Queue an update of `fields` on the rows with the given ids.
+        """
+        self._submit(('update', (list(ids), dict(fields))))
+
+    def sync(self, timeout=10.0):
+        """
+        Flush everything queued so far and wait for it to be committed.
+        """
+        if not self.write_behind:
+            return
+        with self._lock:
+            if not self._ops and not self._flushing:
+                return
+            # A flush already in progress may hold ops queued by this
+            # caller; ops queued since need the flush after it as well
+            target = self._generation + (2 if self._ops and self._flushing else 1)
+            # Flush without waiting for the batch to fill, even if the
+            # flusher only starts its wait after this notify
+            self._sync_requested = True
+            self._wake.notify()
+            deadline = time.monotonic() + timeout
+            # Every flush attempt bumps the generation; ops it left for a
+            # retry are waited for too
+            while self._generation < target or self._attempts:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._flushed.wait(remaining)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._wake.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=30)
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "queued": len(self._ops)}
+
+    def _submit(self, op):
+        if not self.write_behind:
+            started = time.monotonic()
+            with self.app.app_context():
+                apply_ops([op])
+                db.session.remove()
+            metrics.record_stages({'db_commit': time.monotonic() - started})
+            return
+        with self._lock:
+            if self._segment is None:
+                self._segment = SpoolSegment(self.spool_folder, self.fsync)
+            self._segment.append(op)
+            self._ops.append(op)
+            if len(self._ops) == 1 or len(self._ops) >= self.batch_size:
+                self._wake.notify()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._ops and not self._closed:
+                    self._wake.wait()
+                if not self._ops and self._closed:
+                    return
+                if len(self._ops) < self.batch_size and not self._closed and not self._sync_requested:
+                    # Let the batch fill for up to one interval
+                    self._wake.wait(self.interval)
+                self._sync_requested = False
+                ops = self._ops
+                segments = self._retired + ([self._segment] if self._segment else [])
+                self._ops, self._segment, self._retired = [], None, []
+                self._flushing = True
+            self._flush(ops, segments)
+
+    def _apply(self, ops):
+        with self.app.app_context():
+            try:
+                apply_ops(ops)
+            finally:
+                db.session.remove()
+
+    def _flush(self, ops, segments):
+        started = time.monotonic()
+        try:
+            self._apply(ops)
+        except Exception:
+            logger.exception("Persist flush failed, retrying ops one by one", extra={"ops": len(ops)})
+            metrics.ERRORS.inc('persist')
+            self._flush_each(ops, segments, started)
+            return
+        self._committed(ops, segments, started)
+
+    def _flush_each(self, ops, segments, started):
+        """
+        Commit the ops of a failed batch one at a time, so one bad op can't
+        hold back the rest. Ops that still fail are queued for a retry (with
+        backoff) until they have failed `max_retries` times, then dead-lettered.
+        """
+        retry, committed = [], 0
+        for op in ops:
+            try:
+                self._apply([op])
+                self._attempts.pop(id(op), None)
+                committed += 1
+            except Exception as e:
+                attempts = self._attempts.pop(id(op), 0) + 1
+                if attempts >= self.max_retries:
+                    self._dead_letter(op, e, attempts)
+                else:
+                    self._attempts[id(op)] = attempts
+                    retry.append(op)
+        if not retry:
+            self._committed(ops, segments, started, committed)
+            return
+
+        with self._lock:
+            self._flushing = False
+            self._stats["failures"] += 1
+            self._stats["ops"] += committed
+            # Failed ops go back in front of any queued since; their
+            # segments stay on disk until they are resolved
+            self._ops = retry + self._ops
+            self._retired = segments + self._retired
+            self._generation += 1
+            self._flushed.notify_all()
+        backoff = self.interval * 2 ** max(self._attempts[id(op)] for op in retry)
+        time.sleep(min(backoff, 5.0))
+
+    def _dead_letter(self, op, error, attempts):
+        logger.error("Dropping persist op after repeated failures, kept in the dead-letter file",
+                     extra={"op": op[0], "attempts": attempts, "error": str(error),
+                            "path": os.path.join(self.spool_folder, self.DEAD_LETTER_FILE)})
+        metrics.ERRORS.inc('persist_dead_letter')
+        record = {**_encode_op(op), "error": str(error), "attempts": attempts}
+        with open(os.path.join(self.spool_folder, self.DEAD_LETTER_FILE), 'ab') as f:
+            f.write(json.dumps(record).encode('utf-8') + b'\n')
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        with self._lock:
+            self._stats["dead_lettered"] += 1
+
+    def _committed(self, ops, segments, started, committed=None):
+        elapsed = time.monotonic() - started
+        metrics.record_stages({'db_commit': elapsed})
+        for op in ops:
+            self._attempts.pop(id(op), None)
+        for segment in segments:
+            segment.remove()
+        with self._lock:
+            self._flushing = False
+            self._generation += 1
+            self._stats["flushes"] += 1
+            self._stats["ops"] += len(ops) if committed is None else committed
+            self._stats["last_flush_ms"] = round(elapsed * 1000, 3)
+            self._flushed.notify_all()
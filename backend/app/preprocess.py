@@ -0,0 +1,232 @@
+"""
+Upload decoding and model preprocessing.
+
+Large scans are decoded at reduced resolution when the format allows it,
+uploads are stored as received, and resizing plus normalisation write into
+caller-provided buffers so the request path does not allocate per image.
+"""
+import struct
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# Magic bytes -> extension used when storing an upload verbatim
+SIGNATURES = (
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'BM', '.bmp'),
+    (b'II*\x00', '.tif'),
+    (b'MM\x00*', '.tif'),
+)
+DEFAULT_EXTENSION = '.img'
+
+# Scale factor -> cv2 flag. libjpeg decodes these directly at 1/2, 1/4 or
+# 1/8 resolution by skipping DCT coefficients.
+REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+# JPEG start-of-frame markers (baseline, progressive, lossless...); C4, C8
+# and CC share the range but are not frame headers
+SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+STAGES = ('decode', 'store', 'resize_normalize')
+
+# Model input scaling: name -> (scale, offset) applied to uint8 pixels.
+# mobilenet_v2 maps to [-1, 1], unit to [0, 1], raw keeps 0-255.
+PREPROCESSING = {
+    'mobilenet_v2': (1 / 127.5, -1.0),
+    'unit': (1 / 255.0, 0.0),
+    'raw': (1.0, 0.0),
+}
+
+# Prefix read to find a JPEG frame header; EXIF/ICC segments come first
+HEADER_BYTES = 1 << 18
+
+
+def image_extension(img_bytes):
+    for magic, ext in SIGNATURES:
+        if img_bytes.startswith(magic):
+            return ext
+    if img_bytes[:4] == b'RIFF' and img_bytes[8:12] == b'WEBP':
+        return '.webp'
+    if img_bytes[128:132] == b'DICM':
+        return '.dcm'
+    return DEFAULT_EXTENSION
+
+
+def jpeg_size(img_bytes):
+    """
+    (width, height) from a JPEG frame header, or None if it can't be found.
+    """
+    offset = 2
+    length = len(img_bytes)
+    while offset + 4 <= length:
+        if img_bytes[offset] != 0xFF:
+            return None
+        marker = img_bytes[offset + 1]
+        if marker == 0xFF:
+            # Fill byte
+            offset += 1
+            continue
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            offset += 2
+            continue
+        segment_length, = struct.unpack_from('>H', img_bytes, offset + 2)
+        if marker in SOF_MARKERS:
+            if offset + 9 > length:
+                return None
+            height, width = struct.unpack_from('>HH', img_bytes, offset + 5)
+            return width, height
+        offset += 2 + segment_length
+    return None
+
+
+def decode_flag(img_bytes, input_size):
+    """
+    The cv2.imdecode flag for an upload: the coarsest reduced decode that
+    still leaves the short edge at least `input_size` pixels.
+    """
+    if not img_bytes.startswith(b'\xff\xd8\xff'):
+        return cv2.IMREAD_COLOR
+    size = jpeg_size(img_bytes)
+    if size is None:
+        return cv2.IMREAD_COLOR
+    short_edge = min(size)
+    for factor, flag in REDUCED_FLAGS:
+        if short_edge // factor >= input_size:
+            return flag
+    return cv2.IMREAD_COLOR
+
+
+def decode(img_bytes, input_size):
+    """
+    Decode an upload to BGR, at reduced resolution when it is much larger
+    than the model input. Returns None when the bytes are not an image.
+    """
+    return cv2.imdecode(np.frombuffer(img_bytes, np.uint8), decode_flag(img_bytes, input_size))
+
+
+def decode_file(path, input_size):
+    """
+    Like `decode`, for an upload already stored on disk.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(HEADER_BYTES)
+    return cv2.imread(path, decode_flag(head, input_size))
+
+
+def normalize(resized, out=None, preprocessing='mobilenet_v2'):
+    """
+    Scale uint8 pixels into `out` as the model expects (see PREPROCESSING;
+    the default matches mobilenet_v2.preprocess_input).
+    """
+    scale, offset = PREPROCESSING[preprocessing]
+    if out is None:
+        out = np.empty(resized.shape, np.float32)
+    np.multiply(resized, np.float32(scale), out=out)
+    if offset:
+        out += np.float32(offset)
+    return out
+
+
+def resize(img, input_size, out=None):
+    """
+    Resize to the square uint8 model input, into `out` when given.
+    """
+    if out is None:
+        out = np.empty((input_size, input_size, 3), np.uint8)
+    height, width = img.shape[:2]
+    interpolation = cv2.INTER_AREA if height > input_size and width > input_size else cv2.INTER_LINEAR
+    cv2.resize(img, (input_size, input_size), dst=out, interpolation=interpolation)
+    return out
+
+
+def resize_normalize(img, input_size, out=None, resized=None, preprocessing='mobilenet_v2'):
+    """
+    Resize to the square model input and normalise in one step.
+
+    `resized` receives the uint8 pixels and `out` the float32 tensor; both
+    are allocated only when not given. Returns (resized, out).
+    """
+    resized = resize(img, input_size, resized)
+    return resized, normalize(resized, out, preprocessing)
+
+
+class TensorPool:
+    """
+    Reusable float32 model-input buffers.
+
+    A request borrows a buffer for as long as its tensor is queued for
+    inference; the batcher copies it into the batch before the future
+    resolves, after which the buffer goes back for the next request.
+    """
+
+    def __init__(self, input_size, max_free=64):
+        self.shape = (input_size, input_size, 3)
+        self.max_free = max_free
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return np.empty(self.shape, np.float32)
+
+    def release(self, buffer):
+        with self._lock:
+            if len(self._free) < self.max_free:
+                self._free.append(buffer)
+
+
+class StageTimer:
+    """
+    Wall-clock durations of successive preprocessing stages, in seconds.
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self._last = time.perf_counter()
+
+    def restart(self):
+        """
+        Resume timing from now, leaving out work between stages.
+        """
+        self._last = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.timings[stage] = now - self._last
+        self._last = now
+
+
+class PreprocessStats:
+    """
+    Running per-stage totals for /api/inference/stats.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._count = 0
+        self._totals = dict.fromkeys(STAGES, 0.0)
+        self._max = dict.fromkeys(STAGES, 0.0)
+
+    def record(self, timings):
+        with self._lock:
+            self._count += 1
+            # Request timers also carry non-preprocessing stages
+            for stage in STAGES:
+                if stage in timings:
+                    self._totals[stage] += timings[stage]
+                    self._max[stage] = max(self._max[stage], timings[stage])
+
+    def stats(self):
+        with self._lock:
+            count = self._count
+            return {
+                "images": count,
+                "mean_ms": {stage: round(total / count * 1000, 3) if count else 0.0
+                            for stage, total in self._totals.items()},
+                "max_ms": {stage: round(seconds * 1000, 3) for stage, seconds in self._max.items()},
+            }
@@ -0,0 +1,416 @@
+"""
+Versioned model registry with hot reload.
+
+Models live under MODEL_REGISTRY_DIR as `<name>/<version>/`, each folder
+holding the model (`model.keras` or `model.h5`), optional metadata in
+`model.json` and optionally its class index (`class_index.json`):
+
+    {"last_conv_layer": "conv5_block3_out", "input_size": 224,
+     "preprocessing": "mobilenet_v2", "labels": "class_index.json"}
+
+When the registry has no versions of MODEL_NAME, MODEL_PATH is served
+under that name (versioned by the file's modification time).
+
+`refresh()` loads and warms any newer version while the current one keeps
+serving, then switches to it atomically. Requests hold a lease on the
+version they started on; a replaced version is closed once its last lease
+is released. The newest MODEL_REGISTRY_KEEP versions of each model stay
+loaded and can be requested by version (`name@version`).
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from .preprocess import PREPROCESSING
+from .utils import model_identity
+
+MODEL_FILES = ('model.keras', 'model.h5')
+METADATA_FILE = 'model.json'
+
+logger = logging.getLogger(__name__)
+
+
+class UnknownModel(LookupError):
+    """
+    Raised when a request asks for a model or version that isn't loaded.
+    """
+
+
+def version_key(version):
+    """
+    Sort key ordering versions naturally: '2' < '10', '1.9' < '1.10'.
+    """
+    return [(0, int(part), '') if part.isdigit() else (1, 0, part) for part in re.split(r'(\d+)', version) if part]
+
+
+class ModelSpec:
+    """
+    One model version on disk and how to feed it.
+    """
+
+    def __init__(self, name, version, path, last_conv_layer=None, input_size=224,
+                 preprocessing='mobilenet_v2', class_index=None):
+        if preprocessing not in PREPROCESSING:
+            raise ValueError(f"{name}@{version}: unknown preprocessing {preprocessing!r}")
+        self.name = name
+        self.version = version
+        self.path = path
+        self.last_conv_layer = last_conv_layer
+        self.input_size = int(input_size)
+        self.preprocessing = preprocessing
+        self.class_index = class_index
+
+    @property
+    def key(self):
+        return f"{self.name}@{self.version}"
+
+    def fingerprint(self):
+        """
+        Changes when the model file is replaced in place.
+        """
+        return model_identity(self.path)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "version": self.version,
+            "last_conv_layer": self.last_conv_layer,
+            "input_size": self.input_size,
+            "preprocessing": self.preprocessing,
+        }
+
+    @classmethod
+    def from_folder(cls, name, version, folder, input_size=224):
+        """
+        Spec for `<name>/<version>/`, or None when it holds no model file.
+        """
+        path = next((os.path.join(folder, f) for f in MODEL_FILES if os.path.isfile(os.path.join(folder, f))), None)
+        if path is None:
+            return None
+        metadata = {}
+        if os.path.isfile(os.path.join(folder, METADATA_FILE)):
+            with open(os.path.join(folder, METADATA_FILE)) as f:
+                metadata = json.load(f)
+        class_index = metadata.get('labels')
+        return cls(
+            name, version, path,
+            last_conv_layer=metadata.get('last_conv_layer'),
+            input_size=metadata.get('input_size', input_size),
+            preprocessing=metadata.get('preprocessing', 'mobilenet_v2'),
+            class_index=os.path.join(folder, class_index) if class_index else None,
+        )
+
+    @classmethod
+    def legacy(cls, config):
+        """
+        MODEL_PATH served as MODEL_NAME: versioned by its modification time,
+        or `imagenet` for the MobileNetV2 fallback.
+        """
+        path = config['MODEL_PATH']
+        if os.path.exists(path):
+            version = time.strftime('%Y%m%d%H%M%S', time.gmtime(os.stat(path).st_mtime))
+        else:
+            version = 'imagenet'
+        return cls(config['MODEL_NAME'], version, path, input_size=config['MODEL_INPUT_SIZE'])
+
+
+def discover(root, input_size=224):
+    """
+    {name: [ModelSpec, ...]} for the registry folder, oldest version first.
+    Versions with unreadable metadata are skipped.
+    """
+    specs = {}
+    if not root or not os.path.isdir(root):
+        return specs
+    for name in sorted(os.listdir(root)):
+        model_dir = os.path.join(root, name)
+        if name.startswith('.') or not os.path.isdir(model_dir):
+            continue
+        versions = []
+        for version in os.listdir(model_dir):
+            folder = os.path.join(model_dir, version)
+            if version.startswith('.') or not os.path.isdir(folder):
+                continue
+            try:
+                spec = ModelSpec.from_folder(name, version, folder, input_size)
+            except (OSError, ValueError, TypeError) as e:
+                logger.warning("Skipping model version with bad metadata",
+                               extra={"model": f"{name}@{version}", "error": str(e)})
+                continue
+            if spec is not None:
+                versions.append(spec)
+        if versions:
+            specs[name] = sorted(versions, key=lambda spec: version_key(spec.version))
+    return specs
+
+
+def available_specs(config):
+    """
+    Registry specs plus the MODEL_PATH fallback for MODEL_NAME.
+    """
+    specs = discover(config['MODEL_REGISTRY_DIR'], config['MODEL_INPUT_SIZE'])
+    if config['MODEL_NAME'] not in specs:
+        specs[config['MODEL_NAME']] = [ModelSpec.legacy(config)]
+    return specs
+
+
+def default_spec(config):
+    """
+    The version of MODEL_NAME a fresh registry would serve.
+    """
+    return available_specs(config)[config['MODEL_NAME']][-1]
+
+
+class ModelVersion:
+    """
+    A loaded model version and the pipeline serving it.
+
+    `engine` is the backend (None when a shared inference process serves
+    it), `batcher`/`explain_batcher`/`predict_batcher` its batchers,
+    `labels` its LabelMap and `tensor_pool` input buffers of its size.
+    `identity` keys cached results, `label` names it in metrics and
+    `timings` has its load and warmup durations.
+    """
+
+    def __init__(self, spec, engine=None, labels=None, tensor_pool=None, identity=None, label=None,
+                 batcher=None, explain_batcher=None, predict_batcher=None, timings=None):
+        self.spec = spec
+        self.engine = engine
+        self.labels = labels
+        self.tensor_pool = tensor_pool
+        self.identity = identity or spec.key
+        self.label = label or spec.key
+        self.batcher = batcher
+        self.explain_batcher = explain_batcher
+        self.predict_batcher = predict_batcher
+        self.timings = timings or {}
+        self.state = "standby"
+        self.loaded_at = time.time()
+        self.fingerprint = spec.fingerprint()
+        self._leases = 0
+        self._lock = threading.Lock()
+
+    @property
+    def key(self):
+        return self.spec.key
+
+    def acquire(self):
+        """
+        Take a lease; the version stays open until every lease is released.
+        """
+        with self._lock:
+            if self.state == "closed":
+                raise UnknownModel(f"Model {self.key} was unloaded")
+            self._leases += 1
+        return self
+
+    def release(self):
+        with self._lock:
+            self._leases -= 1
+            drained = self.state == "draining" and self._leases == 0
+        if drained:
+            self._close()
+
+    def retire(self):
+        """
+        Stop routing to this version and close it once drained.
+        """
+        with self._lock:
+            if self.state == "closed":
+                return
+            self.state = "draining"
+            drained = self._leases == 0
+        if drained:
+            self._close()
+
+    def _close(self):
+        with self._lock:
+            if self.state == "closed":
+                return
+            self.state = "closed"
+        for worker in (self.batcher, self.explain_batcher, self.predict_batcher):
+            if worker is not None:
+                worker.close()
+        logger.info("Model version unloaded", extra={"model": self.key})
+
+    def stats(self):
+        with self._lock:
+            return {**self.spec.to_dict(), "state": self.state, "leases": self._leases, "loaded_at": self.loaded_at}
+
+
+class ModelRegistry:
+    """
+    Loaded model versions by name, with one active version per name.
+
+    `build(spec)` loads, warms and wires up a ModelVersion (or returns None
+    when the model can't be loaded); it runs without the registry lock, so
+    requests keep leasing the current version meanwhile. `on_activate(entry)`
+    runs after each switch.
+    """
+
+    def __init__(self, config, build, keep=1, on_activate=None):
+        self.config = config
+        self.build = build
+        self.keep = max(1, keep)
+        self.on_activate = on_activate
+        self._versions = {}
+        self._active = {}
+        # Fingerprints of versions that failed to load, retried when replaced
+        self._failed = {}
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._stop = None
+
+    @property
+    def default_name(self):
+        return self.config['MODEL_NAME']
+
+    def active(self, name=None):
+        """
+        The active version of a model (default: MODEL_NAME), or None.
+        """
+        with self._lock:
+            return self._active.get(name or self.default_name)
+
+    def lease(self, selector=None):
+        """
+        Acquire the version a request asked for: `name`, `name@version` or
+        `@version` (of MODEL_NAME); the active default model when empty.
+        Raises UnknownModel when it isn't loaded.
+        """
+        name, _, version = (selector or '').partition('@')
+        name = name or self.default_name
+        with self._lock:
+            if version:
+                entry = self._versions.get(f"{name}@{version}")
+                if entry is not None and entry.state == "draining":
+                    entry = None
+            else:
+                entry = self._active.get(name)
+            if entry is None:
+                raise UnknownModel(f"Model {selector or name!r} is not loaded")
+            return entry.acquire()
+
+    def activate(self, entry):
+        """
+        Make a loaded version the one its name routes to. The previous
+        active version stays loaded while it is among the newest `keep`.
+        """
+        with self._lock:
+            self._versions[entry.key] = entry
+            previous = self._active.get(entry.spec.name)
+            self._active[entry.spec.name] = entry
+            entry.state = "active"
+            if previous is not None and previous is not entry:
+                previous.state = "standby"
+            retired = self._evict_locked(entry.spec.name)
+        for old in retired:
+            old.retire()
+        if self.on_activate is not None:
+            self.on_activate(entry)
+        logger.info("Model version activated", extra={"model": entry.key})
+
+    def _evict_locked(self, name):
+        loaded = sorted((entry for entry in self._versions.values() if entry.spec.name == name),
+                        key=lambda entry: version_key(entry.spec.version))
+        active = self._active.get(name)
+        keep = [entry for entry in loaded if entry is not active][-(self.keep - 1):] if self.keep > 1 else []
+        retired = [entry for entry in loaded if entry is not active and entry not in keep]
+        for entry in retired:
+            del self._versions[entry.key]
+        return retired
+
+    def refresh(self):
+        """
+        Load new versions from disk and switch each model to its newest one.
+
+        Returns the keys of versions activated. A version whose model file
+        is replaced in place is reloaded.
+        """
+        with self._refresh_lock:
+            activated = []
+            for name, specs in available_specs(self.config).items():
+                for spec in specs[-self.keep:]:
+                    with self._lock:
+                        loaded = self._versions.get(spec.key)
+                    if loaded is not None and loaded.fingerprint == spec.fingerprint():
+                        continue
+                    if self._failed.get(spec.key) == spec.fingerprint():
+                        continue
+                    entry = self._load(spec)
+                    if entry is None:
+                        continue
+                    with self._lock:
+                        replaced = self._versions.get(spec.key)
+                        self._versions[spec.key] = entry
+                        if replaced is not None and self._active.get(name) is replaced:
+                            self._active[name] = entry
+                            entry.state = "active"
+                    if replaced is not None:
+                        replaced.retire()
+                with self._lock:
+                    newest = max((entry for entry in self._versions.values() if entry.spec.name == name),
+                                 key=lambda entry: version_key(entry.spec.version), default=None)
+                    current = self._active.get(name)
+                if newest is not None and newest is not current:
+                    self.activate(newest)
+                    activated.append(newest.key)
+            return activated
+
+    def _load(self, spec):
+        started = time.monotonic()
+        try:
+            entry = self.build(spec)
+        except Exception:
+            logger.exception("Error loading model version", extra={"model": spec.key})
+            entry = None
+        if entry is None:
+            self._failed[spec.key] = spec.fingerprint()
+            return None
+        self._failed.pop(spec.key, None)
+        logger.info("Model version loaded", extra={"model": spec.key, "seconds": round(time.monotonic() - started, 3)})
+        return entry
+
+    def watch(self, interval):
+        """
+        Poll the registry folder every `interval` seconds on a daemon thread.
+        """
+        if self._stop is not None or interval <= 0:
+            return
+        stop = self._stop = threading.Event()
+
+        def poll():
+            while not stop.wait(interval):
+                try:
+                    self.refresh()
+                except Exception:
+                    logger.exception("Model registry refresh failed")
+
+        threading.Thread(target=poll, name='model-registry', daemon=True).start()
+
+    def close(self):
+        """
+        Stop watching and unload every version once drained.
+        """
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+        with self._lock:
+            entries = list(self._versions.values())
+            self._versions.clear()
+            self._active.clear()
+        for entry in entries:
+            entry.retire()
+
+    def stats(self):
+        with self._lock:
+            entries = list(self._versions.values())
+            active = {name: entry.key for name, entry in self._active.items()}
+        return {
+            "default": self.default_name,
+            "active": active,
+            "versions": {entry.key: entry.stats() for entry in entries},
+        }
@@ -0,0 +1,334 @@
+import itertools
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from .admission import Deadline, DeadlineExceeded, Overloaded
+
+# Client for the dedicated inference process, set in HTTP worker processes
+# before create_app() so init_model() talks to it instead of loading a model
+client = None
+# ModelSpec the inference process serves, set alongside `client`
+served_model = None
+
+
+def configure_tf_threads(intra_op=0, inter_op=0):
+    """
+    Cap TensorFlow's thread pools for this process (0 keeps TF's default).
+
+    Works before TensorFlow is imported by setting the environment variables
+    it reads at startup, and applies to an already-imported runtime too.
+    """
+    for name, value in (('TF_NUM_INTRAOP_THREADS', intra_op), ('TF_NUM_INTEROP_THREADS', inter_op)):
+        if value:
+            os.environ[name] = str(value)
+    if intra_op:
+        os.environ.setdefault('OMP_NUM_THREADS', str(intra_op))
+
+    import sys
+    if 'tensorflow' in sys.modules:
+        tf = sys.modules['tensorflow']
+        try:
+            if intra_op:
+                tf.config.threading.set_intra_op_parallelism_threads(intra_op)
+            if inter_op:
+                tf.config.threading.set_inter_op_parallelism_threads(inter_op)
+        except RuntimeError:
+            # Already initialized; the environment variables apply to new processes
+            pass
+
+
+class SlotPool:
+    """
+    Fixed-size input tensors in one shared-memory block.
+
+    HTTP workers copy a preprocessed image into a free slot and send only
+    the slot index to the inference process, so image arrays are never
+    pickled. Free slot indices travel through a multiprocessing queue.
+    """
+
+    def __init__(self, ctx, slots, input_shape, name=None):
+        self.slots = slots
+        self.input_shape = tuple(input_shape)
+        self.slot_bytes = int(np.prod(self.input_shape)) * np.dtype(np.float32).itemsize
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=self.slots * self.slot_bytes)
+            self.free = ctx.Queue()
+            for slot in range(slots):
+                self.free.put(slot)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # Only the creating process owns (and unlinks) the block
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.views = np.ndarray((slots,) + self.input_shape, dtype=np.float32, buffer=self.shm.buf)
+
+    def __getstate__(self):
+        return {"slots": self.slots, "input_shape": self.input_shape, "name": self.shm.name, "free": self.free}
+
+    def __setstate__(self, state):
+        self.__init__(None, state["slots"], state["input_shape"], name=state["name"])
+        self.free = state["free"]
+
+    def close(self, unlink=False):
+        self.views = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class InferenceServer:
+    """
+    Dedicated inference process shared by every HTTP worker.
+
+    Loads the model once, batches requests from all workers together with
+    one MicroBatcher per op, and answers on per-worker response queues.
+    """
+
+    def __init__(self, ctx, config, workers, slots):
+        from .registry import default_spec
+
+        self.ctx = ctx
+        self.config = config
+        # The registry version served until restart; workers read it too
+        self.spec = default_spec(config)
+        size = self.spec.input_size
+        self.pool = SlotPool(ctx, slots, (size, size, 3))
+        self.requests = ctx.SimpleQueue()
+        self.responses = [ctx.SimpleQueue() for _ in range(workers)]
+        self.status = ctx.SimpleQueue()
+        self.process = None
+
+    def start(self, timeout=None):
+        """
+        Start the inference process and wait until its model is loaded.
+        """
+        self.process = self.ctx.Process(
+            target=_serve_inference,
+            args=(self.config, self.spec, self.pool, self.requests, self.responses, self.status),
+            name='inference-server',
+            daemon=True
+        )
+        self.process.start()
+        state, detail = self.status.get()
+        if state != 'ready':
+            raise RuntimeError(f"Inference server failed to start: {detail}")
+        return detail
+
+    def client(self, worker_index):
+        return InferenceClient(self.pool, self.requests, self.responses[worker_index], worker_index)
+
+    def stop(self):
+        if self.process is not None and self.process.is_alive():
+            self.requests.put(None)
+            self.process.join(timeout=10)
+            if self.process.is_alive():
+                self.process.terminate()
+        self.pool.close(unlink=True)
+
+
+def _serve_inference(config, spec, pool, requests, responses, status):
+    from .logs import configure_logging
+
+    configure_logging(config['LOG_LEVEL'], config['LOG_FORMAT'])
+    configure_tf_threads(config['INFERENCE_INTRA_OP_THREADS'], config['INFERENCE_INTER_OP_THREADS'])
+    try:
+        from .backends import batch_runner, load_backend
+        from .batching import MicroBatcher
+
+        engine = load_backend(config, spec.path, spec.last_conv_layer, spec.input_size)
+        if engine is None:
+            status.put(('failed', 'Model not loaded'))
+            return
+        if config['MODEL_WARMUP']:
+            engine.warmup(spec.input_size)
+    except Exception as e:
+        status.put(('failed', str(e)))
+        return
+
+    size, wait = config['INFERENCE_BATCH_SIZE'], config['INFERENCE_BATCH_TIMEOUT_MS']
+    max_queue = config['INFERENCE_MAX_QUEUE']
+    batchers = {op: MicroBatcher(batch_runner(engine, op), size, wait, max_queue)
+                for op in ('predict', 'explain', 'predict_and_explain')}
+    status.put(('ready', {"pid": os.getpid(), "model": spec.key, "conv_layer": engine.last_conv_layer_name,
+                          "backend": engine.name}))
+
+    def respond(worker, request_id, slot, future):
+        if slot >= 0:
+            pool.free.put(slot)
+        try:
+            responses[worker].put((request_id, future.result(), None))
+        except Exception as e:
+            responses[worker].put((request_id, None, _error_message(e)))
+
+    while True:
+        message = requests.get()
+        if message is None:
+            break
+        worker, request_id, op, slot, expires_at = message
+        if op == 'stats':
+            stats = {name: batcher.stats() for name, batcher in batchers.items()}
+            stats["backend"] = engine.stats()
+            responses[worker].put((request_id, stats, None))
+            continue
+        deadline = Deadline(expires_at) if expires_at is not None else None
+        try:
+            future = batchers[op].submit(pool.views[slot], deadline)
+        except Overloaded as e:
+            pool.free.put(slot)
+            responses[worker].put((request_id, None, _error_message(e)))
+            continue
+        future.add_done_callback(lambda f, w=worker, r=request_id, s=slot: respond(w, r, s, f))
+
+    for batcher in batchers.values():
+        batcher.close()
+
+
+# Load-shedding errors keep their type across the process boundary
+_ERROR_TYPES = {'deadline': DeadlineExceeded, 'overloaded': Overloaded}
+
+
+def _error_message(e):
+    if isinstance(e, DeadlineExceeded):
+        return ('deadline', str(e))
+    if isinstance(e, Overloaded):
+        return ('overloaded', str(e))
+    return (None, str(e))
+
+
+class InferenceClient:
+    """
+    Worker-side handle on the inference process.
+
+    A dispatcher thread reads this worker's response queue and resolves the
+    Future of whichever request thread is waiting on it.
+    """
+
+    def __init__(self, pool, requests, responses, worker_index):
+        self.pool = pool
+        self.requests = requests
+        self.responses = responses
+        self.worker_index = worker_index
+        self._ids = itertools.count()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._dispatcher = None
+
+    def submit(self, op, image=None, slot_timeout=30.0, deadline=None):
+        if self._dispatcher is None:
+            with self._lock:
+                if self._dispatcher is None:
+                    self._dispatcher = threading.Thread(target=self._dispatch, name='inference-client', daemon=True)
+                    self._dispatcher.start()
+
+        if deadline is not None:
+            deadline.check()
+        slot = -1
+        if image is not None:
+            image = np.asarray(image, dtype=np.float32)
+            if image.shape != self.pool.input_shape:
+                raise ValueError(f"Expected input of shape {self.pool.input_shape}, got {image.shape}")
+            if deadline is not None:
+                slot_timeout = max(0.0, min(slot_timeout, deadline.remaining()))
+            try:
+                slot = self.pool.free.get(timeout=slot_timeout)
+            except queue.Empty:
+                if deadline is not None and deadline.expired():
+                    raise DeadlineExceeded("Deadline passed while waiting for an inference slot")
+                raise Overloaded("No free inference slots")
+            np.copyto(self.pool.views[slot], image)
+
+        future = Future()
+        future.set_running_or_notify_cancel()
+        request_id = next(self._ids)
+        with self._lock:
+            self._pending[request_id] = future
+        expires_at = deadline.expires_at if deadline is not None else None
+        self.requests.put((self.worker_index, request_id, op, slot, expires_at))
+        return future
+
+    def batcher(self, op):
+        return RemoteBatcher(self, op)
+
+    def _dispatch(self):
+        while True:
+            request_id, result, error = self.responses.get()
+            with self._lock:
+                future = self._pending.pop(request_id, None)
+            if future is None:
+                continue
+            if error is not None:
+                kind, message = error
+                future.set_exception(_ERROR_TYPES.get(kind, RuntimeError)(message))
+            else:
+                future.set_result(result)
+
+
+class RemoteBatcher:
+    """
+    MicroBatcher stand-in that forwards to the shared inference process,
+    where requests from every worker are batched together.
+    """
+
+    def __init__(self, client, op):
+        self.client = client
+        self.op = op
+
+    def submit(self, image, deadline=None):
+        return self.client.submit(self.op, image, deadline=deadline)
+
+    def submit_many(self, images, deadline=None, explain=None):
+        """
+        MicroBatcher.submit_many over the inference process: the images are
+        sent one per slot (those past `explain` classification only) and
+        the Future resolves to their stacked outputs.
+        """
+        futures = []
+        for i, image in enumerate(images):
+            op = 'predict' if explain is not None and i >= explain and self.op == 'predict_and_explain' else self.op
+            futures.append(self.client.submit(op, image, deadline=deadline))
+        group = Future()
+        group.set_running_or_notify_cancel()
+        lock = threading.Lock()
+        pending = [len(futures)]
+
+        def gathered(_):
+            # Runs once per image, on whichever thread resolved it; the last
+            # one resolves the group
+            with lock:
+                pending[0] -= 1
+                if pending[0]:
+                    return
+            try:
+                results = [future.result() for future in futures]
+            except Exception as e:
+                group.set_exception(e)
+                return
+            outputs = []
+            for j in range(len(results[0])):
+                parts = [result[j] for result in results]
+                if all(part is None for part in parts):
+                    outputs.append(None)
+                    continue
+                shape = next(np.shape(part) for part in parts if part is not None)
+                outputs.append(np.stack([np.zeros(shape, np.float32) if part is None else part for part in parts]))
+            group.set_result(tuple(outputs))
+
+        for future in futures:
+            future.add_done_callback(gathered)
+        return group
+
+    def queue_depth(self):
+        # The shared queue is in the inference process; local admission
+        # control still sees this worker's backlog
+        return 0
+
+    def stats(self):
+        stats = self.client.submit('stats').result(timeout=10)
+        return {"remote": True, **stats[self.op], "backend": stats["backend"]}
+
+    def close(self):
+        pass
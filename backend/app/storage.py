@@ -0,0 +1,129 @@
+"""
+Content-addressed file storage.
+
+Files are named by the SHA-256 of their bytes and kept in two levels of
+hash-prefix subdirectories (`ab/cd/abcd...jpg`), so no single directory
+grows past a few hundred entries. Writes go through a temp file and an
+atomic rename; a name that already exists is never rewritten.
+"""
+import hashlib
+import os
+import tempfile
+
+from .preprocess import image_extension
+
+CHUNK_SIZE = 1 << 16
+
+# Enough of the file to sniff its type from the magic bytes (DICOM's sit
+# after a 128-byte preamble)
+SNIFF_BYTES = 132
+
+
+def shard_path(folder, name):
+    """
+    Sharded location of `name` (which must start with at least 4 hex chars).
+    """
+    return os.path.join(folder, name[:2], name[2:4], name)
+
+
+def is_content_name(name):
+    stem = os.path.splitext(name)[0]
+    return len(stem) == 64 and all(c in '0123456789abcdef' for c in stem) and '/' not in name
+
+
+def write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class ContentStore:
+    """
+    Sharded, deduplicating store for uploads.
+
+    Stored names are `<sha256><ext>`. Files written before sharding (flat
+    in `folder`, possibly uuid-named) are still found by `resolve`.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.tmp_folder = os.path.join(folder, '.tmp')
+        os.makedirs(self.tmp_folder, exist_ok=True)
+
+    def path_for(self, name):
+        return shard_path(self.folder, name)
+
+    def resolve(self, name):
+        """
+        Absolute path of a stored name, or None if it does not exist.
+        """
+        if is_content_name(name):
+            path = self.path_for(name)
+            if os.path.isfile(path):
+                return path
+        # Flat layout from before sharding
+        path = os.path.join(self.folder, name)
+        if '/' not in name and '\\' not in name and not name.startswith('.') and os.path.isfile(path):
+            return path
+        return None
+
+    def exists(self, name):
+        return self.resolve(name) is not None
+
+    def save_stream(self, stream, chunk_size=CHUNK_SIZE):
+        """
+        Copy a file-like object into the store in chunks while hashing it.
+
+        Returns (name, digest, created); `created` is False when the same
+        bytes were already stored.
+        """
+        hasher = hashlib.sha256()
+        head = b''
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_folder, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    if len(head) < SNIFF_BYTES:
+                        head += chunk[:SNIFF_BYTES - len(head)]
+                    hasher.update(chunk)
+                    f.write(chunk)
+            digest = hasher.hexdigest()
+            name = digest + image_extension(head)
+            return name, digest, self._commit(tmp_path, name)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def save_bytes(self, data, digest=None):
+        """
+        Store an in-memory upload; returns (name, digest, created).
+        """
+        digest = digest or hashlib.sha256(data).hexdigest()
+        name = digest + image_extension(data)
+        if os.path.exists(self.path_for(name)):
+            return name, digest, False
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_folder, suffix='.part')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return name, digest, self._commit(tmp_path, name)
+
+    def _commit(self, tmp_path, name):
+        path = self.path_for(name)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        return True
+
+    def discard(self, name):
+        try:
+            os.remove(self.path_for(name))
+        except FileNotFoundError:
+            pass
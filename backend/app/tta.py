@@ -0,0 +1,107 @@
+"""
+Test-time augmentation (TTA): score an upload as several augmented views
+and average them.
+
+All views of an image are produced in one vectorised resampling step from
+its preprocessed tensor (`augment`), so they are batched into a single
+forward pass like concurrent uploads. `aggregate` averages the class
+probabilities; their variance across views is the uncertainty signal.
+"""
+import functools
+
+import cv2
+import numpy as np
+
+MAX_VIEWS = 12
+
+
+class TTAConfig:
+    """
+    Which views to score: `views` of the flip x rotation x crop
+    combinations, the unaugmented image first (see `transforms`).
+    """
+
+    def __init__(self, views=8, rotation=10.0, crop=0.9):
+        if not 2 <= views <= MAX_VIEWS:
+            raise ValueError(f"TTA views must be between 2 and {MAX_VIEWS}")
+        if not 0.0 < crop <= 1.0:
+            raise ValueError("TTA crop must be in (0, 1]")
+        self.views = views
+        self.rotation = rotation
+        self.crop = crop
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['TTA_VIEWS'], config['TTA_ROTATION_DEGREES'], config['TTA_CROP'])
+
+    @property
+    def identity(self):
+        """
+        Suffix for prediction cache keys: TTA results differ from single-view ones.
+        """
+        return f"tta:{self.views}:{self.rotation:g}:{self.crop:g}"
+
+    def transforms(self):
+        """
+        (flip, degrees, scale) per view, the identity first, then its mirror,
+        rotations either way and the same on a central crop.
+        """
+        combinations = [(flip, angle, scale)
+                        for scale in (1.0, self.crop)
+                        for angle in (0.0, self.rotation, -self.rotation)
+                        for flip in (False, True)]
+        return combinations[:self.views]
+
+
+@functools.lru_cache(maxsize=16)
+def _view_maps(transforms, height, width):
+    """
+    Source coordinates of every output pixel of every view, stacked into
+    one (views * H, W) pair of fixed-point remap tables.
+    """
+    flips = np.array([flip for flip, _, _ in transforms])
+    angles = np.radians([angle for _, angle, _ in transforms]).astype(np.float32)
+    scales = np.array([scale for _, _, scale in transforms], np.float32)
+
+    # Output pixel -> source pixel, about the image centre, for all views at once
+    cy, cx = (height - 1) / 2, (width - 1) / 2
+    v, u = np.mgrid[0:height, 0:width].astype(np.float32)
+    u, v = u - cx, v - cy
+    cos = (np.cos(angles) * scales)[:, None, None]
+    sin = (np.sin(angles) * scales)[:, None, None]
+    src_x = cos * u - sin * v
+    src_y = sin * u + cos * v + cy
+    src_x = np.where(flips[:, None, None], -src_x, src_x) + cx
+    return cv2.convertMaps(src_x.reshape(-1, width), src_y.reshape(-1, width), cv2.CV_16SC2)
+
+
+def augment(image, transforms, out=None):
+    """
+    Resample an (H, W, C) float image into one view per transform, shaped
+    (len(transforms), H, W, C).
+
+    Views are rotated about the centre, mirrored left-right and zoomed in
+    by 1/scale, with bilinear sampling. Edge pixels are repeated past the
+    border, so rotations don't bring in a fill colour the model never saw.
+    The sampling tables depend only on the transforms and image size and
+    are cached, so a request costs a single remap of all views.
+    """
+    height, width, channels = image.shape
+    if out is None:
+        out = np.empty((len(transforms), height, width, channels), np.float32)
+    if not transforms:
+        return out
+    map1, map2 = _view_maps(tuple(transforms), height, width)
+    cv2.remap(image, map1, map2, cv2.INTER_LINEAR, dst=out.reshape(-1, width, channels),
+              borderMode=cv2.BORDER_REPLICATE)
+    return out
+
+
+def aggregate(scores):
+    """
+    Mean class probabilities over views and the variance of the winning
+    class across them: (mean, variance).
+    """
+    scores = np.asarray(scores, np.float32)
+    mean = scores.mean(axis=0)
+    return mean, float(scores[:, int(mean.argmax())].var())
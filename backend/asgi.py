@@ -0,0 +1,9 @@
+"""
+ASGI entry point: the app run.py serves, with uploads received without
+blocking a thread and auth/history served natively (see app/asgi.py).
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+"""
+from app.asgi import create_asgi_app
+
+app = create_asgi_app()
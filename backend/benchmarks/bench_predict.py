@@ -0,0 +1,306 @@
+"""
+Prediction hot-path benchmark, runnable offline.
+
+Boots the app on a locally built stub classifier (benchmarks.fixtures)
+and synthetic scans, then:
+
+- times each stage of a /api/predict request separately for every image
+  size: store, decode, resize_normalize, predict, gradcam, interpret,
+  overlay, db_commit and json;
+- drives /api/predict with concurrent clients, through the Flask test
+  client or against a running server (`--url`), and reports latency
+  percentiles and throughput.
+
+With `--baseline` the report includes the change against an earlier run,
+and stages or load figures worse by more than `--tolerance` are listed as
+regressions.
+
+    python -m benchmarks.bench_predict --sizes 1024x768,3000x2400 --output predict.json
+    python -m benchmarks.bench_predict --baseline predict.json --output predict-new.json
+"""
+import argparse
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+import numpy as np
+
+from benchmarks.fixtures import encode, parse_sizes, save_stub_model, synthetic_scan
+from benchmarks.http_load import multipart_body, percentiles, run_load, wait_ready
+from config import Config
+
+STAGES = ('store', 'decode', 'resize_normalize', 'predict', 'gradcam', 'interpret', 'overlay', 'db_commit', 'json')
+
+
+def bench_config(tmp, model_path, args):
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        UPLOAD_FOLDER = os.path.join(tmp, 'uploads')
+        GRADCAM_FOLDER = os.path.join(tmp, 'gradcam')
+        GRADCAM_VARIANT_FOLDER = os.path.join(tmp, 'gradcam_variants')
+        PREDICTION_CACHE_PATH = os.path.join(tmp, 'prediction_cache.db')
+        PERSIST_SPOOL_FOLDER = os.path.join(tmp, 'spool')
+        MODEL_PATH = model_path
+        MODEL_REGISTRY_DIR = os.path.join(tmp, 'registry')
+        EMBEDDING_FOLDER = os.path.join(tmp, 'embeddings')
+        MODEL_REGISTRY_POLL_SECONDS = 0
+        MODEL_INPUT_SIZE = args.input_size
+        MODEL_LOADING = 'eager'
+        INFERENCE_BACKEND = args.backend
+        # Every request must reach the model, not the prediction cache
+        PREDICTION_CACHE_ENABLED = False
+        GRADCAM_ASYNC = not args.sync_gradcam
+    return BenchConfig
+
+
+def summarize(seconds):
+    ordered = sorted(seconds)
+    return {
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+        **{name: round(value * 1000, 3) for name, value in percentiles(ordered, (50, 95)).items()},
+    }
+
+
+def time_stages(app, img_bytes, repeat):
+    """
+    Per-stage latency of one prediction, done step by step with the
+    functions the request path uses. The stored upload is removed after
+    each run so `store` always writes.
+    """
+    from app import main
+    from app.heatmaps import OverlayParams, render_overlay
+    from app.preprocess import decode_file, resize_normalize
+    from flask import jsonify
+
+    input_size = app.config['MODEL_INPUT_SIZE']
+    entry = main.registry.active()
+    engine = entry.engine
+    out = np.empty((input_size, input_size, 3), np.float32)
+    timings = {stage: [] for stage in STAGES}
+
+    # The first run warms caches and is not recorded
+    for run in range(repeat + 1):
+        marks = []
+        started = time.perf_counter()
+
+        def mark(stage):
+            nonlocal started
+            now = time.perf_counter()
+            marks.append((stage, now - started))
+            started = now
+
+        name, _, _ = main.upload_store.save_bytes(img_bytes)
+        mark('store')
+        img = decode_file(main.upload_store.path_for(name), input_size)
+        mark('decode')
+        _, tensor = resize_normalize(img, input_size, out)
+        mark('resize_normalize')
+        prediction = engine.predict(tensor[np.newaxis])
+        mark('predict')
+        heatmap = engine.explain(tensor[np.newaxis])
+        mark('gradcam')
+        with app.test_request_context('/api/predict', method='POST'):
+            row, differential = main._build_prediction(entry, name, prediction[0], heatmap[0], None,
+                                                       gradcam_name=f"{name}.jpg")
+            mark('interpret')
+            # With GRADCAM_CLASSES > 1 each image has a stack, top class first
+            render_overlay(heatmap[0] if heatmap[0].ndim == 2 else heatmap[0][0], img, OverlayParams())
+            mark('overlay')
+            main.persister.add(row)
+            main.persister.sync()
+            mark('db_commit')
+            jsonify(main._prediction_response(row, differential)).get_data()
+            mark('json')
+
+        main.upload_store.discard(name)
+        if run:
+            for stage, seconds in marks:
+                timings[stage].append(seconds)
+
+    stages = {stage: summarize(seconds) for stage, seconds in timings.items()}
+    stages["total"] = summarize([sum(parts) for parts in zip(*timings.values())])
+    return stages
+
+
+def run_test_client_load(app, images, concurrency, duration):
+    """
+    Like http_load.run_load, through the Flask test client in this process.
+    """
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def client(index):
+        test_client = app.test_client()
+        local, local_statuses = [], {}
+        n = index
+        while time.monotonic() < stop_at:
+            image = images[n % len(images)]
+            n += concurrency
+            started = time.perf_counter()
+            response = test_client.post('/api/predict', data={'image': (io.BytesIO(image), 'scan.jpg')},
+                                        content_type='multipart/form-data')
+            response.get_data()
+            local.append(time.perf_counter() - started)
+            local_statuses[response.status_code] = local_statuses.get(response.status_code, 0) + 1
+        with lock:
+            latencies.extend(local)
+            for status, count in local_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - started
+    return {
+        "latencies": latencies,
+        "statuses": statuses,
+        "elapsed": elapsed,
+        "requests_per_second": len(latencies) / elapsed if elapsed else 0.0,
+    }
+
+
+def run_server_load(url, image, concurrency, duration):
+    parts = urlsplit(url)
+    host, port = parts.hostname, parts.port or 80
+    if not wait_ready(host, port, timeout=60):
+        raise RuntimeError(f"{url} never became ready")
+    body, content_type = multipart_body('image', 'scan.jpg', image, 'image/jpeg')
+    return run_load(host, port, parts.path or '/api/predict', body, content_type, concurrency, duration)
+
+
+def load_report(result, concurrency, target):
+    return {
+        "target": target,
+        "concurrency": concurrency,
+        "requests": len(result["latencies"]),
+        "requests_per_second": round(result["requests_per_second"], 2),
+        "latency_ms": {name: None if value is None else round(value * 1000, 3)
+                       for name, value in percentiles(result["latencies"]).items()},
+        "statuses": {str(k): v for k, v in result["statuses"].items()},
+    }
+
+
+def compare_to_baseline(report, baseline, tolerance):
+    """
+    Relative change of each stage mean and of the load figures; positive
+    means slower (or, for throughput, lower).
+    """
+    changes, regressions = {}, []
+    old_sizes = {run["size"]: run for run in baseline.get("stages", [])}
+    for run in report["stages"]:
+        old = old_sizes.get(run["size"])
+        if old is None:
+            continue
+        for stage, figures in run["stages"].items():
+            before = old["stages"].get(stage, {}).get("mean_ms")
+            if not before:
+                continue
+            change = figures["mean_ms"] / before - 1
+            changes[f"{run['size']}/{stage}"] = round(change, 4)
+            if change > tolerance:
+                regressions.append(f"{run['size']}/{stage}")
+
+    old_load, new_load = baseline.get("load"), report.get("load")
+    if old_load and new_load and old_load["requests_per_second"]:
+        change = 1 - new_load["requests_per_second"] / old_load["requests_per_second"]
+        changes["load/requests_per_second"] = round(change, 4)
+        if change > tolerance:
+            regressions.append("load/requests_per_second")
+        for name, before in old_load["latency_ms"].items():
+            after = new_load["latency_ms"].get(name)
+            if before and after is not None:
+                change = after / before - 1
+                changes[f"load/{name}"] = round(change, 4)
+                if change > tolerance:
+                    regressions.append(f"load/{name}")
+    return {"tolerance": tolerance, "changes": changes, "regressions": regressions}
+
+
+def run(args, tmp):
+    """
+    Stage timings and load figures for an app whose files all live in `tmp`.
+    """
+    model_path = args.model_path or save_stub_model(os.path.join(tmp, 'stub_model.keras'), input_size=args.input_size)
+
+    from app import create_app, main as app_main
+    app = create_app(bench_config(tmp, os.path.abspath(model_path), args))
+    if app_main.registry.active() is None:
+        sys.exit(f"Model {model_path} could not be loaded")
+
+    rng = np.random.default_rng(0)
+    stage_runs = []
+    for width, height in parse_sizes(args.sizes):
+        img_bytes = encode(synthetic_scan(rng, width, height))
+        stages = time_stages(app, img_bytes, args.repeat)
+        stage_runs.append({"size": f"{width}x{height}", "upload_bytes": len(img_bytes), "stages": stages})
+        print(f"{width}x{height}: " + ', '.join(f"{stage} {figures['mean_ms']:.1f}"
+                                                for stage, figures in stages.items()) + ' ms', file=sys.stderr)
+
+    report = {
+        "model_path": args.model_path or 'stub',
+        "backend": args.backend,
+        "repeat": args.repeat,
+        "stages": stage_runs,
+        "load": None,
+    }
+
+    if args.duration > 0:
+        width, height = parse_sizes(args.load_size)[0]
+        # Distinct uploads, so storage dedup doesn't shortcut the load
+        images = [encode(synthetic_scan(rng, width, height)) for _ in range(max(8, args.concurrency * 2))]
+        if args.url:
+            result = run_server_load(args.url, images[0], args.concurrency, args.duration)
+        else:
+            result = run_test_client_load(app, images, args.concurrency, args.duration)
+        report["load"] = load_report(result, args.concurrency, args.url or 'test_client')
+        print(f"load: {report['load']['requests_per_second']} req/s, latency {report['load']['latency_ms']}",
+              file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["baseline"] = compare_to_baseline(report, json.load(f), args.tolerance)
+        if report["baseline"]["regressions"]:
+            print(f"regressions: {', '.join(report['baseline']['regressions'])}", file=sys.stderr)
+
+    app_main.persister.close()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model-path', help='Keras model to benchmark (default: a stub built offline)')
+    parser.add_argument('--backend', default='keras', help='INFERENCE_BACKEND to load')
+    parser.add_argument('--input-size', type=int, default=224)
+    parser.add_argument('--sizes', default='1024x768,2048x1536,3000x2400')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--load-size', default='2048x1536')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds of load (0 skips it)')
+    parser.add_argument('--url', help='Drive a running server instead, e.g. http://127.0.0.1:5000/api/predict')
+    parser.add_argument('--sync-gradcam', action='store_true', help='Render Grad-CAM on the request path')
+    parser.add_argument('--baseline', help='Earlier --output to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='medvisor-bench-predict-') as tmp:
+        report = run(args, tmp)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Upload preprocessing benchmark.
+
+Compares the original path (full-resolution decode, JPEG re-encode for
+storage, resize, float cast) with app.preprocess (reduced decode, verbatim
+storage, fused resize+normalise into a reused buffer) on synthetic scans.
+
+    python -m benchmarks.bench_preprocess --sizes 1024x768,4000x3000 --output preprocess.json
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from app.preprocess import decode, resize_normalize
+from benchmarks.fixtures import encode, parse_sizes, synthetic_scan
+
+
+def legacy(img_bytes, path):
+    img = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_COLOR)
+    cv2.imwrite(path, img)
+    img_resized = cv2.resize(img, (224, 224))
+    return img_resized.astype(np.float32) / 127.5 - 1.0
+
+
+def optimized(img_bytes, path, out):
+    img = decode(img_bytes, 224)
+    with open(path, 'wb') as f:
+        f.write(img_bytes)
+    return resize_normalize(img, 224, out)[1]
+
+
+def time_it(fn, repeat):
+    fn()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - started) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1024x768,2048x1536,4000x3000')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    tmp = tempfile.mkdtemp(prefix='medvisor-preprocess-')
+    out = np.empty((224, 224, 3), np.float32)
+    results = []
+    for width, height in parse_sizes(args.sizes):
+        size = f"{width}x{height}"
+        img_bytes = encode(synthetic_scan(rng, width, height))
+        path = os.path.join(tmp, 'upload.jpg')
+
+        legacy_s = time_it(lambda: legacy(img_bytes, path), args.repeat)
+        optimized_s = time_it(lambda: optimized(img_bytes, path, out), args.repeat)
+        results.append({
+            "size": size,
+            "upload_bytes": len(img_bytes),
+            "legacy_ms": round(legacy_s * 1000, 2),
+            "optimized_ms": round(optimized_s * 1000, 2),
+            "speedup": round(legacy_s / optimized_s, 2),
+        })
+        print(f"{size}: {legacy_s * 1000:.1f} ms -> {optimized_s * 1000:.1f} ms", file=sys.stderr)
+
+    report = {"repeat": args.repeat, "runs": results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Startup-time benchmark.
+
+Boots the app in a fresh interpreter for each MODEL_LOADING mode and reports
+how long it takes until auth requests are served and until /api/ready
+reports the model ready for predictions.
+
+    python -m benchmarks.bench_startup --model-path models/model.h5 --output startup.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = r'''
+import json, os, sys, tempfile, time
+started = time.monotonic()
+sys.path.insert(0, {backend_dir!r})
+from config import Config
+
+tmp_dir = tempfile.TemporaryDirectory(prefix="medvisor-startup-", ignore_cleanup_errors=True)
+tmp = tmp_dir.name
+class BenchConfig(Config):
+    SQLALCHEMY_DATABASE_URI = "sqlite://"
+    UPLOAD_FOLDER = os.path.join(tmp, "uploads")
+    GRADCAM_FOLDER = os.path.join(tmp, "gradcam")
+    GRADCAM_VARIANT_FOLDER = os.path.join(tmp, "gradcam_variants")
+    PREDICTION_CACHE_PATH = os.path.join(tmp, "prediction_cache.db")
+    PERSIST_SPOOL_FOLDER = os.path.join(tmp, "spool")
+    MODEL_REGISTRY_DIR = os.path.join(tmp, "registry")
+    EMBEDDING_FOLDER = os.path.join(tmp, "embeddings")
+    MODEL_LOADING = {mode!r}
+    MODEL_WARMUP = {warmup!r}
+    if {model_path!r}:
+        MODEL_PATH = {model_path!r}
+
+from app import create_app
+app = create_app(BenchConfig)
+client = app.test_client()
+app_created = time.monotonic() - started
+
+response = client.post("/api/auth/login", json={{"username": "nobody", "password": "x"}})
+assert response.status_code == 401, response.status_code
+auth_ready = time.monotonic() - started
+tensorflow_at_auth_ready = "tensorflow" in sys.modules
+
+deadline = time.monotonic() + {timeout!r}
+ready = None
+while time.monotonic() < deadline:
+    response = client.get("/api/ready")
+    if response.status_code == 200:
+        ready = time.monotonic() - started
+        break
+    if response.get_json()["model_state"] == "failed":
+        break
+    time.sleep(0.01)
+
+print(json.dumps({{
+    "mode": {mode!r},
+    "app_created_seconds": app_created,
+    "auth_ready_seconds": auth_ready,
+    "predict_ready_seconds": ready,
+    "tensorflow_imported_at_auth_ready": tensorflow_at_auth_ready,
+    "model_timings": client.get("/api/ready").get_json()["timings"],
+}}))
+tmp_dir.cleanup()
+'''
+
+
+def run_mode(mode, model_path, warmup, timeout):
+    code = CHILD.format(backend_dir=BACKEND_DIR, mode=mode, model_path=model_path, warmup=warmup, timeout=timeout)
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, cwd=BACKEND_DIR)
+    if result.returncode != 0:
+        raise RuntimeError(f"{mode} startup failed:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model-path', help='Keras model to load (defaults to Config.MODEL_PATH)')
+    parser.add_argument('--modes', default='eager,background,lazy')
+    parser.add_argument('--no-warmup', action='store_true')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--timeout', type=float, default=300.0)
+    parser.add_argument('--output', help='Write JSON results to this file')
+    args = parser.parse_args()
+
+    results = []
+    for mode in args.modes.split(','):
+        for _ in range(args.repeat):
+            run = run_mode(mode, args.model_path, not args.no_warmup, args.timeout)
+            results.append(run)
+            predict_ready = run['predict_ready_seconds']
+            predict_ready = 'never' if predict_ready is None else f"{predict_ready:.2f}s"
+            print(f"{mode:>10}: auth ready {run['auth_ready_seconds']:.2f}s, predict ready {predict_ready}",
+                  file=sys.stderr)
+
+    report = {"model_path": args.model_path, "warmup": not args.no_warmup, "runs": results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Test-time augmentation benchmark, runnable offline.
+
+For each view count, times scoring one preprocessed scan as that many
+views: augmenting them in one step (app.tta) and scoring them in one
+batch, against the naive loop of one augmentation and one predict call
+per view. Reports latency and the overhead over a single-view prediction.
+
+    python -m benchmarks.bench_tta --views 1,2,4,8,12 --output tta.json
+"""
+import argparse
+import json
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from app import tta
+from benchmarks.fixtures import build_stub_model, synthetic_scan
+
+
+def time_it(fn, repeat):
+    fn()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - started) / repeat
+
+
+def batched(engine, tensor, transforms):
+    views = tta.augment(tensor, transforms[1:])
+    return tta.aggregate(engine.predict(np.concatenate([tensor[None], views])))
+
+
+def naive(engine, tensor, transforms):
+    height, width = tensor.shape[:2]
+    scores = []
+    for flip, angle, scale in transforms:
+        matrix = cv2.getRotationMatrix2D(((width - 1) / 2, (height - 1) / 2), angle, 1 / scale)
+        view = cv2.warpAffine(tensor, matrix, (width, height), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        view = view[:, ::-1] if flip else view
+        scores.append(engine.predict(view[None])[0])
+    return tta.aggregate(scores)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model-path', help='Keras model to benchmark (default: a stub built offline)')
+    parser.add_argument('--input-size', type=int, default=224)
+    parser.add_argument('--views', default='1,2,4,8,12')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    from app.inference import InferenceEngine
+    from app.preprocess import resize_normalize
+    from app.utils import load_model_safe
+
+    if args.model_path:
+        model, last_conv_layer_name = load_model_safe(args.model_path)
+    else:
+        model, last_conv_layer_name = build_stub_model(args.input_size), 'last_conv'
+    engine = InferenceEngine(model, last_conv_layer_name)
+    engine.warmup(args.input_size)
+
+    scan = synthetic_scan(np.random.default_rng(0), 1024, 768)
+    tensor = resize_normalize(scan, args.input_size)[1]
+    single_s = time_it(lambda: engine.predict(tensor[None]), args.repeat)
+
+    results = []
+    for count in (int(v) for v in args.views.split(',')):
+        transforms = tta.TTAConfig(max(count, 2)).transforms()[:count]
+        augment_s = time_it(lambda: tta.augment(tensor, transforms[1:]), args.repeat)
+        batched_s = time_it(lambda: batched(engine, tensor, transforms), args.repeat)
+        naive_s = time_it(lambda: naive(engine, tensor, transforms), args.repeat)
+        results.append({
+            "views": count,
+            "augment_ms": round(augment_s * 1000, 2),
+            "batched_ms": round(batched_s * 1000, 2),
+            "naive_ms": round(naive_s * 1000, 2),
+            "overhead": round(batched_s / single_s, 2),
+            "speedup": round(naive_s / batched_s, 2),
+        })
+        print(f"{count} views: {naive_s * 1000:.1f} ms -> {batched_s * 1000:.1f} ms "
+              f"({batched_s / single_s:.2f}x single view)", file=sys.stderr)
+
+    report = {"input_size": args.input_size, "repeat": args.repeat,
+              "single_view_ms": round(single_s * 1000, 2), "runs": results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
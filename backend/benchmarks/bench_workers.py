@@ -0,0 +1,143 @@
+"""
+Pre-fork serving benchmark.
+
+Starts serve.py with an increasing number of HTTP workers and reports
+requests/sec, latency percentiles and total RSS (inference process plus
+workers) for each worker count.
+
+    python -m benchmarks.bench_workers --workers 1,2,4 --model-path models/model.h5 --output workers.json
+"""
+import argparse
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from benchmarks.http_load import multipart_body, percentiles, run_load, wait_ready
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def process_tree_rss(root_pid):
+    """
+    Total resident set size in bytes of a process and all its descendants.
+    """
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    total, stack = 0, [root_pid]
+    while stack:
+        pid = stack.pop()
+        stack.extend(children.get(pid, []))
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+def bench(workers, args, image_bytes):
+    tmp = tempfile.mkdtemp(prefix='medvisor-bench-workers-')
+    # Everything the server writes stays under tmp: a spool left in
+    # instance/ would be replayed into the real database on the next start
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+        PREDICTION_CACHE_PATH=os.path.join(tmp, 'prediction_cache.db'),
+        UPLOAD_FOLDER=os.path.join(tmp, 'uploads'),
+        GRADCAM_FOLDER=os.path.join(tmp, 'gradcam'),
+        GRADCAM_VARIANT_FOLDER=os.path.join(tmp, 'gradcam_variants'),
+        PERSIST_SPOOL_FOLDER=os.path.join(tmp, 'spool'),
+        EMBEDDING_FOLDER=os.path.join(tmp, 'embeddings'),
+        MODEL_REGISTRY_DIR=os.path.join(tmp, 'registry'),
+        # Every request must reach the model, not the prediction cache
+        PREDICTION_CACHE_ENABLED='false',
+    )
+    if args.model_path:
+        env['MODEL_PATH'] = os.path.abspath(args.model_path)
+
+    try:
+        server = subprocess.Popen(
+            [sys.executable, 'serve.py', '--workers', str(workers), '--port', str(args.port), '--host', '127.0.0.1'],
+            cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True
+        )
+        try:
+            if not wait_ready('127.0.0.1', args.port, timeout=args.timeout):
+                raise RuntimeError(f"serve.py with {workers} workers never became ready")
+            idle_rss = process_tree_rss(server.pid)
+
+            body, content_type = multipart_body('image', 'bench.png', image_bytes, 'image/png')
+            result = run_load('127.0.0.1', args.port, args.path, body, content_type, args.concurrency, args.duration)
+            loaded_rss = process_tree_rss(server.pid)
+        finally:
+            os.killpg(server.pid, signal.SIGTERM)
+            server.wait(timeout=30)
+            time.sleep(0.5)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    return {
+        "workers": workers,
+        "concurrency": args.concurrency,
+        "requests": len(result["latencies"]),
+        "requests_per_second": result["requests_per_second"],
+        "latency_seconds": percentiles(result["latencies"]),
+        "statuses": {str(k): v for k, v in result["statuses"].items()},
+        "rss_idle_bytes": idle_rss,
+        "rss_loaded_bytes": loaded_rss,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', default='1,2,4')
+    parser.add_argument('--model-path')
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--path', default='/api/predict')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=15.0)
+    parser.add_argument('--image-size', type=int, default=1024)
+    parser.add_argument('--timeout', type=float, default=300.0)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 255, (args.image_size, args.image_size, 3), dtype=np.uint8)
+    image_bytes = cv2.imencode('.png', image)[1].tobytes()
+
+    results = []
+    for workers in [int(w) for w in args.workers.split(',')]:
+        run = bench(workers, args, image_bytes)
+        results.append(run)
+        print(f"{workers} workers: {run['requests_per_second']:.1f} req/s, "
+              f"p95 {run['latency_seconds']['p95']}, RSS {run['rss_loaded_bytes'] / 2**20:.0f} MiB",
+              file=sys.stderr)
+
+    report = {"model_path": args.model_path, "runs": results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Offline stand-ins for the benchmarks: a small Keras classifier shaped like
+the real one and synthetic scans of realistic sizes.
+
+    python -m benchmarks.fixtures --output /tmp/stub_model.keras
+"""
+import argparse
+
+import cv2
+import numpy as np
+
+STUB_CONV_LAYER = 'last_conv'
+
+
+def build_stub_model(input_size=224, num_classes=1000, width=32, seed=0):
+    """
+    A strided conv stack ending in a conv layer named STUB_CONV_LAYER, then
+    global pooling and a softmax head, so Grad-CAM finds the same kind of
+    (7x7 at 224) feature map it does on MobileNetV2. Weights are random but
+    seeded, so runs are comparable.
+    """
+    import tensorflow as tf
+
+    tf.keras.utils.set_random_seed(seed)
+    inputs = tf.keras.Input(shape=(input_size, input_size, 3))
+    x = inputs
+    for i, filters in enumerate((width, width * 2, width * 4, width * 8)):
+        x = tf.keras.layers.Conv2D(filters, 3, strides=2, padding='same', activation='relu', name=f'conv_{i}')(x)
+    x = tf.keras.layers.Conv2D(width * 8, 3, strides=2, padding='same', activation='relu', name=STUB_CONV_LAYER)(x)
+    x = tf.keras.layers.GlobalAveragePooling2D()(x)
+    outputs = tf.keras.layers.Dense(num_classes, activation='softmax', name='predictions')(x)
+    return tf.keras.Model(inputs, outputs, name='stub_classifier')
+
+
+def save_stub_model(path, **kwargs):
+    model = build_stub_model(**kwargs)
+    model.save(path)
+    return path
+
+
+def synthetic_scan(rng, width, height):
+    """
+    BGR image with smooth content, so encoded sizes resemble real scans
+    rather than noise.
+    """
+    coarse = rng.integers(0, 255, (max(1, height // 16), max(1, width // 16), 3), dtype=np.uint8)
+    return cv2.resize(coarse, (width, height))
+
+
+def encode(image, ext='.jpg', quality=92):
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality] if ext in ('.jpg', '.jpeg') else []
+    return cv2.imencode(ext, image, params)[1].tobytes()
+
+
+def parse_sizes(sizes):
+    """
+    '1024x768,2048x1536' -> [(1024, 768), (2048, 1536)]
+    """
+    return [tuple(int(v) for v in size.split('x')) for size in sizes.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', required=True, help='Where to save the model (.keras or .h5)')
+    parser.add_argument('--input-size', type=int, default=224)
+    parser.add_argument('--classes', type=int, default=1000)
+    args = parser.parse_args()
+    save_stub_model(args.output, input_size=args.input_size, num_classes=args.classes)
+
+
+if __name__ == '__main__':
+    main()
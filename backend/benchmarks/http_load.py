@@ -0,0 +1,85 @@
+"""
+Minimal HTTP load helpers (stdlib only) shared by the serving benchmarks.
+"""
+import http.client
+import threading
+import time
+import uuid
+
+
+def multipart_body(field, filename, data, content_type='application/octet-stream'):
+    boundary = uuid.uuid4().hex
+    body = (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+        f'Content-Type: {content_type}\r\n\r\n'
+    ).encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+def wait_ready(host, port, timeout=300.0, path='/api/ready'):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection(host, port, timeout=5)
+            conn.request('GET', path)
+            if conn.getresponse().status == 200:
+                return True
+        except OSError:
+            pass
+        time.sleep(0.2)
+    return False
+
+
+def run_load(host, port, path, body, content_type, concurrency, duration):
+    """
+    Hammer `path` with `concurrency` keep-alive clients for `duration` seconds.
+
+    Returns a dict with latencies (seconds), status counts and throughput.
+    """
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def client():
+        conn = http.client.HTTPConnection(host, port, timeout=60)
+        local, local_statuses = [], {}
+        while time.monotonic() < stop_at:
+            started = time.perf_counter()
+            try:
+                conn.request('POST', path, body=body, headers={'Content-Type': content_type})
+                response = conn.getresponse()
+                response.read()
+                status = response.status
+            except OSError:
+                conn.close()
+                conn = http.client.HTTPConnection(host, port, timeout=60)
+                status = 'error'
+            local.append(time.perf_counter() - started)
+            local_statuses[status] = local_statuses.get(status, 0) + 1
+        with lock:
+            latencies.extend(local)
+            for status, count in local_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - started
+    return {
+        "latencies": latencies,
+        "statuses": statuses,
+        "elapsed": elapsed,
+        "requests_per_second": len(latencies) / elapsed if elapsed else 0.0,
+    }
+
+
+def percentiles(values, points=(50, 95, 99)):
+    if not values:
+        return {f"p{p}": None for p in points}
+    ordered = sorted(values)
+    return {f"p{p}": ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] for p in points}
@@ -9,8 +9,151 @@ class Config:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     JWT_SECRET_KEY = os.getenv('JWT_SECRET_KEY', 'jwt_secret_key')
     
+    # Logging ('json' lines or 'text') and Prometheus metrics at /metrics;
+    # under serve.py workers share metric snapshots every METRICS_SYNC_SECONDS
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+    LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+    METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    METRICS_SYNC_SECONDS = float(os.getenv('METRICS_SYNC_SECONDS', 5))
+
+    # Password hashing: bcrypt cost and the dedicated pool it runs on
+    BCRYPT_LOG_ROUNDS = int(os.getenv('BCRYPT_LOG_ROUNDS', 12))
+    PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', 2))
+    PASSWORD_HASH_QUEUE = int(os.getenv('PASSWORD_HASH_QUEUE', 32))
+    # Seconds a /api/auth/profile lookup is cached per JWT identity
+    PROFILE_CACHE_TTL = float(os.getenv('PROFILE_CACHE_TTL', 30))
+
     # Path settings
     BASE_DIR = os.path.abspath(os.path.dirname(__file__))
-    UPLOAD_FOLDER = os.path.join(BASE_DIR, 'app', 'static', 'uploads')
-    GRADCAM_FOLDER = os.path.join(BASE_DIR, 'app', 'static', 'gradcam')
-    MODEL_PATH = os.path.join(BASE_DIR, 'models', 'model.h5')
+    UPLOAD_FOLDER = os.getenv('UPLOAD_FOLDER', os.path.join(BASE_DIR, 'app', 'static', 'uploads'))
+    GRADCAM_FOLDER = os.getenv('GRADCAM_FOLDER', os.path.join(BASE_DIR, 'app', 'static', 'gradcam'))
+    GRADCAM_VARIANT_FOLDER = os.getenv('GRADCAM_VARIANT_FOLDER', os.path.join(BASE_DIR, 'app', 'static', 'gradcam_variants'))
+    GRADCAM_VARIANT_CACHE_BYTES = int(os.getenv('GRADCAM_VARIANT_CACHE_BYTES', 256 * 1024 * 1024))
+    MODEL_PATH = os.getenv('MODEL_PATH', os.path.join(BASE_DIR, 'models', 'model.h5'))
+    MODEL_INPUT_SIZE = int(os.getenv('MODEL_INPUT_SIZE', 224))
+
+    # Inference micro-batching
+    INFERENCE_BATCH_SIZE = int(os.getenv('INFERENCE_BATCH_SIZE', 16))
+    INFERENCE_BATCH_TIMEOUT_MS = float(os.getenv('INFERENCE_BATCH_TIMEOUT_MS', 10))
+    BATCH_MAX_FILES = int(os.getenv('BATCH_MAX_FILES', 256))
+    # Images queued for the model beyond which submissions are shed
+    INFERENCE_MAX_QUEUE = int(os.getenv('INFERENCE_MAX_QUEUE', 256))
+
+    # Admission control for /api/predict*: requests in the pipeline at once,
+    # requests allowed to wait for a slot, and the default and largest
+    # deadline (a client may ask for less with X-Deadline-Ms). Shed requests
+    # get ADMISSION_REJECT_STATUS (429 or 503) with Retry-After.
+    ADMISSION_MAX_CONCURRENT = int(os.getenv('ADMISSION_MAX_CONCURRENT', 32))
+    ADMISSION_MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE', 64))
+    ADMISSION_REJECT_STATUS = int(os.getenv('ADMISSION_REJECT_STATUS', 503))
+    PREDICT_DEADLINE_MS = float(os.getenv('PREDICT_DEADLINE_MS', 10000))
+    PREDICT_MAX_DEADLINE_MS = float(os.getenv('PREDICT_MAX_DEADLINE_MS', 30000))
+    # Degraded mode: skip Grad-CAM while this many requests are queued
+    # (waiting for admission plus queued for the model); 0 disables it
+    DEGRADE_QUEUE_DEPTH = int(os.getenv('DEGRADE_QUEUE_DEPTH', 0))
+
+    # Write-behind persistence of Prediction rows: flushed in bulk every
+    # PERSIST_BATCH_SIZE rows or PERSIST_INTERVAL_MS, spooled to disk first
+    PERSIST_WRITE_BEHIND = os.getenv('PERSIST_WRITE_BEHIND', 'true').lower() in ('1', 'true', 'yes')
+    PERSIST_BATCH_SIZE = int(os.getenv('PERSIST_BATCH_SIZE', 256))
+    PERSIST_INTERVAL_MS = float(os.getenv('PERSIST_INTERVAL_MS', 50))
+    PERSIST_ID_BLOCK = int(os.getenv('PERSIST_ID_BLOCK', 100))
+    # Failed writes of one op before it is moved to the spool's dead-letter file
+    PERSIST_MAX_RETRIES = int(os.getenv('PERSIST_MAX_RETRIES', 5))
+    PERSIST_SPOOL_FOLDER = os.getenv('PERSIST_SPOOL_FOLDER', os.path.join(BASE_DIR, 'instance', 'spool'))
+    PERSIST_SPOOL_FSYNC = os.getenv('PERSIST_SPOOL_FSYNC', 'true').lower() in ('1', 'true', 'yes')
+
+    # /api/history keyset pagination
+    HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', 50))
+    HISTORY_MAX_PAGE_SIZE = int(os.getenv('HISTORY_MAX_PAGE_SIZE', 500))
+
+    # Content-addressed prediction cache
+    PREDICTION_CACHE_ENABLED = os.getenv('PREDICTION_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    PREDICTION_CACHE_SIZE = int(os.getenv('PREDICTION_CACHE_SIZE', 1024))
+    PREDICTION_CACHE_PATH = os.getenv('PREDICTION_CACHE_PATH', os.path.join(BASE_DIR, 'instance', 'prediction_cache.db'))
+
+    # Background Grad-CAM rendering
+    GRADCAM_ASYNC = os.getenv('GRADCAM_ASYNC', 'true').lower() in ('1', 'true', 'yes')
+    GRADCAM_WORKERS = int(os.getenv('GRADCAM_WORKERS', 2))
+    # Heatmaps per prediction, one for each of the top classes in its
+    # differential, all from one batched backward pass (1 = top class only)
+    GRADCAM_CLASSES = int(os.getenv('GRADCAM_CLASSES', 3))
+
+    # Test-time augmentation: average TTA_VIEWS flipped, rotated and cropped
+    # views of each upload, scored in one batch; the variance across views is
+    # reported as `uncertainty`. Requests can turn it on or off with `tta`.
+    TTA_ENABLED = os.getenv('TTA_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+    TTA_VIEWS = int(os.getenv('TTA_VIEWS', 8))
+    TTA_ROTATION_DEGREES = float(os.getenv('TTA_ROTATION_DEGREES', 10))
+    TTA_CROP = float(os.getenv('TTA_CROP', 0.9))
+
+    # Model loading: 'background' (default), 'lazy' (first use) or 'eager'
+    MODEL_LOADING = os.getenv('MODEL_LOADING', 'background')
+    MODEL_WARMUP = os.getenv('MODEL_WARMUP', 'true').lower() in ('1', 'true', 'yes')
+
+    # Model registry: versions under MODEL_REGISTRY_DIR/<name>/<version>/.
+    # Requests get MODEL_NAME unless they ask for another (`model`); MODEL_PATH
+    # is served under that name when the registry has none. The folder is
+    # polled for new versions every MODEL_REGISTRY_POLL_SECONDS (0 disables)
+    # and the newest MODEL_REGISTRY_KEEP versions per model stay loaded.
+    MODEL_NAME = os.getenv('MODEL_NAME', 'default')
+    MODEL_REGISTRY_DIR = os.getenv('MODEL_REGISTRY_DIR', os.path.join(BASE_DIR, 'models', 'registry'))
+    MODEL_REGISTRY_POLL_SECONDS = float(os.getenv('MODEL_REGISTRY_POLL_SECONDS', 10))
+    MODEL_REGISTRY_KEEP = int(os.getenv('MODEL_REGISTRY_KEEP', 1))
+
+    # Similar-case search (/api/predictions/<id>/similar): every prediction's
+    # embedding is kept per model version under EMBEDDING_FOLDER; a version is
+    # searched exactly below EMBEDDING_IVF_MIN_SIZE embeddings and with an
+    # IVF-PQ index (probing EMBEDDING_IVF_PROBES lists) above it, extended in
+    # the background every EMBEDDING_IVF_UPDATE_EVERY new embeddings
+    EMBEDDINGS_ENABLED = os.getenv('EMBEDDINGS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    EMBEDDING_FOLDER = os.getenv('EMBEDDING_FOLDER', os.path.join(BASE_DIR, 'instance', 'embeddings'))
+    EMBEDDING_IVF_MIN_SIZE = int(os.getenv('EMBEDDING_IVF_MIN_SIZE', 50000))
+    EMBEDDING_IVF_PROBES = int(os.getenv('EMBEDDING_IVF_PROBES', 16))
+    EMBEDDING_IVF_UPDATE_EVERY = int(os.getenv('EMBEDDING_IVF_UPDATE_EVERY', 10000))
+    SIMILAR_MAX_RESULTS = int(os.getenv('SIMILAR_MAX_RESULTS', 100))
+
+    # Inference backend: 'keras' or 'tflite' (a quantized artifact made by
+    # `python -m scripts.convert_tflite`; defaults to models/model.<quantization>.tflite)
+    INFERENCE_BACKEND = os.getenv('INFERENCE_BACKEND', 'keras')
+    TFLITE_QUANTIZATION = os.getenv('TFLITE_QUANTIZATION', 'float16')
+    TFLITE_MODEL_PATH = os.getenv('TFLITE_MODEL_PATH')
+    # Synthetic images the TFLite backend is checked against Keras on at load
+    TFLITE_VERIFY_IMAGES = int(os.getenv('TFLITE_VERIFY_IMAGES', 8))
+
+    # High-bit-depth and very large images (app/ingest.py): uncompressed
+    # pixels are read INGEST_BAND_BYTES of rows at a time, compressed ones
+    # that must be decoded whole are refused past INGEST_MAX_DECODE_BYTES,
+    # and without a window in the file INGEST_WINDOW_PERCENT of each tail
+    # is clipped when mapping to 8 bits
+    INGEST_BAND_BYTES = int(os.getenv('INGEST_BAND_BYTES', 32 * 1024 * 1024))
+    INGEST_MAX_DECODE_BYTES = int(os.getenv('INGEST_MAX_DECODE_BYTES', 512 * 1024 * 1024))
+    INGEST_WINDOW_PERCENT = float(os.getenv('INGEST_WINDOW_PERCENT', 0.5))
+
+    # Tiled inference and Grad-CAM for uploads whose long edge is at least
+    # INGEST_TILE_MIN_EDGE: reduced to at most INGEST_TILE_MAX_EDGE, cut into
+    # INGEST_TILE_SIZE tiles overlapping by INGEST_TILE_OVERLAP, tile scores
+    # pooled by INGEST_TILE_POOLING ('mean' or 'max') and heatmaps stitched
+    INGEST_TILED = os.getenv('INGEST_TILED', 'false').lower() in ('1', 'true', 'yes')
+    INGEST_TILE_MIN_EDGE = int(os.getenv('INGEST_TILE_MIN_EDGE', 2048))
+    INGEST_TILE_MAX_EDGE = int(os.getenv('INGEST_TILE_MAX_EDGE', 2048))
+    INGEST_TILE_SIZE = int(os.getenv('INGEST_TILE_SIZE', 512))
+    INGEST_TILE_OVERLAP = int(os.getenv('INGEST_TILE_OVERLAP', 64))
+    INGEST_TILE_POOLING = os.getenv('INGEST_TILE_POOLING', 'mean')
+
+    # ASGI serving (asgi.py, serve.py --asgi): bodies are received on the
+    # event loop, spooled to disk past ASGI_SPOOL_BYTES and refused past
+    # ASGI_MAX_BODY_BYTES; routes without a native async handler run on
+    # ASGI_REQUEST_THREADS threads, native handlers' DB work on ASGI_DB_THREADS
+    ASGI_MAX_BODY_BYTES = int(os.getenv('ASGI_MAX_BODY_BYTES', 1024 * 1024 * 1024))
+    ASGI_SPOOL_BYTES = int(os.getenv('ASGI_SPOOL_BYTES', 1024 * 1024))
+    ASGI_REQUEST_THREADS = int(os.getenv('ASGI_REQUEST_THREADS', 32))
+    ASGI_DB_THREADS = int(os.getenv('ASGI_DB_THREADS', 4))
+
+    # Pre-fork serving (serve.py): TensorFlow threads for the shared inference
+    # process (0 = TensorFlow default) and for each HTTP worker
+    INFERENCE_INTRA_OP_THREADS = int(os.getenv('INFERENCE_INTRA_OP_THREADS', 0))
+    INFERENCE_INTER_OP_THREADS = int(os.getenv('INFERENCE_INTER_OP_THREADS', 0))
+    WORKER_TF_THREADS = int(os.getenv('WORKER_TF_THREADS', 1))
+    SERVE_WORKERS = int(os.getenv('SERVE_WORKERS', os.cpu_count() or 2))
+    SERVE_SLOTS = int(os.getenv('SERVE_SLOTS', 64))
@@ -0,0 +1,134 @@
+"""
+Convert the Keras model to a quantized TFLite artifact for INFERENCE_BACKEND=tflite.
+
+Calibration images (int8 needs them) and evaluation images are read from
+folders and preprocessed exactly like uploads. The report written next to
+the artifact has per-image latency of both backends and the accuracy
+delta of the quantized model against Keras; the TFLite backend serves it
+from /api/inference/stats.
+
+    python -m scripts.convert_tflite --quantization int8 --calibration-dir datasets/calibration --eval-dir datasets/eval
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from app.backends import QUANTIZATIONS, TFLiteBackend, compare, convert, report_path, tflite_path
+from app.inference import InferenceEngine
+from app.preprocess import decode_file, resize_normalize
+from app.utils import load_model_safe
+from config import Config
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp'}
+
+
+def load_images(folder, input_size, limit):
+    """
+    Preprocessed float32 batch of up to `limit` images found under `folder`.
+    """
+    paths = sorted(
+        os.path.join(root, name)
+        for root, _, names in os.walk(folder)
+        for name in names
+        if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+    )
+    images = []
+    for path in paths:
+        img = decode_file(path, input_size)
+        if img is None:
+            continue
+        images.append(resize_normalize(img, input_size)[1])
+        if len(images) >= limit:
+            break
+    return np.stack(images) if images else np.zeros((0, input_size, input_size, 3), np.float32)
+
+
+def synthetic_images(count, input_size, seed):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(-1, 1, (count, input_size, input_size, 3)).astype(np.float32)
+
+
+def time_per_image(predict, images, batch_size, repeats):
+    """
+    Mean milliseconds per image when scoring `images` in batches of `batch_size`.
+    """
+    predict(images[:batch_size])
+    started = time.perf_counter()
+    for _ in range(repeats):
+        for start in range(0, len(images), batch_size):
+            predict(images[start:start + batch_size])
+    return round((time.perf_counter() - started) / (repeats * len(images)) * 1000, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model-path', default=Config.MODEL_PATH)
+    parser.add_argument('--quantization', choices=QUANTIZATIONS, default=Config.TFLITE_QUANTIZATION)
+    parser.add_argument('--output', help="artifact path (default: next to the model)")
+    parser.add_argument('--input-size', type=int, default=Config.MODEL_INPUT_SIZE)
+    parser.add_argument('--calibration-dir')
+    parser.add_argument('--calibration-images', type=int, default=200)
+    parser.add_argument('--eval-dir', help="defaults to the calibration images")
+    parser.add_argument('--eval-images', type=int, default=200)
+    parser.add_argument('--batch-sizes', default='1,16')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    model, last_conv_layer_name = load_model_safe(args.model_path)
+    if model is None:
+        sys.exit("Model could not be loaded")
+    output = args.output or tflite_path(args.model_path, args.quantization)
+
+    if args.calibration_dir:
+        calibration = load_images(args.calibration_dir, args.input_size, args.calibration_images)
+    else:
+        print("No --calibration-dir, calibrating on random images; int8 accuracy will suffer", file=sys.stderr)
+        calibration = synthetic_images(args.calibration_images, args.input_size, seed=0)
+    if args.eval_dir:
+        evaluation = load_images(args.eval_dir, args.input_size, args.eval_images)
+    elif args.calibration_dir:
+        evaluation = calibration[:args.eval_images]
+    else:
+        evaluation = synthetic_images(args.eval_images, args.input_size, seed=1)
+    if not len(evaluation):
+        sys.exit("No evaluation images found")
+
+    started = time.perf_counter()
+    flatbuffer = convert(model, args.quantization, calibration)
+    convert_seconds = time.perf_counter() - started
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'wb') as f:
+        f.write(flatbuffer)
+
+    keras = InferenceEngine(model, last_conv_layer_name)
+    tflite = TFLiteBackend(output, keras, quantization=args.quantization)
+    latency = {}
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        latency[f"batch_{batch_size}"] = {
+            "keras_ms_per_image": time_per_image(keras.predict, evaluation, batch_size, args.repeats),
+            "tflite_ms_per_image": time_per_image(tflite.predict, evaluation, batch_size, args.repeats),
+        }
+
+    report = {
+        "model_path": os.path.abspath(args.model_path),
+        "quantization": args.quantization,
+        "artifact_bytes": len(flatbuffer),
+        "convert_seconds": round(convert_seconds, 3),
+        "calibration_images": int(len(calibration)),
+        "calibration_source": args.calibration_dir or 'synthetic',
+        "eval_source": args.eval_dir or args.calibration_dir or 'synthetic',
+        "latency": latency,
+        "accuracy": compare(keras.predict(evaluation), tflite.predict(evaluation)),
+    }
+    with open(report_path(output), 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {output} ({len(flatbuffer) / 2**20:.1f} MiB)", file=sys.stderr)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
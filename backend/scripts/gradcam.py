@@ -15,10 +15,6 @@ def generate_gradcam(model, img_array, last_conv_layer_name):
         heatmap: Grad-CAM heatmap as numpy array
     """
 
-    # Get the model's prediction
-    preds = model.predict(img_array)
-    pred_index = np.argmax(preds[0])
-
     # Create a model that maps the input image to the activations
     # of the last conv layer and the final predictions
     grad_model = tf.keras.models.Model(
@@ -27,9 +23,10 @@ def generate_gradcam(model, img_array, last_conv_layer_name):
     )
 
     # Compute the gradient of the predicted class with respect
-    # to the output feature map
+    # to the output feature map, predicting in the same forward pass
     with tf.GradientTape() as tape:
         conv_outputs, predictions = grad_model(img_array)
+        pred_index = int(np.argmax(predictions[0]))
         loss = predictions[:, pred_index]
 
     grads = tape.gradient(loss, conv_outputs)
@@ -39,12 +36,8 @@ def generate_gradcam(model, img_array, last_conv_layer_name):
 
     conv_outputs = conv_outputs[0].numpy()
 
-    # Multiply conv feature maps by importance weights
-    for i in range(len(pooled_grads)):
-        conv_outputs[:, :, i] *= pooled_grads[i]
-
-    # Generate heatmap
-    heatmap = np.mean(conv_outputs, axis=-1)
+    # Weight conv feature maps by importance and average over channels
+    heatmap = conv_outputs @ pooled_grads / len(pooled_grads)
 
     # Normalize heatmap
     heatmap = np.maximum(heatmap, 0)
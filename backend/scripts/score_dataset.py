@@ -0,0 +1,460 @@
+"""
+Score every image under a dataset folder offline, with the same model,
+preprocessing and Grad-CAM code as the API.
+
+Images are decoded and resized by a pool of worker processes a few chunks
+ahead of the model, scored in batches, and written a chunk at a time to
+the Prediction table (`--output db`, uploads are copied into the content
+store so the app can show them) or to a CSV file or Parquet folder.
+
+Progress is checkpointed in a manifest (JSON lines, next to the output by
+default), so an interrupted run picks up where it stopped when run again
+with the same arguments. A chunk is checkpointed after it is written, so
+a crash in between scores at most that chunk twice.
+
+    python -m scripts.score_dataset /data/studies --output db --gradcam
+    python -m scripts.score_dataset /data/studies --output results.csv --model chest@3
+"""
+import argparse
+import collections
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from app import ingest
+from app.preprocess import normalize, resize
+from app.storage import ContentStore
+from config import Config
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp', '.dcm'}
+
+FIELDS = ('path', 'image_path', 'predicted_class', 'confidence', 'severity', 'differential',
+          'model_version', 'gradcam_path')
+
+
+def list_images(root):
+    """
+    Image paths under `root`, relative to it, in a stable order.
+    """
+    paths = []
+    for folder, dirs, names in os.walk(root):
+        dirs.sort()
+        for name in sorted(names):
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                paths.append(os.path.relpath(os.path.join(folder, name), root))
+    return paths
+
+
+def _init_worker():
+    # One OpenCV thread per worker process; the pool is the parallelism
+    cv2.setNumThreads(1)
+
+
+def load_image(task):
+    """
+    Worker: read, optionally store, decode and resize one image.
+
+    Returns (path, image_path, resized uint8 pixels or None, error).
+    """
+    root, path, input_size, store_folder, limits = task
+    full_path = os.path.join(root, path)
+    image_path = None
+    try:
+        if store_folder:
+            with open(full_path, 'rb') as f:
+                image_path = ContentStore(store_folder).save_stream(f)[0]
+        # High-bit-depth and very large scans are read band by band
+        img = ingest.load(full_path, limits, min_edge=input_size)
+        if img is None:
+            return path, image_path, None, "Invalid image format"
+        return path, image_path, resize(img, input_size), None
+    except ingest.IngestError as e:
+        return path, image_path, None, str(e)
+    except OSError as e:
+        return path, None, None, str(e)
+
+
+class Manifest:
+    """
+    Checkpoint of the images already handled: a header naming the dataset
+    and model, then one line per image with its status.
+    """
+
+    def __init__(self, path, dataset, model):
+        self.path = path
+        self.done = {}
+        header = {"dataset": os.path.abspath(dataset), "model": model}
+        if os.path.exists(path):
+            with open(path) as f:
+                lines = f.read().splitlines()
+            existing = json.loads(lines[0]) if lines else None
+            if existing is not None and existing != header:
+                raise SystemExit(f"{path} was written for {existing}, not {header}; use another --manifest")
+            for line in lines[1:]:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Torn final line from a crash
+                    break
+                self.done[entry["path"]] = entry["status"]
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = open(path, 'a')
+        if not self.done and self.file.tell() == 0:
+            self._append([header])
+
+    def pending(self, paths, retry_failed=False):
+        return [path for path in paths
+                if path not in self.done or (retry_failed and self.done[path] == 'failed')]
+
+    def record(self, entries):
+        self._append(entries)
+        for entry in entries:
+            self.done[entry["path"]] = entry["status"]
+
+    def _append(self, entries):
+        self.file.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+class DbWriter:
+    """
+    Bulk inserts into the Prediction table, with ids reserved in blocks
+    like the API's write-behind persister, and the rows' embeddings added
+    to the similar-case index.
+    """
+
+    def __init__(self, chunk_size):
+        from app import create_app
+        from app.persistence import IdAllocator
+
+        class ScoringConfig(Config):
+            MODEL_LOADING = 'lazy'
+            MODEL_REGISTRY_POLL_SECONDS = 0
+
+        self.app = create_app(ScoringConfig)
+        self.ids = IdAllocator(self.app, block_size=chunk_size)
+
+    def write(self, rows):
+        from app import main as app_main
+        from app.extensions import db
+        from app.models import Prediction
+        from app.persistence import apply_ops
+
+        columns = set(Prediction.__table__.columns.keys())
+        embedded = [row for row in rows if row["embedding"] is not None]
+        for row in rows:
+            row["id"] = self.ids.allocate()
+        with self.app.app_context():
+            apply_ops([('insert', [{k: v for k, v in row.items() if k in columns} for row in rows])])
+            db.session.remove()
+        if app_main.embedding_indexes is not None and embedded:
+            app_main.embedding_indexes.add(embedded[0]["model_version"], [row["id"] for row in embedded],
+                                           [row["user_id"] for row in embedded],
+                                           np.stack([row["embedding"] for row in embedded]))
+
+    def close(self):
+        from app import main as app_main
+        app_main.persister.close()
+
+
+class CsvWriter:
+    def __init__(self, path):
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.DictWriter(self.file, FIELDS, extrasaction='ignore')
+        if new:
+            self.writer.writeheader()
+
+    def write(self, rows):
+        for row in rows:
+            self.writer.writerow({**row, "differential": json.dumps(row["differential"])})
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    """
+    One Parquet file per chunk in the output folder (Parquet files can't be
+    appended to); read the folder back as one dataset.
+    """
+
+    def __init__(self, folder):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit("Parquet output needs pyarrow (pip install pyarrow)")
+        self.pa, self.pq = pyarrow, pyarrow.parquet
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self.part = len([name for name in os.listdir(folder) if name.endswith('.parquet')])
+
+    def write(self, rows):
+        columns = {field: [row.get(field) for row in rows] for field in FIELDS}
+        columns["differential"] = [json.dumps(value) for value in columns["differential"]]
+        columns["heatmap"] = [row.get("heatmap") for row in rows]
+        table = self.pa.table(columns)
+        path = os.path.join(self.folder, f'part-{self.part:06d}.parquet')
+        self.pq.write_table(table, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        self.part += 1
+
+    def close(self):
+        pass
+
+
+def make_writer(output, chunk_size):
+    if output == 'db':
+        return DbWriter(chunk_size)
+    if output.endswith('.csv'):
+        return CsvWriter(output)
+    if output.endswith('.parquet'):
+        return ParquetWriter(output)
+    raise SystemExit("--output must be 'db', a .csv file or a .parquet folder")
+
+
+class Progress:
+    """
+    Throughput and ETA on stderr every `interval` seconds.
+    """
+
+    def __init__(self, total, interval=5.0):
+        self.total = total
+        self.interval = interval
+        self.scored = self.failed = 0
+        self.started = self._last = time.monotonic()
+
+    @property
+    def rate(self):
+        elapsed = time.monotonic() - self.started
+        return (self.scored + self.failed) / elapsed if elapsed else 0.0
+
+    def update(self, scored, failed, force=False):
+        self.scored += scored
+        self.failed += failed
+        now = time.monotonic()
+        if not force and now - self._last < self.interval:
+            return
+        self._last = now
+        handled = self.scored + self.failed
+        eta = (self.total - handled) / self.rate if self.rate else 0
+        print(f"{handled}/{self.total} images ({handled / max(self.total, 1):.1%}), {self.failed} failed, "
+              f"{self.rate:.1f} img/s, ETA {time.strftime('%H:%M:%S', time.gmtime(eta))}", file=sys.stderr)
+
+
+def resolve_spec(config, selector):
+    """
+    Registry version for `name`, `name@version` or `@version` (newest
+    version of MODEL_NAME by default).
+    """
+    from app.registry import available_specs
+
+    name, _, version = (selector or '').partition('@')
+    specs = available_specs(config).get(name or config['MODEL_NAME'])
+    if not specs:
+        raise SystemExit(f"No model named {name or config['MODEL_NAME']!r} in the registry")
+    if not version:
+        return specs[-1]
+    for spec in specs:
+        if spec.version == version:
+            return spec
+    raise SystemExit(f"No version {version!r} of {specs[0].name!r}; have {[spec.version for spec in specs]}")
+
+
+class Scorer:
+    """
+    Batched inference, interpretation and heatmaps for decoded chunks.
+    """
+
+    def __init__(self, config, spec, gradcam=False, gradcam_dir=None, batch_size=64, user_id=None):
+        from app.backends import load_backend
+        from app.labels import LabelMap
+
+        self.spec = spec
+        self.engine = load_backend(config, spec.path, spec.last_conv_layer, spec.input_size)
+        if self.engine is None:
+            raise SystemExit(f"Model {spec.key} could not be loaded")
+        if config['MODEL_WARMUP']:
+            self.engine.warmup(spec.input_size)
+        self.labels = LabelMap.for_model(spec.path, self.engine.model.output_shape[-1], spec.class_index)
+        self.gradcam = gradcam
+        self.gradcam_dir = gradcam_dir
+        self.batch_size = batch_size
+        self.user_id = user_id
+        self.batch = np.empty((batch_size, spec.input_size, spec.input_size, 3), np.float32)
+
+    def score(self, images):
+        """
+        Class scores, embeddings and (with --gradcam) heatmaps for a list of
+        resized images.
+        """
+        predictions, heatmaps, embeddings = [], [], []
+        for start in range(0, len(images), self.batch_size):
+            part = images[start:start + self.batch_size]
+            batch = self.batch[:len(part)]
+            for i, image in enumerate(part):
+                normalize(image, batch[i], self.spec.preprocessing)
+            if self.gradcam:
+                scores, maps, vectors = self.engine.predict_and_explain(batch, embed=True)
+            else:
+                (scores, vectors), maps = self.engine.predict(batch, embed=True), None
+            predictions.append(np.asarray(scores))
+            heatmaps.extend(maps if maps is not None else [None] * len(part))
+            embeddings.extend(vectors if vectors is not None else [None] * len(part))
+        return np.concatenate(predictions), heatmaps, embeddings
+
+    def rows(self, loaded):
+        """
+        Output rows for the decoded images of a chunk.
+        """
+        from app.heatmaps import OverlayParams, encode_heatmap, render_overlay
+
+        predictions, heatmaps, embeddings = self.score([resized for _, _, resized, _ in loaded])
+        rows = []
+        for (path, image_path, resized, _), (decoded_preds, class_name, confidence, severity), heatmap, embedding in zip(
+                loaded, self.labels.interpret(predictions, k=3), heatmaps, embeddings):
+            row = {
+                "path": path,
+                "image_path": image_path or path,
+                "predicted_class": class_name.replace('_', ' ').title(),
+                "confidence": confidence,
+                "severity": severity,
+                "differential": [{"condition": name.replace('_', ' ').title(), "confidence": score * 100}
+                                 for _, name, score in decoded_preds],
+                "model_version": self.spec.key,
+                "gradcam_path": None,
+                "heatmap": None,
+                "embedding": embedding,
+                "user_id": self.user_id,
+            }
+            if heatmap is not None:
+                row["heatmap"] = encode_heatmap(heatmap)
+                if image_path:
+                    # Rendered on demand by the app, like uploads scored through the API
+                    row["gradcam_path"] = f"gradcam_{image_path}"
+                elif self.gradcam_dir:
+                    overlay_path = os.path.join(self.gradcam_dir, path + '.jpg')
+                    os.makedirs(os.path.dirname(overlay_path), exist_ok=True)
+                    with open(overlay_path, 'wb') as f:
+                        # Files hold the top class; per-class heatmaps stay in the row
+                        top = heatmap if np.ndim(heatmap) == 2 else heatmap[0]
+                        f.write(render_overlay(top, resized, OverlayParams()))
+                    row["gradcam_path"] = os.path.relpath(overlay_path, self.gradcam_dir)
+            rows.append(row)
+        return rows
+
+
+def default_manifest(dataset, output):
+    """
+    Checkpoint next to a file output; database runs keep theirs in
+    instance/, one per dataset folder.
+    """
+    if output != 'db':
+        return output.rstrip('/') + '.manifest.jsonl'
+    name = os.path.basename(os.path.abspath(dataset)) or 'dataset'
+    return os.path.join(Config.BASE_DIR, 'instance', f'score_dataset.{name}.manifest.jsonl')
+
+
+def run(args):
+    config = {name: getattr(Config, name) for name in dir(Config) if name.isupper()}
+    spec = resolve_spec(config, args.model)
+    paths = list_images(args.dataset)
+    manifest_path = args.manifest or default_manifest(args.dataset, args.output)
+    manifest = Manifest(manifest_path, args.dataset, spec.key)
+    pending = manifest.pending(paths, args.retry_failed)
+    if args.limit:
+        pending = pending[:args.limit]
+    print(f"{len(paths)} images in {args.dataset}, {len(pending)} to score with {spec.key}", file=sys.stderr)
+
+    writer = make_writer(args.output, args.chunk_size)
+    gradcam_dir = args.gradcam_dir or (None if args.output == 'db' else args.output.rstrip('/') + '.gradcam')
+    scorer = Scorer(config, spec, gradcam=args.gradcam, gradcam_dir=gradcam_dir,
+                    batch_size=args.batch_size, user_id=args.user_id)
+    store_folder = config['UPLOAD_FOLDER'] if args.output == 'db' else None
+    progress = Progress(len(pending), args.progress_seconds)
+
+    chunks = [pending[start:start + args.chunk_size] for start in range(0, len(pending), args.chunk_size)]
+    limits = ingest.IngestLimits.from_config(config)
+    tasks = lambda chunk: [(args.dataset, path, spec.input_size, store_folder, limits) for path in chunk]
+    pool = None
+    if args.workers > 0:
+        # Spawned, so workers don't inherit TensorFlow's threads
+        pool = multiprocessing.get_context('spawn').Pool(args.workers, initializer=_init_worker)
+    try:
+        in_flight = collections.deque()
+        for chunk in chunks + [None] * args.prefetch:
+            # Keep `prefetch` chunks decoding while one is scored
+            if chunk is not None:
+                in_flight.append(pool.map_async(load_image, tasks(chunk)) if pool else list(map(load_image, tasks(chunk))))
+            if len(in_flight) <= args.prefetch and chunk is not None:
+                continue
+            if not in_flight:
+                break
+            results = in_flight.popleft()
+            results = results.get() if pool else results
+            loaded = [result for result in results if result[2] is not None]
+            failed = [result for result in results if result[2] is None]
+            if loaded:
+                writer.write(scorer.rows(loaded))
+            manifest.record([{"path": path, "status": "done"} for path, _, _, _ in loaded] +
+                            [{"path": path, "status": "failed", "error": error} for path, _, _, error in failed])
+            progress.update(len(loaded), len(failed))
+    finally:
+        if pool is not None:
+            pool.terminate()
+        writer.close()
+        manifest.close()
+    progress.update(0, 0, force=True)
+    return {
+        "dataset": os.path.abspath(args.dataset),
+        "model": spec.key,
+        "images": len(paths),
+        "scored": progress.scored,
+        "failed": progress.failed,
+        "images_per_second": round(progress.rate, 2),
+        "output": args.output,
+        "manifest": manifest_path,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('dataset', help='folder of images (searched recursively)')
+    parser.add_argument('--output', default='db', help="'db', a .csv file or a .parquet folder")
+    parser.add_argument('--model', help='name, name@version or @version (default: newest MODEL_NAME)')
+    parser.add_argument('--gradcam', action='store_true', help='also compute Grad-CAM heatmaps')
+    parser.add_argument('--gradcam-dir', help='overlay images for file outputs (default: <output>.gradcam)')
+    parser.add_argument('--manifest', help='checkpoint file (default: next to the output)')
+    parser.add_argument('--retry-failed', action='store_true', help='retry images that failed to decode')
+    parser.add_argument('--user-id', type=int, help='owner of rows written to the database')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2,
+                        help='decode processes (0 decodes in this process)')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--chunk-size', type=int, default=512, help='images written and checkpointed together')
+    parser.add_argument('--prefetch', type=int, default=2, help='chunks decoded ahead of the model')
+    parser.add_argument('--limit', type=int, help='score at most this many images this run')
+    parser.add_argument('--progress-seconds', type=float, default=5.0)
+    args = parser.parse_args(argv)
+    if not os.path.isdir(args.dataset):
+        parser.error(f"{args.dataset} is not a folder")
+
+    summary = run(args)
+    print(json.dumps(summary, indent=2))
+    return summary
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""
+Production serving mode.
+
+Loads the model once in a dedicated inference process, then forks HTTP
+workers that share one listening socket. Workers never import TensorFlow for
+inference: they copy preprocessed tensors into shared memory and the
+inference process batches requests from all of them together.
+
+    python serve.py --workers 4 --port 5000
+
+With --asgi each worker runs the ASGI app (app/asgi.py) under uvicorn, so
+slow uploads are received without holding a request thread.
+"""
+import argparse
+import logging
+import multiprocessing
+import shutil
+import signal
+import socket
+import tempfile
+import time
+
+from config import Config
+from app import metrics, serving
+from app.logs import configure_logging
+
+logger = logging.getLogger('serve')
+
+# Seconds workers get to finish and flush queued writes after SIGTERM
+WORKER_STOP_SECONDS = 30
+
+
+def _config_dict(config_class):
+    return {name: getattr(config_class, name) for name in dir(config_class) if name.isupper()}
+
+
+def _exit(signum, frame):
+    raise SystemExit(0)
+
+
+def _run_worker(worker_index, server, sock, threads, tf_threads, metrics_dir, asgi=False):
+    # SIGTERM unwinds the server loop so queued writes are flushed below
+    signal.signal(signal.SIGTERM, _exit)
+    # Set before anything can import TensorFlow in this worker
+    serving.configure_tf_threads(tf_threads, tf_threads)
+    serving.client = server.client(worker_index)
+    serving.served_model = server.spec
+    metrics.shared_dir = metrics_dir
+
+    from werkzeug.serving import make_server
+    from app import create_app
+
+    from app import main as app_main
+
+    app = create_app()
+    try:
+        if asgi:
+            import uvicorn
+            from app.asgi import AsgiApp
+
+            config = uvicorn.Config(AsgiApp(app, request_threads=threads), log_config=None, access_log=False)
+            uvicorn.Server(config).run(sockets=[sock])
+            return
+        host, port = sock.getsockname()[:2]
+        httpd = make_server(host, port, app, threaded=threads > 1, fd=sock.fileno())
+        httpd.serve_forever()
+    finally:
+        # Write queued rows and close the spool segment before exiting
+        app_main.persister.close()
+
+
+def _stop_workers(workers, timeout=WORKER_STOP_SECONDS):
+    """
+    SIGTERM every worker and wait for them to exit, killing any still
+    running after `timeout` seconds.
+    """
+    for worker in workers:
+        if worker.is_alive():
+            worker.terminate()
+    deadline = time.monotonic() + timeout
+    for worker in workers:
+        worker.join(max(0.0, deadline - time.monotonic()))
+    for worker in workers:
+        if worker.is_alive():
+            logger.warning("Worker did not stop, killing it", extra={"pid": worker.pid})
+            worker.kill()
+            worker.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=Config.SERVE_WORKERS)
+    parser.add_argument('--threads', type=int, default=8, help='Request threads per worker')
+    parser.add_argument('--slots', type=int, default=Config.SERVE_SLOTS, help='Shared-memory input slots')
+    parser.add_argument('--asgi', action='store_true', help='Serve the ASGI app with uvicorn')
+    args = parser.parse_args()
+    if args.asgi:
+        try:
+            import uvicorn  # noqa: F401
+        except ImportError:
+            raise SystemExit("--asgi needs uvicorn: pip install uvicorn")
+
+    config = _config_dict(Config)
+    configure_logging(Config.LOG_LEVEL, Config.LOG_FORMAT)
+
+    # Create tables once here so workers don't race on create_all()
+    from app import create_app
+    from app.extensions import db
+
+    class SchemaConfig(Config):
+        MODEL_LOADING = 'lazy'
+
+    schema_app = create_app(SchemaConfig)
+    from app import main as app_main
+    # Replays any spool left by a crashed worker, then stops its flusher
+    app_main.persister.close()
+    with schema_app.app_context():
+        db.engine.dispose()
+
+    # The inference process is spawned so it starts without inherited state;
+    # HTTP workers are forked so they share the socket and queues.
+    server = serving.InferenceServer(multiprocessing.get_context('spawn'), config, args.workers, args.slots)
+    info = server.start()
+    logger.info("Inference server ready", extra=info)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(128)
+    sock.set_inheritable(True)
+
+    # Workers merge each other's metric snapshots from here on /metrics
+    metrics_dir = tempfile.mkdtemp(prefix='medvisor-metrics-')
+
+    # Installed before forking, so a signal arriving while workers start
+    # still stops (and waits for) the ones already running
+    signal.signal(signal.SIGTERM, _exit)
+    signal.signal(signal.SIGINT, _exit)
+    fork = multiprocessing.get_context('fork')
+    workers = []
+    try:
+        for i in range(args.workers):
+            worker = fork.Process(
+                target=_run_worker,
+                args=(i, server, sock, args.threads, config['WORKER_TF_THREADS'], metrics_dir, args.asgi),
+                name=f'http-worker-{i}'
+            )
+            worker.start()
+            workers.append(worker)
+        logger.info(f"Serving on http://{args.host}:{args.port}",
+                    extra={"workers": args.workers, "pids": [w.pid for w in workers]})
+        for worker in workers:
+            worker.join()
+    finally:
+        _stop_workers(workers)
+        server.stop()
+        sock.close()
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
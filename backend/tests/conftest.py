@@ -1,3 +1,6 @@
+import os
+import shutil
+import tempfile
 import pytest
 from app import create_app
 from app.extensions import db
@@ -8,10 +11,31 @@ class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
     WTF_CSRF_ENABLED = False
+    MODEL_LOADING = 'lazy'
+    BCRYPT_LOG_ROUNDS = 4
+    MODEL_REGISTRY_POLL_SECONDS = 0
+
+def config_in(tmp_dir):
+    """TestConfig with every file the app writes kept under `tmp_dir`."""
+    class Paths(TestConfig):
+        UPLOAD_FOLDER = os.path.join(tmp_dir, 'uploads')
+        GRADCAM_FOLDER = os.path.join(tmp_dir, 'gradcam')
+        GRADCAM_VARIANT_FOLDER = os.path.join(tmp_dir, 'gradcam_variants')
+        PREDICTION_CACHE_PATH = os.path.join(tmp_dir, 'prediction_cache.db')
+        PERSIST_SPOOL_FOLDER = os.path.join(tmp_dir, 'spool')
+        MODEL_REGISTRY_DIR = os.path.join(tmp_dir, 'registry')
+        EMBEDDING_FOLDER = os.path.join(tmp_dir, 'embeddings')
+    return Paths
+
+@pytest.fixture(scope='session')
+def tmp_dir():
+    path = tempfile.mkdtemp(prefix='medvisor-test-')
+    yield path
+    shutil.rmtree(path, ignore_errors=True)
 
 @pytest.fixture(scope='module')
-def app():
-    app = create_app(TestConfig)
+def app(tmp_dir):
+    app = create_app(config_in(tmp_dir))
     with app.app_context():
         db.create_all()
         yield app
@@ -23,8 +47,34 @@ def client(app):
 
 @pytest.fixture(scope='function')
 def init_database(app):
+    from app import main
     with app.app_context():
         db.create_all()
         yield db
+        # Land queued writes before their tables go away
+        main.persister.sync()
+        main.persister.ids.reset()
         db.session.remove()
         db.drop_all()
+
+@pytest.fixture(scope='session')
+def stub_model():
+    """Small offline stand-in for the classifier with a named last conv layer."""
+    import tensorflow as tf
+    inputs = tf.keras.Input(shape=(None, None, 3))
+    x = tf.keras.layers.Conv2D(8, 3, activation='relu', name='last_conv')(inputs)
+    x = tf.keras.layers.GlobalAveragePooling2D()(x)
+    outputs = tf.keras.layers.Dense(5, activation='softmax')(x)
+    return tf.keras.Model(inputs, outputs, name='stub')
+
+@pytest.fixture
+def stub_inference(app, monkeypatch, stub_model):
+    """Route /api/predict* through the stub model instead of MobileNetV2."""
+    from app import main
+    from app.inference import InferenceEngine
+
+    main._start_inference(app, InferenceEngine(stub_model, 'last_conv'))
+    main.prediction_cache.clear()
+
+    yield main
+    main._start_inference(app, None)
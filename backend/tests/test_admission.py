@@ -0,0 +1,84 @@
+import threading
+import time
+import numpy as np
+import pytest
+from app.admission import AdmissionController, Deadline, DeadlineExceeded, Overloaded, request_deadline
+from app.batching import MicroBatcher
+
+def test_sheds_when_queue_is_full():
+    controller = AdmissionController(max_concurrent=1, max_queue=0)
+    ticket = controller.acquire(Deadline.after(1))
+    with pytest.raises(Overloaded) as excinfo:
+        controller.acquire(Deadline.after(1))
+    assert not isinstance(excinfo.value, DeadlineExceeded)
+    assert excinfo.value.retry_after >= 1
+
+    ticket.release()
+    ticket.release()
+    controller.acquire(Deadline.after(1)).release()
+    stats = controller.stats()
+    assert stats["admitted"] == 2 and stats["rejected"] == 1 and stats["active"] == 0
+
+def test_deadline_expires_while_waiting():
+    controller = AdmissionController(max_concurrent=1, max_queue=4)
+    with controller.admit(Deadline.after(1)):
+        started = time.monotonic()
+        with pytest.raises(DeadlineExceeded):
+            controller.acquire(Deadline.after(0.05))
+        assert time.monotonic() - started < 1
+    assert controller.stats()["expired"] == 1
+    assert controller.depth() == 0
+
+def test_waiter_gets_slot_when_released():
+    controller = AdmissionController(max_concurrent=1, max_queue=4)
+    ticket = controller.acquire(Deadline.after(1))
+    threading.Timer(0.05, ticket.release).start()
+    controller.acquire(Deadline.after(5)).release()
+
+def test_degrades_past_threshold():
+    controller = AdmissionController(max_concurrent=1, max_queue=4, degrade_depth=3)
+    assert not controller.should_degrade(2)
+    assert controller.should_degrade(3)
+    assert not AdmissionController(1, 4).should_degrade(100)
+
+def test_request_deadline_header_is_capped():
+    assert request_deadline({}, 1000, 5000).remaining() == pytest.approx(1, abs=0.1)
+    assert request_deadline({'X-Deadline-Ms': '60000'}, 1000, 5000).remaining() == pytest.approx(5, abs=0.1)
+    assert request_deadline({'X-Deadline-Ms': 'soon'}, 1000, 5000).remaining() == pytest.approx(1, abs=0.1)
+
+def test_batcher_drops_expired_items():
+    seen = []
+    def run_batch(images):
+        seen.append(len(images))
+        return (images,)
+
+    batcher = MicroBatcher(run_batch, max_batch_size=4, max_wait_ms=1)
+    expired = batcher.submit(np.zeros((1,), dtype=np.float32), Deadline(time.monotonic() - 1))
+    live = batcher.submit(np.ones((1,), dtype=np.float32), Deadline.after(5))
+    with pytest.raises(DeadlineExceeded):
+        expired.result(timeout=5)
+    assert live.result(timeout=5)[0][0] == 1
+    stats = batcher.stats()
+    batcher.close()
+    assert stats["expired"] == 1
+    assert sum(seen) == 1
+
+def test_batcher_rejects_when_queue_is_full():
+    release = threading.Event()
+    def run_batch(images):
+        release.wait(5)
+        return (images,)
+
+    batcher = MicroBatcher(run_batch, max_batch_size=1, max_wait_ms=1, max_queue=1)
+    first = batcher.submit(np.zeros((1,), dtype=np.float32))
+    # Wait for the worker to pick up the first item, then fill the queue
+    deadline = time.monotonic() + 5
+    while batcher.queue_depth() and time.monotonic() < deadline:
+        time.sleep(0.001)
+    batcher.submit(np.zeros((1,), dtype=np.float32))
+    with pytest.raises(Overloaded):
+        batcher.submit(np.zeros((1,), dtype=np.float32))
+    release.set()
+    first.result(timeout=5)
+    assert batcher.stats()["rejected"] == 1
+    batcher.close()
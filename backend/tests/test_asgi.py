@@ -0,0 +1,110 @@
+import asyncio
+import json
+import pytest
+from app.asgi import AsgiApp
+from test_main import _png
+
+@pytest.fixture
+def asgi(app):
+    asgi = AsgiApp(app, request_threads=1, db_threads=1)
+    yield asgi
+    asgi.request_executor.shutdown()
+    asgi.db_executor.shutdown()
+
+async def _call(asgi, method, path, body=b'', headers=(), query=b'', chunks=None, gate=None):
+    """Drive one HTTP request through the ASGI app; `chunks` arrive after `gate` is set."""
+    chunks = list(chunks) if chunks is not None else [body]
+    sent = []
+
+    async def receive():
+        if gate is not None and len(chunks) == 1:
+            await gate.wait()
+        chunk = chunks.pop(0)
+        return {'type': 'http.request', 'body': chunk, 'more_body': bool(chunks)}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'http_version': '1.1', 'method': method, 'path': path, 'root_path': '',
+             'scheme': 'http', 'query_string': query, 'server': ('testserver', 80), 'client': ('127.0.0.1', 1234),
+             'headers': [(b'host', b'testserver'), *[(k.lower().encode(), v.encode()) for k, v in headers]]}
+    await asgi(scope, receive, send)
+    headers = {k.decode(): v.decode() for k, v in sent[0]['headers']}
+    return sent[0]['status'], headers, b''.join(m.get('body', b'') for m in sent[1:])
+
+def _json(method, path, payload=None, token=None, query=b''):
+    headers = [('Content-Type', 'application/json')]
+    if token:
+        headers.append(('Authorization', f'Bearer {token}'))
+    return method, path, json.dumps(payload).encode() if payload is not None else b'', headers, query
+
+def test_native_auth_and_history(app, asgi, init_database):
+    from flask_jwt_extended import create_access_token
+
+    async def run():
+        user = {'username': 'asyncuser', 'email': 'async@example.com', 'password': 'password123'}
+        status, _, _ = await _call(asgi, *_json('POST', '/api/auth/register', user))
+        assert status == 201
+        status, _, body = await _call(asgi, *_json('POST', '/api/auth/register', user))
+        assert (status, json.loads(body)['msg']) == (409, 'Username already exists')
+
+        status, _, _ = await _call(asgi, *_json('POST', '/api/auth/login', {**user, 'password': 'wrong'}))
+        assert status == 401
+        status, headers, body = await _call(asgi, *_json('POST', '/api/auth/login', user))
+        assert status == 200 and headers['access-control-allow-origin'] == '*'
+        login = json.loads(body)
+        assert login['access_token'] and login['user']['username'] == 'asyncuser'
+        with app.app_context():
+            token = create_access_token(identity=str(login['user']['id']))
+
+        status, _, _ = await _call(asgi, *_json('GET', '/api/auth/profile'))
+        assert status == 401
+        status, _, body = await _call(asgi, *_json('GET', '/api/auth/profile', token=token))
+        assert (status, json.loads(body)['username']) == (200, 'asyncuser')
+
+        status, _, body = await _call(asgi, *_json('GET', '/api/history', token=token, query=b'limit=5'))
+        assert (status, json.loads(body)) == (200, [])
+        status, _, _ = await _call(asgi, *_json('GET', '/api/history', token=token, query=b'cursor=bogus'))
+        assert status == 400
+    asyncio.run(run())
+
+def test_chunked_upload_falls_back_to_flask(app, asgi, init_database, stub_inference, monkeypatch):
+    # The cache outlives this module's app; keep its counters to this test
+    monkeypatch.setattr(stub_inference.prediction_cache, 'misses', stub_inference.prediction_cache.misses)
+    from flask_jwt_extended import create_access_token
+    from app.extensions import db
+    from app.models import User
+    with app.app_context():
+        user = User(username='uploader', email='u@example.com', password_hash='x')
+        db.session.add(user)
+        db.session.commit()
+        token = create_access_token(identity=str(user.id))
+
+    boundary = 'asgi-test-boundary'
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="image"; filename="scan.png"\r\n'
+            f'Content-Type: image/png\r\n\r\n').encode() + _png(3) + f'\r\n--{boundary}--\r\n'.encode()
+    headers = [('Authorization', f'Bearer {token}'), ('Content-Type', f'multipart/form-data; boundary={boundary}'),
+               ('Content-Length', str(len(body)))]
+
+    async def run():
+        home = await _call(asgi, 'GET', '/')
+        assert home[0] == 200 and b"Backend Running" in home[2]
+
+        # A slow upload holds no request thread while its body trickles in
+        gate = asyncio.Event()
+        chunks = [body[i:i + 1024] for i in range(0, len(body), 1024)]
+        upload = asyncio.create_task(_call(asgi, 'POST', '/api/predict', headers=headers, chunks=chunks, gate=gate))
+        await asyncio.sleep(0.05)
+        status, _, _ = await asyncio.wait_for(_call(asgi, 'GET', '/'), timeout=30)
+        assert status == 200 and not upload.done()
+        gate.set()
+        return await upload
+
+    status, headers, body = asyncio.run(run())
+    assert status == 200, body
+    assert 'predicted_class' in json.loads(body)
+
+def test_rejects_oversized_body(app, asgi, monkeypatch):
+    monkeypatch.setattr(asgi, 'max_body', 10)
+    status, _, body = asyncio.run(_call(asgi, 'POST', '/api/predict', body=b'x' * 11))
+    assert status == 413
@@ -36,3 +36,45 @@ def test_login(client, init_database):
     assert response.status_code == 200
     data = json.loads(response.data)
     assert 'access_token' in data
+
+def test_register_duplicate_email(client, init_database):
+    client.post('/api/auth/register', json={'username': 'a', 'email': 'same@example.com', 'password': 'pw'})
+    response = client.post('/api/auth/register', json={'username': 'b', 'email': 'same@example.com', 'password': 'pw'})
+    assert response.status_code == 409
+    assert b"Email already exists" in response.data
+
+def test_passwords_hashed_at_configured_cost(app, client, init_database):
+    from app.models import User
+    client.post('/api/auth/register', json={'username': 'cost', 'email': 'c@example.com', 'password': 'pw'})
+    assert User.query.filter_by(username='cost').one().password_hash.startswith('$2b$04$')
+
+def test_profile_cached_until_user_changes(app, client, init_database):
+    from flask_jwt_extended import create_access_token
+    from app import auth
+    from app.extensions import db
+    from app.models import User
+    client.post('/api/auth/register', json={'username': 'prof', 'email': 'p@example.com', 'password': 'pw'})
+    user = User.query.filter_by(username='prof').one()
+    headers = {'Authorization': f'Bearer {create_access_token(identity=str(user.id))}'}
+    auth.identity_cache.clear()
+
+    assert client.get('/api/auth/profile', headers=headers).get_json()['email'] == 'p@example.com'
+    client.get('/api/auth/profile', headers=headers)
+    assert auth.identity_cache.stats()['hits'] >= 1
+
+    user.email = 'new@example.com'
+    db.session.commit()
+    assert client.get('/api/auth/profile', headers=headers).get_json()['email'] == 'new@example.com'
+
+def test_hasher_rejects_when_saturated():
+    import pytest
+    from app.passwords import HasherBusy, PasswordHasher
+    hasher = PasswordHasher(rounds=4, max_workers=1, max_queue=0, queue_timeout=0.05)
+    hasher._slots.acquire()  # a hash in flight
+    try:
+        with pytest.raises(HasherBusy):
+            hasher.hash('pw')
+    finally:
+        hasher._slots.release()
+    assert hasher.check(hasher.hash('pw'), 'pw')
+    hasher.close()
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from app.backends import KerasBackend, TFLiteBackend, backend_identity, compare, convert, load_backend, tflite_path
+from app.inference import InferenceEngine
+
+@pytest.fixture
+def stub_artifacts(tmp_path, stub_model):
+    model_path = str(tmp_path / 'model.keras')
+    stub_model.save(model_path)
+    artifact = tflite_path(model_path, 'float16')
+    with open(artifact, 'wb') as f:
+        f.write(convert(stub_model, 'float16'))
+    return model_path, artifact
+
+def backend_config(model_path, backend='tflite'):
+    return {
+        'MODEL_PATH': model_path, 'MODEL_INPUT_SIZE': 32, 'INFERENCE_BACKEND': backend,
+        'TFLITE_QUANTIZATION': 'float16', 'TFLITE_MODEL_PATH': None, 'TFLITE_VERIFY_IMAGES': 4,
+        'INFERENCE_INTRA_OP_THREADS': 0, 'GRADCAM_CLASSES': 1,
+    }
+
+def test_compare_reports_top1_agreement():
+    reference = np.array([[0.9, 0.1], [0.2, 0.8]])
+    delta = compare(reference, np.array([[0.8, 0.2], [0.6, 0.4]]))
+    assert delta["top1_agreement"] == 0.5
+    assert delta["max_abs_diff"] == pytest.approx(0.4)
+
+def test_tflite_backend_matches_keras(stub_model, stub_artifacts):
+    engine = InferenceEngine(stub_model, 'last_conv')
+    backend = TFLiteBackend(stub_artifacts[1], engine, quantization='float16')
+    images = np.random.uniform(-1, 1, (3, 32, 32, 3)).astype(np.float32)
+
+    np.testing.assert_allclose(backend.predict(images), engine.predict(images), atol=1e-2)
+    # The interpreter is resized for a new batch size
+    assert backend.predict(images[:1]).shape == (1, 5)
+    assert backend.stats()["latency"]["predict"]["batches"] == 2
+
+def test_tflite_backend_explains_with_keras(stub_model, stub_artifacts):
+    engine = InferenceEngine(stub_model, 'last_conv')
+    backend = TFLiteBackend(stub_artifacts[1], engine)
+    images = np.random.uniform(-1, 1, (2, 32, 32, 3)).astype(np.float32)
+
+    predictions, heatmaps = backend.predict_and_explain(images)
+
+    expected_predictions, expected_heatmaps = engine.predict_and_explain(images)
+    np.testing.assert_allclose(predictions, expected_predictions)
+    np.testing.assert_allclose(heatmaps, expected_heatmaps)
+    np.testing.assert_allclose(backend.explain(images), expected_heatmaps)
+
+def test_load_backend_verifies_tflite(stub_artifacts):
+    backend = load_backend(backend_config(stub_artifacts[0]))
+    assert isinstance(backend, TFLiteBackend)
+    assert backend.accuracy["images"] == 4
+    assert backend.accuracy["top1_agreement"] == 1.0
+
+def test_load_backend_falls_back_without_artifact(tmp_path, stub_model):
+    model_path = str(tmp_path / 'model.keras')
+    stub_model.save(model_path)
+    config = backend_config(model_path)
+
+    assert isinstance(load_backend(config), KerasBackend)
+    assert '|tflite:' not in backend_identity(config)
@@ -0,0 +1,77 @@
+import threading
+import numpy as np
+import pytest
+from app.batching import MicroBatcher
+
+def _double(images):
+    return images * 2, images.sum(axis=(1, 2, 3))
+
+def test_results_are_routed_to_callers():
+    batcher = MicroBatcher(_double, max_batch_size=4, max_wait_ms=50)
+    images = [np.full((2, 2, 1), i, dtype=np.float32) for i in range(10)]
+    futures = [batcher.submit(image) for image in images]
+
+    for i, future in enumerate(futures):
+        doubled, total = future.result(timeout=5)
+        assert doubled.shape == (2, 2, 1)
+        assert doubled[0, 0, 0] == 2 * i
+        assert total == 4 * i
+
+    stats = batcher.stats()
+    batcher.close()
+    assert stats["items"] == 10
+    assert stats["batches"] < 10
+    assert 0 < stats["fill_ratio"] <= 1
+
+def test_concurrent_requests_share_a_batch():
+    sizes = []
+    def run_batch(images):
+        sizes.append(len(images))
+        return (images,)
+
+    batcher = MicroBatcher(run_batch, max_batch_size=8, max_wait_ms=200)
+    barrier = threading.Barrier(8)
+    def worker():
+        barrier.wait()
+        batcher.submit(np.zeros((1,), dtype=np.float32)).result(timeout=5)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    batcher.close()
+    assert sum(sizes) == 8
+    assert max(sizes) > 1
+
+def test_errors_propagate_to_every_caller():
+    def fail(images):
+        raise ValueError("boom")
+
+    batcher = MicroBatcher(fail, max_batch_size=2, max_wait_ms=50)
+    futures = [batcher.submit(np.zeros((1,))) for _ in range(2)]
+    for future in futures:
+        with pytest.raises(ValueError):
+            future.result(timeout=5)
+    batcher.close()
+
+def test_groups_share_a_batch_and_get_their_slice():
+    masks = []
+
+    def run(images, explain=None):
+        masks.append(None if explain is None else list(explain))
+        return images * 2, None
+
+    batcher = MicroBatcher(run, max_batch_size=2, max_wait_ms=50)
+    try:
+        single = batcher.submit(np.full((1,), 1.0, np.float32))
+        group = batcher.submit_many(np.arange(3, dtype=np.float32)[:, None], explain=1)
+        doubled, nothing = single.result(timeout=5)
+        assert doubled.tolist() == [2.0] and nothing is None
+        doubled, nothing = group.result(timeout=5)
+        assert doubled.tolist() == [[0.0], [2.0], [4.0]] and nothing is None
+        # The group isn't split to respect max_batch_size
+        assert masks == [[True, True, False, False]]
+        assert batcher.stats()['batches'] == 1
+    finally:
+        batcher.close()
@@ -0,0 +1,15 @@
+import json
+import os
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_bench_predict_runs_with_default_config(tmp_path):
+    env = {name: value for name, value in os.environ.items() if not name.startswith('GRADCAM_')}
+    output = tmp_path / 'predict.json'
+    subprocess.run([sys.executable, '-m', 'benchmarks.bench_predict', '--input-size', '64', '--sizes', '96x64',
+                    '--repeat', '1', '--duration', '0', '--output', str(output)],
+                   cwd=BACKEND_DIR, env=env, check=True, capture_output=True, timeout=300)
+    stages = json.loads(output.read_text())["stages"][0]["stages"]
+    assert stages["gradcam"]["mean_ms"] > 0 and stages["overlay"]["mean_ms"] > 0
@@ -0,0 +1,42 @@
+from app.cache import PredictionCache, cache_key, image_digest
+
+def test_lru_is_bounded_and_backed_by_disk(tmp_path):
+    cache = PredictionCache(str(tmp_path / 'index.db'), max_entries=2)
+    cache.set_model('model-a')
+    for i in range(3):
+        cache.put(f'k{i}', {'value': i})
+
+    stats = cache.stats()
+    assert stats['memory_entries'] == 2
+    assert stats['disk_entries'] == 3
+
+    # Evicted from memory but still served from the disk index
+    assert cache.get('k0') == {'value': 0}
+    assert cache.get('missing') is None
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+def test_index_survives_restart_for_same_model(tmp_path):
+    path = str(tmp_path / 'index.db')
+    cache = PredictionCache(path)
+    cache.set_model('model-a')
+    cache.put('k', {'value': 1})
+
+    reopened = PredictionCache(path)
+    reopened.set_model('model-a')
+    assert reopened.get('k') == {'value': 1}
+
+def test_new_model_invalidates(tmp_path):
+    path = str(tmp_path / 'index.db')
+    cache = PredictionCache(path)
+    cache.set_model('model-a')
+    cache.put('k', {'value': 1})
+
+    cache.set_model('model-b')
+    assert cache.get('k') is None
+    assert PredictionCache(path).stats()['disk_entries'] == 0
+
+def test_keys_depend_on_model():
+    digest = image_digest(b'xray')
+    assert cache_key(digest, 'a') != cache_key(digest, 'b')
+    assert cache_key(digest, 'a') == cache_key(image_digest(b'xray'), 'a')
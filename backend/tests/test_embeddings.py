@@ -0,0 +1,80 @@
+import numpy as np
+from app.embeddings import EmbeddingIndex, EmbeddingStore, exact_search, normalize
+
+def _clustered(n, dim=16, clusters=20, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim))
+    return (centers[rng.integers(0, clusters, n)] + 0.2 * rng.normal(size=(n, dim))).astype(np.float32)
+
+def test_store_appends_float16_records(tmp_path):
+    store = EmbeddingStore(str(tmp_path))
+    store.add([1, 2], [7, None], np.array([[3.0, 4.0], [1.0, 0.0]]))
+    store.add([3], [7], np.array([[0.0, 2.0]]))
+
+    reopened = EmbeddingStore(str(tmp_path))
+    records = reopened.records()
+    assert reopened.dim == 2 and records.dtype['vector'].base == np.float16
+    assert list(records['id']) == [1, 2, 3] and list(records['owner']) == [7, -1, 7]
+    np.testing.assert_allclose(records['vector'][0], [0.6, 0.8], atol=1e-3)
+    assert reopened.position(3) == 2 and reopened.position(4) is None
+    assert list(reopened.owner_positions(7)) == [0, 2] and list(reopened.owner_positions(8)) == []
+
+    # Records appended by another process are indexed when next mapped
+    store.add([4, 3], [8, 7], np.array([[1.0, 0.0], [0.0, 1.0]]))
+    assert reopened.position(3) == 4 and reopened.position(4) == 3
+    assert list(reopened.owner_positions(7)) == [0, 2, 4] and list(reopened.owner_positions(8)) == [3]
+
+def test_exact_search_filters_owner_and_self(tmp_path):
+    index = EmbeddingIndex(str(tmp_path), background=False)
+    index.add([1, 2, 3, 4], [1, 1, 2, 1], np.array([[1, 0], [0.9, 0.1], [1, 0.01], [0, 1]], np.float32))
+
+    assert [match for match, _ in index.search(1, k=2)] == [3, 2]
+    matches = index.search(1, k=5, owner=1)
+    assert [match for match, _ in matches] == [2, 4]
+    assert matches[0][1] > 0.99
+    assert index.search(99) is None
+
+def test_ivf_index_matches_exact_search_and_updates_incrementally(tmp_path):
+    vectors = _clustered(3000)
+    index = EmbeddingIndex(str(tmp_path), ivf_min_size=2000, probes=8, update_every=500, background=False)
+    index.add(np.arange(1, 2001), [None] * 2000, vectors[:2000])
+    assert index.update() == 'train'
+    assert index.stats()['index'] == 'ivfpq'
+
+    # Added after training: scanned exactly until the index is extended
+    index.add(np.arange(2001, 3001), [None] * 1000, vectors[2000:])
+    assert index.stats()['exact_tail'] == 1000
+    records = index.store.records()
+    queries = range(1, 3001, 60)
+
+    def recall(search_index):
+        hits = 0
+        for query in queries:
+            _, positions = exact_search(records, normalize(vectors[query - 1])[0], 10, exclude_id=query)
+            expected = set(records['id'][positions])
+            hits += len(expected & {match for match, _ in search_index.search(query, k=10)})
+        return hits / (10 * len(queries))
+
+    assert recall(index) >= 0.9
+    assert index.update() == 'extend'
+    assert index.stats()['exact_tail'] == 0
+    # Another process (or a restart) picks the index up from disk
+    reopened = EmbeddingIndex(str(tmp_path), ivf_min_size=2000, probes=8, background=False)
+    assert reopened.stats()['ivf']['indexed'] == 3000
+    assert recall(reopened) >= 0.9
+
+def test_ivf_search_is_restricted_to_the_owner(tmp_path):
+    vectors = _clustered(3000)
+    owners = [1 + i % 3 for i in range(3000)]
+    index = EmbeddingIndex(str(tmp_path), ivf_min_size=500, probes=8, background=False)
+    index.add(np.arange(1, 2501), owners[:2500], vectors[:2500])
+    assert index.update() == 'train'
+    index.add(np.arange(2501, 3001), owners[2500:], vectors[2500:])
+
+    records = index.store.records()
+    for query in range(2, 3001, 150):
+        owner = owners[query - 1]
+        _, positions = exact_search(records, normalize(vectors[query - 1])[0], 10, owner=owner, exclude_id=query)
+        matches = index.search(query, k=10, owner=owner)
+        assert all(owners[match - 1] == owner and match != query for match, _ in matches)
+        assert len(set(records['id'][positions]) & {match for match, _ in matches}) >= 8
@@ -0,0 +1,49 @@
+import cv2
+import numpy as np
+import pytest
+from app.heatmaps import OverlayCache, OverlayParams, decode_heatmap, encode_heatmap, heatmap_count, render_overlay
+
+def test_heatmap_roundtrip_is_compact():
+    heatmap = np.random.rand(7, 7).astype(np.float32)
+    blob = encode_heatmap(heatmap)
+    assert len(blob) == 4 + 7 * 7 * 2
+    np.testing.assert_allclose(decode_heatmap(blob), heatmap, atol=1e-3)
+
+def test_per_class_heatmaps_roundtrip():
+    heatmaps = np.random.rand(3, 7, 7).astype(np.float32)
+    blob = encode_heatmap(heatmaps)
+    assert len(blob) == 8 + 3 * 7 * 7 * 2 and heatmap_count(blob) == 3
+    for index in range(3):
+        np.testing.assert_allclose(decode_heatmap(blob, index), heatmaps[index], atol=1e-3)
+    assert heatmap_count(encode_heatmap(heatmaps[0])) == 1
+    with pytest.raises(IndexError):
+        decode_heatmap(blob, 3)
+
+def test_params_validation():
+    params = OverlayParams.from_args({'size': 'original', 'colormap': 'Viridis', 'format': 'webp'}, 'gradcam_x.jpg')
+    assert (params.size, params.colormap, params.fmt) == ('original', 'viridis', 'webp')
+    assert OverlayParams.from_args({}, 'gradcam_x.png').fmt == 'png'
+    # The top class keeps the cache key it had before per-class heatmaps
+    top, second = OverlayParams.from_args({'class': '0'}, 'x.jpg'), OverlayParams.from_args({'class': '2'}, 'x.jpg')
+    assert top.cache_key(b'h', 'a.png') == OverlayParams().cache_key(b'h', 'a.png') != second.cache_key(b'h', 'a.png')
+    for bad in ({'size': '0'}, {'size': 'big'}, {'colormap': 'rainbow'}, {'intensity': '2'}, {'format': 'gif'},
+                {'class': 'first'}, {'class': '-1'}):
+        with pytest.raises(ValueError):
+            OverlayParams.from_args(bad, 'gradcam_x.jpg')
+
+@pytest.mark.parametrize('size, expected', [(None, (224, 224)), ('original', (300, 400)), (200, (150, 200))])
+def test_render_sizes(size, expected):
+    base = np.zeros((300, 400, 3), dtype=np.uint8)
+    data = render_overlay(np.random.rand(7, 7), base, OverlayParams(size=size, fmt='png'))
+    decoded = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    assert decoded.shape[:2] == expected
+
+def test_overlay_cache_is_bounded(tmp_path):
+    cache = OverlayCache(str(tmp_path), max_bytes=2500)
+    for i in range(5):
+        cache.put(f'{i:064x}', 'png', b'x' * 1000)
+    assert sum(f.stat().st_size for f in tmp_path.rglob('*') if f.is_file()) <= 2500
+    assert cache.get(f'{4:064x}', 'png') is not None
+    assert cache.get(f'{0:064x}', 'png') is None
+    # Sharded two levels deep by key prefix
+    assert cache.path_for(f'{4:064x}', 'png') == str(tmp_path / '00' / '00' / f'{4:064x}.png')
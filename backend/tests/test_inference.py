@@ -0,0 +1,77 @@
+import numpy as np
+from app.inference import InferenceEngine, find_conv_layer
+
+def test_find_conv_layer_fallback(stub_model):
+    assert find_conv_layer(stub_model, 'last_conv') == 'last_conv'
+    assert find_conv_layer(stub_model, 'conv5_block3_out') == 'last_conv'
+
+def test_predict_and_explain_matches_model(stub_model):
+    engine = InferenceEngine(stub_model, 'last_conv')
+    images = np.random.uniform(-1, 1, (3, 32, 32, 3)).astype(np.float32)
+
+    predictions, heatmaps = engine.predict_and_explain(images)
+
+    np.testing.assert_allclose(predictions, stub_model.predict(images, verbose=0), rtol=1e-5, atol=1e-6)
+    assert heatmaps.shape == (3, 30, 30)
+    assert heatmaps.min() >= 0 and heatmaps.max() <= 1.0
+
+def test_grad_model_is_reused(stub_model):
+    engine = InferenceEngine(stub_model, 'last_conv')
+    grad_model = engine.grad_model
+    images = np.zeros((1, 32, 32, 3), dtype=np.float32)
+    engine.predict_and_explain(images)
+    engine.predict_and_explain(images)
+    assert engine.grad_model is grad_model
+    np.testing.assert_allclose(engine.predict(images), stub_model.predict(images, verbose=0), rtol=1e-5, atol=1e-6)
+
+def _reference_gradcam(model, image, layer_name):
+    """Textbook single-image Grad-CAM of the top class, as first shipped."""
+    import tensorflow as tf
+    grad_model = tf.keras.models.Model([model.inputs], [model.get_layer(layer_name).output, model.output])
+    with tf.GradientTape() as tape:
+        conv_outputs, predictions = grad_model(image)
+        loss = predictions[:, int(np.argmax(predictions[0]))]
+    pooled_grads = tf.reduce_mean(tape.gradient(loss, conv_outputs), axis=(0, 1, 2)).numpy()
+    conv_outputs = conv_outputs[0].numpy()
+    for i in range(len(pooled_grads)):
+        conv_outputs[:, :, i] *= pooled_grads[i]
+    heatmap = np.maximum(np.mean(conv_outputs, axis=-1), 0)
+    return heatmap / (np.max(heatmap) + 1e-10)
+
+def test_heatmap_matches_legacy_gradcam(stub_model):
+    engine = InferenceEngine(stub_model, 'last_conv')
+    image = np.random.uniform(-1, 1, (1, 32, 32, 3)).astype(np.float32)
+
+    _, heatmaps = engine.predict_and_explain(image)
+
+    np.testing.assert_allclose(heatmaps[0], _reference_gradcam(stub_model, image, 'last_conv'), atol=1e-4)
+
+def test_heatmaps_for_top_classes_in_one_pass(stub_model):
+    import tensorflow as tf
+    engine = InferenceEngine(stub_model, 'last_conv', explain_classes=3)
+    images = np.random.uniform(-1, 1, (2, 32, 32, 3)).astype(np.float32)
+
+    predictions, heatmaps = engine.predict_and_explain(images)
+    assert heatmaps.shape == (2, 3, 30, 30)
+    # The top class is explained exactly as with a single heatmap
+    _, top = InferenceEngine(stub_model, 'last_conv').predict_and_explain(images)
+    np.testing.assert_allclose(heatmaps[:, 0], top, atol=1e-5)
+
+    grad_model = tf.keras.Model(stub_model.inputs, [stub_model.get_layer('last_conv').output, stub_model.output])
+    for rank in range(3):
+        classes = np.argsort(-predictions, axis=1)[:, rank]
+        with tf.GradientTape() as tape:
+            conv_outputs, scores = grad_model(images)
+            score = tf.gather(scores, classes, batch_dims=1)
+        weights = tf.reduce_mean(tape.gradient(score, conv_outputs), axis=(1, 2))
+        expected = np.maximum(np.einsum('bhwc,bc->bhw', conv_outputs.numpy(), weights.numpy()), 0)
+        expected /= expected.max(axis=(1, 2), keepdims=True) + 1e-10
+        np.testing.assert_allclose(heatmaps[:, rank], expected, atol=1e-4)
+
+def test_warmup_traces_once_for_all_batch_sizes(stub_model):
+    engine = InferenceEngine(stub_model, 'last_conv')
+    engine.warmup(default_size=32)
+    assert engine._fused_fn.experimental_get_tracing_count() == 1
+
+    engine.predict_and_explain(np.zeros((4, 32, 32, 3), dtype=np.float32))
+    assert engine._fused_fn.experimental_get_tracing_count() == 1
@@ -0,0 +1,126 @@
+import struct
+import cv2
+import numpy as np
+import pytest
+from app import ingest
+from app.preprocess import image_extension
+
+LIMITS = ingest.IngestLimits(band_bytes=64 * 1024, max_decode_bytes=8 << 20)
+
+def _element(group, element, vr, value):
+    if len(value) % 2:
+        value += b' '
+    if vr in (b'OB', b'OW', b'SQ', b'UN'):
+        return struct.pack('<HH2sHI', group, element, vr, 0, len(value)) + value
+    return struct.pack('<HH2sH', group, element, vr, len(value)) + value
+
+def write_dicom(path, pixels, window=None, rescale=None, photometric=b'MONOCHROME2', bits_stored=12):
+    """Explicit VR little endian DICOM with an undefined-length sequence before the pixels."""
+    syntax = _element(0x0002, 0x0010, b'UI', b'1.2.840.10008.1.2.1\x00')
+    meta = _element(0x0002, 0x0000, b'UL', struct.pack('<I', len(syntax))) + syntax
+    sequence = (struct.pack('<HH2sHI', 0x0008, 0x1140, b'SQ', 0, 0xFFFFFFFF)
+                + struct.pack('<HHI', 0xFFFE, 0xE000, 0xFFFFFFFF)
+                + _element(0x0008, 0x1150, b'UI', b'1.2.3\x00')
+                + struct.pack('<HHI', 0xFFFE, 0xE00D, 0)
+                + struct.pack('<HHI', 0xFFFE, 0xE0DD, 0))
+    data = sequence + b''.join([
+        _element(0x0028, 0x0002, b'US', struct.pack('<H', 1)),
+        _element(0x0028, 0x0004, b'CS', photometric),
+        _element(0x0028, 0x0010, b'US', struct.pack('<H', pixels.shape[0])),
+        _element(0x0028, 0x0011, b'US', struct.pack('<H', pixels.shape[1])),
+        _element(0x0028, 0x0100, b'US', struct.pack('<H', 16)),
+        _element(0x0028, 0x0101, b'US', struct.pack('<H', bits_stored)),
+        _element(0x0028, 0x0103, b'US', struct.pack('<H', 0)),
+    ])
+    if window:
+        data += _element(0x0028, 0x1050, b'DS', str(window[0]).encode())
+        data += _element(0x0028, 0x1051, b'DS', str(window[1]).encode())
+    if rescale:
+        data += _element(0x0028, 0x1052, b'DS', str(rescale[1]).encode())
+        data += _element(0x0028, 0x1053, b'DS', str(rescale[0]).encode())
+    data += _element(0x7FE0, 0x0010, b'OW', pixels.astype('<u2').tobytes())
+    with open(path, 'wb') as f:
+        f.write(b'\0' * 128 + b'DICM' + meta + data)
+
+def _radiograph(height=1200, width=900):
+    pixels = np.random.default_rng(0).integers(0, 4096, (height, width)).astype(np.uint16)
+    pixels[100:300, 100:300] = 4000
+    return pixels
+
+def test_dicom_read_in_bands_and_windowed(tmp_path):
+    pixels = _radiograph()
+    # Bits above BitsStored (e.g. overlays) are ignored
+    write_dicom(tmp_path / 'scan.dcm', pixels | 0x8000, window=(2048, 4096))
+    assert image_extension((tmp_path / 'scan.dcm').read_bytes()[:256]) == '.dcm'
+    assert ingest.image_size(str(tmp_path / 'scan.dcm')) == (1200, 900)
+
+    image = ingest.open_image(str(tmp_path / 'scan.dcm'), LIMITS)
+    assert isinstance(image.pixels, ingest.RawPixels) and image.window == (2048, 4096)
+    img = ingest.load(str(tmp_path / 'scan.dcm'), LIMITS, min_edge=224)
+    assert img.shape == (300, 225, 3) and img.dtype == np.uint8
+
+    expected = cv2.resize(pixels.astype(np.float32), (225, 300), interpolation=cv2.INTER_AREA) / 4096 * 255
+    np.testing.assert_allclose(img[:, :, 0], expected, atol=1.01)
+
+def test_monochrome1_and_rescale(tmp_path):
+    pixels = _radiograph(64, 48)
+    write_dicom(tmp_path / 'inverted.dcm', pixels, window=(1024, 2048), rescale=(0.5, 0), photometric=b'MONOCHROME1')
+    img = ingest.load(str(tmp_path / 'inverted.dcm'), LIMITS)
+    expected = 255 - np.clip(pixels * 0.5 / 2048 * 255, 0, 255)
+    np.testing.assert_allclose(img[:, :, 0], expected, atol=1.01)
+
+def test_sixteen_bit_png_and_uncompressed_tiff(tmp_path):
+    pixels = _radiograph()
+    cv2.imwrite(str(tmp_path / 'scan.png'), pixels)
+    cv2.imwrite(str(tmp_path / 'scan.tif'), pixels, [cv2.IMWRITE_TIFF_COMPRESSION, 1])
+
+    assert isinstance(ingest.open_image(str(tmp_path / 'scan.tif'), LIMITS).pixels, ingest.RawPixels)
+    from_png = ingest.load(str(tmp_path / 'scan.png'), LIMITS, min_edge=224)
+    from_tiff = ingest.load(str(tmp_path / 'scan.tif'), LIMITS, min_edge=224)
+    np.testing.assert_array_equal(from_png, from_tiff)
+    # Percentile windowing keeps the 16-bit dynamic range instead of the top byte
+    assert from_png.std() > 20
+
+    # Compressed 16-bit images must be decoded whole, so they are refused past the limit
+    with pytest.raises(ingest.ImageTooLarge):
+        ingest.load(str(tmp_path / 'scan.png'), ingest.IngestLimits(max_decode_bytes=1024))
+
+def test_plain_images_and_non_images(tmp_path):
+    image = np.random.default_rng(1).integers(0, 255, (300, 400, 3), dtype=np.uint8)
+    cv2.imwrite(str(tmp_path / 'photo.png'), image)
+    np.testing.assert_array_equal(ingest.load(str(tmp_path / 'photo.png'), LIMITS), image)
+    assert ingest.load(str(tmp_path / 'photo.png'), LIMITS, max_edge=200).shape == (150, 200, 3)
+    (tmp_path / 'notes.txt').write_bytes(b'not an image')
+    assert ingest.read(str(tmp_path / 'notes.txt'), LIMITS) == (None, None)
+
+def test_tiles_cover_the_image_and_stitch():
+    boxes = ingest.tile_boxes((1000, 700), 512, 64)
+    assert len(boxes) == 6
+    covered = np.zeros((1000, 700), bool)
+    for top, left, bottom, right in boxes:
+        assert (bottom - top, right - left) == (512, 512)
+        covered[top:bottom, left:right] = True
+    assert covered.all()
+
+    heatmaps = [np.zeros((7, 7), np.float32) for _ in boxes]
+    heatmaps[0][1, 1] = 1.0
+    stitched = ingest.stitch_heatmaps((1000, 700), boxes, heatmaps)
+    assert stitched.max() == pytest.approx(1.0)
+    hot = np.unravel_index(stitched.argmax(), stitched.shape)
+    assert hot[0] < stitched.shape[0] // 4 and hot[1] < stitched.shape[1] // 4
+    assert ingest.stitch_heatmaps((1000, 700), boxes, [None] * len(boxes)) is None
+
+def test_eight_bit_decodes_are_bounded(tmp_path):
+    image = np.random.default_rng(2).integers(0, 255, (1600, 1200, 3), dtype=np.uint8)
+    cv2.imwrite(str(tmp_path / 'large.png'), image)
+    cv2.imwrite(str(tmp_path / 'large.jpg'), image)
+    limits = ingest.IngestLimits(max_decode_bytes=1 << 20)
+
+    # Refused from the header, before anything is decoded
+    with pytest.raises(ingest.ImageTooLarge):
+        ingest.read(str(tmp_path / 'large.png'), limits, max_edge=400)
+    with pytest.raises(ingest.ImageTooLarge):
+        ingest.read(str(tmp_path / 'large.jpg'), limits)
+    # A max_edge alone is enough for a reduced JPEG decode
+    img, size = ingest.read(str(tmp_path / 'large.jpg'), limits, max_edge=400)
+    assert img.shape == (400, 300, 3) and size == (400, 300)
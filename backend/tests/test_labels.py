@@ -0,0 +1,34 @@
+import json
+import numpy as np
+from app.labels import LabelMap
+
+def test_bundled_imagenet_index_loads_offline():
+    labels = LabelMap.for_model('/nonexistent/model.h5', 1000)
+    assert len(labels) == 1000
+    assert labels.names[1] == 'goldfish' and labels.synsets[1] == 'n01443537'
+    # "monitor" classes are pinned to normal, as before
+    assert labels.fixed_severity[list(labels.names).index('monitor')] == 'normal'
+
+def test_top_k_matches_full_sort():
+    predictions = np.random.default_rng(0).random((8, 1000)).astype(np.float32)
+    indices, scores = LabelMap.placeholder(1000).top_k(predictions, k=3)
+    np.testing.assert_array_equal(indices, np.argsort(-predictions, axis=1)[:, :3])
+    np.testing.assert_array_equal(scores, np.take_along_axis(predictions, indices, axis=1))
+
+def test_severity_thresholds_and_fixed_classes():
+    labels = LabelMap(['a', 'b'], ['lesion', 'normal_tissue'])
+    assert list(labels.severity([0, 0, 0, 0, 0, 1], [20, 20.5, 50, 80, 95, 95])) == \
+        ['normal', 'mild', 'mild', 'moderate', 'severe', 'normal']
+
+def test_class_index_next_to_model(tmp_path):
+    model_path = tmp_path / 'model.h5'
+    (tmp_path / 'model.labels.json').write_text(json.dumps({
+        '0': {'name': 'effusion', 'severity': 'severe'},
+        '1': ['n0', 'no_finding'],
+    }))
+    labels = LabelMap.for_model(str(model_path), 2)
+    (decoded, name, confidence, severity), = labels.interpret(np.array([0.3, 0.7]))
+    assert (name, severity) == ('no_finding', 'moderate')
+    assert labels.interpret(np.array([0.9, 0.1]))[0][3] == 'severe'
+    # A class index for a different number of classes is ignored
+    assert LabelMap.for_model(str(model_path), 3).source == 'placeholder'
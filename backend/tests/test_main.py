@@ -1,5 +1,6 @@
 import json
 import io
+import pytest
 
 def test_home(client):
     response = client.get('/')
@@ -35,3 +36,392 @@ def test_predict_no_image(client, init_database):
     # If model is None (likely in clean test env unless we mock it globally), it returns 500.
     # I should assert 500 or 400.
     assert response.status_code in [400, 500]
+
+def _png(seed=0):
+    import cv2
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    ok, buf = cv2.imencode('.png', rng.integers(0, 255, (64, 48, 3), dtype=np.uint8))
+    return buf.tobytes()
+
+def test_predict_batch_streams_ndjson(client, init_database, stub_inference):
+    import zipfile
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zf:
+        zf.writestr('study/a.png', _png(1))
+        zf.writestr('study/b.png', _png(2))
+        zf.writestr('study/notes.txt', b'ignored')
+
+    response = client.post('/api/predict/batch', data={
+        'images': [
+            (io.BytesIO(_png(0)), 'single.png'),
+            (io.BytesIO(b'not an image'), 'broken.png'),
+            (io.BytesIO(archive.getvalue()), 'study.zip'),
+        ]
+    }, content_type='multipart/form-data')
+
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    lines = [json.loads(line) for line in response.data.decode().splitlines()]
+    results, summary = lines[:-1], lines[-1]
+
+    assert len(results) == 4
+    errors = [r for r in results if 'error' in r]
+    assert [r['filename'] for r in errors] == ['broken.png']
+    for r in results:
+        if 'error' not in r:
+            assert set(r) >= {'predicted_class', 'confidence', 'severity', 'gradcam_image', 'differential'}
+    assert summary['done'] is True
+    assert summary['count'] == 3
+
+    from app.models import Prediction
+    stub_inference.persister.sync()
+    assert Prediction.query.count() == 3
+    assert sorted(summary['ids'].values()) == sorted(r['id'] for r in results if 'error' not in r)
+
+def test_predict_batch_no_images(client, stub_inference):
+    response = client.post('/api/predict/batch')
+    assert response.status_code == 400
+
+def test_predict_reupload_hits_cache(app, client, init_database, stub_inference):
+    import os
+    from app.cache import image_digest
+    image = _png(7)
+
+    first = client.post('/api/predict', data={'image': (io.BytesIO(image), 'a.png')}, content_type='multipart/form-data')
+    second = client.post('/api/predict', data={'image': (io.BytesIO(image), 'b.png')}, content_type='multipart/form-data')
+
+    assert first.status_code == 200 and second.status_code == 200
+    first_data, second_data = json.loads(first.data), json.loads(second.data)
+    assert first_data['id'] != second_data['id']
+    for field in ('predicted_class', 'confidence', 'severity', 'gradcam_image', 'differential'):
+        assert first_data[field] == second_data[field]
+
+    stats = json.loads(client.get('/api/cache/stats').data)
+    assert stats['hits'] == 1 and stats['misses'] == 1
+    digest = image_digest(image)
+    stored = os.listdir(os.path.join(app.config['UPLOAD_FOLDER'], digest[:2], digest[2:4]))
+    assert stored == [f'{digest}.png']
+
+def test_predict_renders_gradcam_in_background(client, init_database, stub_inference):
+    response = client.post('/api/predict', data={'image': (io.BytesIO(_png(11)), 'a.png')}, content_type='multipart/form-data')
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert data['gradcam_job'] == data['id']
+
+    status = json.loads(client.get(f"/api/gradcam/{data['gradcam_job']}?wait=10").data)
+    assert status['status'] == 'done'
+    assert status['gradcam_image'].endswith('.jpg')
+
+    from app.models import Prediction
+    from app.extensions import db
+    stub_inference.persister.sync()
+    db.session.expire_all()
+    assert db.session.get(Prediction, data['id']).gradcam_path is not None
+
+def test_predict_inline_gradcam_when_async_disabled(app, client, init_database, stub_inference):
+    app.config['GRADCAM_ASYNC'] = False
+    try:
+        stub_inference._start_inference(app, stub_inference.registry.active().engine)
+        response = client.post('/api/predict', data={'image': (io.BytesIO(_png(12)), 'a.png')}, content_type='multipart/form-data')
+    finally:
+        app.config['GRADCAM_ASYNC'] = True
+    data = json.loads(response.data)
+    assert 'gradcam_job' not in data
+    assert data['gradcam_image'] is not None
+
+def test_differential_gets_per_class_heatmaps(app, client, init_database, stub_inference, stub_model):
+    from app.inference import InferenceEngine
+    app.config['GRADCAM_ASYNC'] = False
+    try:
+        stub_inference._start_inference(app, InferenceEngine(stub_model, 'last_conv', explain_classes=3))
+        response = client.post('/api/predict', data={'image': (io.BytesIO(_png(15)), 'a.png')}, content_type='multipart/form-data')
+    finally:
+        app.config['GRADCAM_ASYNC'] = True
+    data = json.loads(response.data)
+    urls = [item['gradcam_image'] for item in data['differential']]
+    assert urls[0] == data['gradcam_image'] and urls[1:] == [f"{urls[0]}?class=1", f"{urls[0]}?class=2"]
+    status = json.loads(client.get(f"/api/gradcam/{data['id']}").data)
+    assert status['gradcam_images'] == urls
+
+    path = urls[0].replace('http://localhost', '')
+    top, second = client.get(path), client.get(urls[1].replace('http://localhost', ''))
+    assert second.status_code == 200 and second.headers['ETag'] != top.headers['ETag']
+    assert client.get(path + '?class=3').status_code == 404
+    assert client.get(path + '?class=-1').status_code == 400
+
+def test_predict_with_test_time_augmentation(app, client, init_database, stub_inference):
+    image = _png(16)
+    plain = json.loads(client.post('/api/predict', data={'image': (io.BytesIO(image), 'a.png')},
+                                   content_type='multipart/form-data').data)
+    assert 'uncertainty' not in plain
+
+    response = client.post('/api/predict?tta=true', data={'image': (io.BytesIO(image), 'a.png')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert data['tta_views'] == app.config['TTA_VIEWS'] and data['uncertainty'] >= 0
+    # Averaged over views, so not the single-view result from the cache
+    assert data['confidence'] != plain['confidence']
+
+    from app.models import Prediction
+    from app.extensions import db
+    stub_inference.persister.sync()
+    row = db.session.get(Prediction, data['id'])
+    assert (row.tta_views, row.uncertainty) == (data['tta_views'], pytest.approx(data['uncertainty']))
+
+    bad = client.post('/api/predict', data={'image': (io.BytesIO(image), 'a.png'), 'tta': 'maybe'},
+                      content_type='multipart/form-data')
+    assert bad.status_code == 400
+
+def test_tta_views_skip_gradcam_when_explaining_inline(app, client, init_database, stub_inference, monkeypatch):
+    app.config['GRADCAM_ASYNC'] = False
+    try:
+        engine = stub_inference.registry.active().engine
+        explained = []
+        explain = engine.explain
+        monkeypatch.setattr(engine, 'explain', lambda images: explained.append(len(images)) or explain(images))
+        entry = stub_inference._start_inference(app, engine)
+        response = client.post('/api/predict?tta=true', data={'image': (io.BytesIO(_png(17)), 'a.png')},
+                               content_type='multipart/form-data')
+    finally:
+        app.config['GRADCAM_ASYNC'] = True
+    data = json.loads(response.data)
+    assert data['tta_views'] == app.config['TTA_VIEWS'] and data['gradcam_image']
+    # Every view is scored in one batch, and only the unaugmented one explained
+    stats = entry.batcher.stats()
+    assert stats['batches'] == 1 and stats['items'] == app.config['TTA_VIEWS']
+    assert explained == [1]
+
+def test_gradcam_status_unknown_prediction(client, init_database):
+    assert client.get('/api/gradcam/12345').status_code == 404
+
+def test_gradcam_rendered_on_demand(client, init_database, stub_inference):
+    import cv2
+    import numpy as np
+    response = client.post('/api/predict', data={'image': (io.BytesIO(_png(13)), 'a.png')}, content_type='multipart/form-data')
+    data = json.loads(response.data)
+    status = json.loads(client.get(f"/api/gradcam/{data['id']}?wait=10").data)
+    url = status['gradcam_image'].replace('http://localhost', '')
+
+    default = client.get(url)
+    assert default.status_code == 200 and default.mimetype == 'image/jpeg'
+    assert cv2.imdecode(np.frombuffer(default.data, np.uint8), cv2.IMREAD_COLOR).shape[:2] == (224, 224)
+
+    original = client.get(url + '?size=original&format=png&colormap=inferno&intensity=0.3')
+    assert original.mimetype == 'image/png'
+    assert cv2.imdecode(np.frombuffer(original.data, np.uint8), cv2.IMREAD_COLOR).shape[:2] == (64, 48)
+
+    assert client.get(url + '?format=gif').status_code == 400
+
+    # Variants are immutable and revalidate by ETag without rendering
+    assert 'immutable' in default.headers['Cache-Control']
+    revalidated = client.get(url, headers={'If-None-Match': default.headers['ETag']})
+    assert revalidated.status_code == 304
+
+def test_uploads_served_with_strong_etag(client, init_database, stub_inference):
+    from app.cache import image_digest
+    image = _png(14)
+    data = json.loads(client.post('/api/predict', data={'image': (io.BytesIO(image), 'a.png')},
+                                  content_type='multipart/form-data').data)
+    url = f"/static/uploads/{image_digest(image)}.png"
+
+    response = client.get(url)
+    assert response.status_code == 200 and response.data == image
+    assert response.headers['ETag'] == f'"{image_digest(image)}"'
+    assert 'immutable' in response.headers['Cache-Control']
+    assert client.get(url, headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+    assert client.get('/static/uploads/.tmp').status_code == 404
+    assert data['id']
+
+def test_ready_reports_loading(app, client, monkeypatch):
+    from app import main
+    from app.registry import ModelRegistry
+    monkeypatch.setattr(main, 'registry', ModelRegistry(app.config, build=lambda spec: None))
+    monkeypatch.setattr(main, 'model_state', 'loading')
+
+    response = client.get('/api/ready')
+    assert response.status_code == 503
+    assert json.loads(response.data)['model_state'] == 'loading'
+
+    response = client.post('/api/predict')
+    assert response.status_code == 503
+    assert response.headers['Retry-After']
+
+def test_ready_once_model_serving(client, stub_inference):
+    response = client.get('/api/ready')
+    assert response.status_code == 200
+    assert json.loads(response.data)['ready'] is True
+
+def test_predict_stores_upload_verbatim(app, client, init_database, stub_inference):
+    import os
+    from app.models import Prediction
+    data = _png(7)
+    response = client.post('/api/predict', data={'image': (io.BytesIO(data), 'scan.png')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 200
+    stub_inference.persister.sync()
+    with app.app_context():
+        image_path = Prediction.query.get(response.get_json()['id']).image_path
+    assert image_path.endswith('.png')
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], image_path[:2], image_path[2:4], image_path), 'rb') as f:
+        assert f.read() == data
+    stats = client.get('/api/inference/stats').get_json()['preprocess']
+    assert stats['images'] >= 1 and set(stats['mean_ms']) == {'decode', 'store', 'resize_normalize'}
+
+def _history_user(app, rows):
+    from datetime import datetime, timedelta
+    from flask_jwt_extended import create_access_token
+    from app.extensions import db
+    from app.models import Prediction, User
+    with app.app_context():
+        user = User(username='historian', email='h@example.com', password_hash='x')
+        db.session.add(user)
+        db.session.commit()
+        start = datetime(2024, 1, 1)
+        for i, (severity, predicted_class) in enumerate(rows):
+            # Pairs of rows share a timestamp so the id tiebreak is exercised
+            db.session.add(Prediction(
+                image_path=f'{i}.jpg', predicted_class=predicted_class, confidence=50.0, severity=severity,
+                date_posted=start + timedelta(days=i // 2), user_id=user.id
+            ))
+        db.session.commit()
+        return {'Authorization': f'Bearer {create_access_token(identity=str(user.id))}'}
+
+def test_history_keyset_pagination(app, client, init_database):
+    headers = _history_user(app, [('mild', 'Cat'), ('severe', 'Dog')] * 4)
+
+    seen, cursor = [], None
+    while True:
+        response = client.get('/api/history', query_string={'limit': 3, **({'cursor': cursor} if cursor else {})},
+                              headers=headers)
+        assert response.status_code == 200
+        page = response.get_json()
+        seen.extend(row['id'] for row in page)
+        cursor = response.headers.get('X-Next-Cursor')
+        if cursor is None:
+            break
+        assert 'rel="next"' in response.headers['Link']
+    assert seen == list(range(8, 0, -1))
+
+    severe = client.get('/api/history?severity=severe&from=2024-01-02&to=2024-01-04', headers=headers).get_json()
+    assert [row['id'] for row in severe] == [6, 4]
+    assert all(row['predicted_class'] == 'Dog' for row in severe)
+    assert client.get('/api/history?cursor=bogus', headers=headers).status_code == 400
+    assert client.get('/api/history?limit=0', headers=headers).status_code == 400
+
+def test_history_query_uses_composite_index(app, init_database):
+    from sqlalchemy import text
+    from app.extensions import db
+    with app.app_context():
+        plan = db.session.execute(text(
+            "EXPLAIN QUERY PLAN SELECT id FROM prediction WHERE user_id = 1 AND (date_posted, id) < ('2024-01-01', 5) "
+            "ORDER BY date_posted DESC, id DESC LIMIT 10"
+        )).all()
+    detail = ' '.join(row[-1] for row in plan)
+    assert 'ix_prediction_user_date_id' in detail and 'TEMP B-TREE' not in detail
+
+def test_predict_shed_with_retry_after(client, stub_inference, monkeypatch):
+    from app.admission import AdmissionController, Deadline
+    controller = AdmissionController(max_concurrent=1, max_queue=0)
+    monkeypatch.setattr(stub_inference, 'admission', controller)
+    ticket = controller.acquire(Deadline.after(5))
+    try:
+        response = client.post('/api/predict', data={'image': (io.BytesIO(_png(20)), 'a.png')}, content_type='multipart/form-data')
+    finally:
+        ticket.release()
+    assert response.status_code == 503
+    assert int(response.headers['Retry-After']) >= 1
+    assert client.post('/api/predict', data={}).status_code == 400
+
+def test_predict_degraded_skips_gradcam(client, init_database, stub_inference, monkeypatch):
+    from app.admission import AdmissionController
+    monkeypatch.setattr(stub_inference, 'admission', AdmissionController(4, 4, degrade_depth=1))
+    monkeypatch.setattr(stub_inference, '_degraded', lambda queued: True)
+    response = client.post('/api/predict', data={'image': (io.BytesIO(_png(21)), 'a.png')}, content_type='multipart/form-data')
+    data = json.loads(response.data)
+    assert response.status_code == 200
+    assert data['degraded'] is True
+    assert 'gradcam_job' not in data
+
+def test_predict_records_model_version(app, client, init_database, stub_inference):
+    from app.models import Prediction
+    response = client.post('/api/predict', data={'image': (io.BytesIO(_png(22)), 'a.png')}, content_type='multipart/form-data')
+    data = response.get_json()
+    active = stub_inference.registry.active().key
+    assert data['model_version'] == active
+    stub_inference.persister.sync()
+    with app.app_context():
+        assert Prediction.query.filter_by(id=data['id']).one().model_version == active
+
+    models = client.get('/api/models').get_json()
+    assert models['active'] == {'default': active}
+
+    response = client.post('/api/predict?model=default@0', data={'image': (io.BytesIO(_png(22)), 'a.png')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 404
+    assert response.get_json()['models'] == [active]
+
+def test_similar_predictions(app, client, init_database, stub_inference, monkeypatch, tmp_path):
+    import numpy as np
+    import cv2
+    from app.embeddings import EmbeddingIndexes
+    monkeypatch.setattr(stub_inference, 'embedding_indexes', EmbeddingIndexes(str(tmp_path), background=False))
+    headers = _history_user(app, [])
+
+    def predict(image, headers=None):
+        ok, buf = cv2.imencode('.png', image)
+        response = client.post('/api/predict', data={'image': (io.BytesIO(buf.tobytes()), 'a.png')},
+                               content_type='multipart/form-data', headers=headers or {})
+        return response.get_json()['id']
+
+    rng = np.random.default_rng(40)
+    base = rng.integers(0, 200, (64, 48, 3), dtype=np.uint8)
+    query = predict(base, headers)
+    near = predict(base + 3, headers)
+    far = predict(rng.integers(0, 255, (64, 48, 3), dtype=np.uint8), headers)
+    predict(base + 1)  # anonymous: not this user's case
+
+    response = client.get(f'/api/predictions/{query}/similar?k=5', headers=headers)
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['model_version'] == stub_inference.registry.active().key
+    assert [row['id'] for row in data['similar']] == [near, far]
+    assert data['similar'][0]['similarity'] >= data['similar'][1]['similarity']
+    assert data['similar'][0]['image_url'].endswith('.png')
+
+    assert client.get(f'/api/predictions/{query}/similar').status_code == 401
+    assert client.get('/api/predictions/9999/similar', headers=headers).status_code == 404
+
+def test_predict_tiled_dicom(app, client, init_database, stub_inference, monkeypatch, tmp_path):
+    import numpy as np
+    from test_ingest import write_dicom
+    for name, value in {'INGEST_TILED': True, 'INGEST_TILE_MIN_EDGE': 600, 'INGEST_TILE_MAX_EDGE': 600,
+                        'INGEST_TILE_SIZE': 256, 'INGEST_TILE_OVERLAP': 32}.items():
+        monkeypatch.setitem(app.config, name, value)
+    pixels = np.random.default_rng(50).integers(0, 4096, (1200, 800)).astype(np.uint16)
+    write_dicom(tmp_path / 'chest.dcm', pixels, window=(2048, 4096))
+
+    response = client.post('/api/predict', data={'image': ((tmp_path / 'chest.dcm').open('rb'), 'chest.dcm')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 200, response.get_json()
+    data = response.get_json()
+    assert data['gradcam_image'] and 'gradcam_job' not in data
+    stub_inference.persister.sync()
+    with app.app_context():
+        from app.models import Prediction
+        assert Prediction.query.get(data['id']).image_path.endswith('.dcm')
+    assert 'decode' in response.headers['Server-Timing'] and 'stitch' in response.headers['Server-Timing']
+    overlay = client.get(data['gradcam_image'] + '?size=original')
+    assert overlay.status_code == 200 and overlay.mimetype == 'image/jpeg'
+
+    # Tiles are not augmented, and the response says so
+    response = client.post('/api/predict?tta=true', data={'image': ((tmp_path / 'chest.dcm').open('rb'), 'tta.dcm')},
+                           content_type='multipart/form-data')
+    assert response.get_json()['tta_skipped'] == 'tiled' and 'tta_views' not in response.get_json()
+
+    # Below the threshold the same upload is scored whole
+    monkeypatch.setitem(app.config, 'INGEST_TILE_MIN_EDGE', 4096)
+    response = client.post('/api/predict', data={'image': ((tmp_path / 'chest.dcm').open('rb'), 'other.dcm')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 200 and response.get_json()['id'] != data['id']
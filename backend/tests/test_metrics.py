@@ -0,0 +1,67 @@
+import io
+import json
+import logging
+import os
+import cv2
+import numpy as np
+from app import metrics
+from app.logs import JsonFormatter
+
+def _png(seed=0):
+    image = np.random.default_rng(seed).integers(0, 255, (64, 64, 3), dtype=np.uint8)
+    return cv2.imencode('.png', image)[1].tobytes()
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = metrics.Histogram('test_seconds', 'Test.', ('stage',), buckets=(0.1, 1.0))
+    histogram.observe(0.05, 'a')
+    histogram.observe(0.5, 'a')
+    histogram.observe(5.0, 'a')
+
+    text = '\n'.join(histogram.render(dict(histogram._values)))
+
+    assert 'test_seconds_bucket{stage="a",le="0.1"} 1' in text
+    assert 'test_seconds_bucket{stage="a",le="1.0"} 2' in text
+    assert 'test_seconds_bucket{stage="a",le="+Inf"} 3' in text
+    assert 'test_seconds_count{stage="a"} 3' in text
+
+def test_worker_snapshots_are_merged(tmp_path, monkeypatch):
+    counter = metrics.Counter('test_total', 'Test.', ('where',))
+    gauge = metrics.Gauge('test_in_flight', 'Test.')
+    registry = metrics.Registry()
+    registry.register(counter)
+    registry.register(gauge)
+    counter.inc('x', amount=2)
+    gauge.set(1)
+    monkeypatch.setattr(metrics, 'REGISTRY', registry)
+    monkeypatch.setattr(metrics, 'shared_dir', str(tmp_path))
+    # A live worker (our parent) and one that has exited
+    snapshot = {'test_total': {'["x"]': 3}, 'test_in_flight': {'[]': 4}}
+    (tmp_path / f'{os.getppid()}.json').write_text(json.dumps(snapshot))
+    (tmp_path / '999999999.json').write_text(json.dumps(snapshot))
+
+    text = registry.render(metrics.other_snapshots())
+
+    assert 'test_total{where="x"} 8' in text
+    assert 'test_in_flight 5' in text
+
+def test_predict_reports_stages(client, init_database, stub_inference):
+    response = client.post('/api/predict', data={'image': (io.BytesIO(_png(3)), 'scan.png')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 200
+    stages = [part.split(';')[0] for part in response.headers['Server-Timing'].split(', ')]
+    assert stages[:2] == ['store', 'cache_lookup']
+    assert {'decode', 'resize_normalize', 'inference', 'persist', 'json', 'total'} <= set(stages)
+
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'medvisor_stage_duration_seconds_count{stage="inference"' in text
+    assert 'medvisor_request_duration_seconds_count{endpoint="/api/predict",method="POST",status="200"}' in text
+    assert 'medvisor_model_state{state="failed"} 0' in text
+    assert 'medvisor_requests_in_flight{endpoint="/metrics"} 1' in text
+
+def test_json_log_lines_carry_extra_fields():
+    record = logging.LogRecord('app.main', logging.WARNING, __file__, 1, 'Upload rejected', (), None)
+    record.upload = 'scan.png'
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry['message'] == 'Upload rejected'
+    assert entry['level'] == 'WARNING'
+    assert entry['upload'] == 'scan.png'
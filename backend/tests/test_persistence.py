@@ -0,0 +1,133 @@
+import os
+import time
+from app.extensions import db
+from app.models import Prediction
+from app.persistence import SpoolSegment, WriteBehindPersister, recover_spool
+
+def _row(**fields):
+    return Prediction(image_path='x.jpg', predicted_class='Cat', confidence=90.0, severity='mild', **fields)
+
+def test_rows_get_ids_before_they_are_written(app, init_database, tmp_path):
+    persister = WriteBehindPersister(app, str(tmp_path), batch_size=1000, interval_ms=10000, id_block=2)
+    try:
+        rows = persister.add_all([_row(), _row(), _row()])
+        assert [row.id for row in rows] == [1, 2, 3]
+        assert Prediction.query.count() == 0
+
+        persister.update([2], {'gradcam_path': 'gradcam_2.jpg', 'heatmap': b'\x00\x01'})
+        assert len(os.listdir(tmp_path)) == 1
+        persister.sync()
+        assert persister.stats()['flushes'] == 1
+        assert Prediction.query.count() == 3
+        assert db.session.get(Prediction, 2).heatmap == b'\x00\x01'
+        # Committed segments are removed
+        assert os.listdir(tmp_path) == []
+    finally:
+        persister.close()
+
+def test_sync_does_not_wait_for_the_batch_to_fill(app, init_database, tmp_path):
+    persister = WriteBehindPersister(app, str(tmp_path), batch_size=1000, interval_ms=10000)
+    try:
+        for _ in range(5):
+            persister.add(_row())
+            started = time.monotonic()
+            persister.sync()
+            assert time.monotonic() - started < 2
+        assert Prediction.query.count() == 5
+    finally:
+        persister.close()
+
+def test_spool_from_a_dead_process_is_replayed(app, init_database, tmp_path):
+    row = _row(id=41)
+    segment = SpoolSegment(str(tmp_path), fsync=False)
+    segment.append(('insert', [{c.name: getattr(row, c.name) for c in Prediction.__table__.columns}]))
+    segment.append(('update', ([41], {'severity': 'severe'})))
+    segment.file.write(b'{"op": "ins')  # torn write
+    segment.file.close()  # releases the lock, as the process dying would
+
+    assert recover_spool(app, str(tmp_path)) == 2
+    assert db.session.get(Prediction, 41).severity == 'severe'
+    assert os.listdir(tmp_path) == []
+
+def test_synchronous_mode_commits_inline(app, init_database, tmp_path):
+    persister = WriteBehindPersister(app, str(tmp_path), write_behind=False)
+    row = persister.add(_row())
+    assert db.session.get(Prediction, row.id) is not None
+    persister.close()
+
+def test_sync_waits_for_a_flush_in_progress(app, init_database, tmp_path, monkeypatch):
+    import threading
+    from app import persistence
+    flushing = threading.Event()
+
+    def slow_apply(ops):
+        flushing.set()
+        time.sleep(0.3)
+        real_apply(ops)
+
+    real_apply = persistence.apply_ops
+    monkeypatch.setattr(persistence, 'apply_ops', slow_apply)
+    persister = WriteBehindPersister(app, str(tmp_path), batch_size=1)
+    try:
+        row = persister.add(_row())
+        assert flushing.wait(5) and persister.stats()['queued'] == 0
+        # Nothing is queued, but the row isn't committed yet
+        persister.sync()
+        assert db.session.get(Prediction, row.id) is not None
+    finally:
+        persister.close()
+
+def test_sync_returns_once_a_failed_flush_is_retried(app, init_database, tmp_path, monkeypatch):
+    import threading
+    from app import persistence
+    flushing = threading.Event()
+    calls = []
+
+    def failing_apply(ops):
+        # The first flush fails as a batch and op by op, after a while
+        calls.append(len(ops))
+        if len(calls) <= 2:
+            flushing.set()
+            time.sleep(0.3)
+            raise RuntimeError("database is locked")
+        real_apply(ops)
+
+    real_apply = persistence.apply_ops
+    monkeypatch.setattr(persistence, 'apply_ops', failing_apply)
+    persister = WriteBehindPersister(app, str(tmp_path), batch_size=1, interval_ms=10)
+    try:
+        first = persister.add(_row())
+        assert flushing.wait(5)
+        # Queued while the failing flush is in progress
+        second = persister.add(_row())
+        started = time.monotonic()
+        persister.sync()
+        assert time.monotonic() - started < 5
+        assert db.session.get(Prediction, first.id) is not None
+        assert db.session.get(Prediction, second.id) is not None
+        assert persister.stats()['failures'] == 1
+    finally:
+        persister.close()
+
+def test_failing_op_is_dead_lettered_and_the_rest_commit(app, init_database, tmp_path):
+    import json
+    persister = WriteBehindPersister(app, str(tmp_path), batch_size=1000, interval_ms=10, max_retries=2)
+    try:
+        row = persister.add(_row())
+        persister.update([row.id], {'no_such_column': 1})
+        persister.update([row.id], {'severity': 'severe'})
+        persister.sync()
+        assert db.session.get(Prediction, row.id).severity == 'severe'
+        assert persister.stats()['dead_lettered'] == 1
+
+        with open(tmp_path / WriteBehindPersister.DEAD_LETTER_FILE) as f:
+            dead = [json.loads(line) for line in f]
+        assert dead[0]['fields'] == {'no_such_column': 1} and dead[0]['attempts'] == 2
+        # Later syncs are not held up by the dropped op
+        persister.add(_row())
+        started = time.monotonic()
+        persister.sync()
+        assert time.monotonic() - started < 2 and Prediction.query.count() == 2
+        assert os.listdir(tmp_path) == [WriteBehindPersister.DEAD_LETTER_FILE]
+    finally:
+        persister.close()
@@ -0,0 +1,34 @@
+import cv2
+import numpy as np
+from app.preprocess import TensorPool, decode, decode_flag, image_extension, jpeg_size, resize_normalize
+
+def _jpeg(width, height):
+    image = np.random.default_rng(0).integers(0, 255, (height, width, 3), dtype=np.uint8)
+    return cv2.imencode('.jpg', image)[1].tobytes()
+
+def test_jpeg_size_and_extension():
+    data = _jpeg(640, 480)
+    assert jpeg_size(data) == (640, 480)
+    assert image_extension(data) == '.jpg'
+    assert image_extension(cv2.imencode('.png', np.zeros((4, 4, 3), np.uint8))[1].tobytes()) == '.png'
+    assert image_extension(b'not an image') == '.img'
+
+def test_large_jpeg_decoded_at_reduced_resolution():
+    data = _jpeg(2000, 1000)
+    assert decode_flag(data, 224) == cv2.IMREAD_REDUCED_COLOR_4
+    assert decode(data, 224).shape == (250, 500, 3)
+    # Never reduced below the model input
+    assert decode_flag(_jpeg(400, 300), 224) == cv2.IMREAD_COLOR
+
+def test_resize_normalize_writes_into_buffers():
+    image = np.random.default_rng(1).integers(0, 255, (300, 400, 3), dtype=np.uint8)
+    out = np.empty((224, 224, 3), np.float32)
+    resized, tensor = resize_normalize(image, 224, out)
+    assert tensor is out
+    np.testing.assert_allclose(tensor, resized.astype(np.float32) / 127.5 - 1.0, atol=1e-6)
+
+def test_tensor_pool_reuses_buffers():
+    pool = TensorPool(8, max_free=1)
+    first = pool.acquire()
+    pool.release(first)
+    assert pool.acquire() is first
@@ -0,0 +1,107 @@
+import json
+import os
+import pytest
+from app.registry import ModelRegistry, ModelVersion, UnknownModel, discover, version_key
+
+class FakeBatcher:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+def _config(tmp_path, **overrides):
+    config = {
+        'MODEL_NAME': 'chest',
+        'MODEL_REGISTRY_DIR': str(tmp_path / 'registry'),
+        'MODEL_PATH': str(tmp_path / 'missing.h5'),
+        'MODEL_INPUT_SIZE': 224,
+    }
+    config.update(overrides)
+    return config
+
+def _add_version(tmp_path, name, version, metadata=None):
+    folder = tmp_path / 'registry' / name / version
+    folder.mkdir(parents=True)
+    (folder / 'model.h5').write_bytes(b'weights')
+    if metadata is not None:
+        (folder / 'model.json').write_text(json.dumps(metadata))
+    return folder
+
+def _build(spec):
+    return ModelVersion(spec, batcher=FakeBatcher())
+
+def test_versions_sort_naturally():
+    assert sorted(['10', '9', '1.10', '1.9'], key=version_key) == ['1.9', '1.10', '9', '10']
+
+def test_discover_reads_metadata(tmp_path):
+    _add_version(tmp_path, 'chest', '1')
+    _add_version(tmp_path, 'chest', '2', {'last_conv_layer': 'block5', 'input_size': 256,
+                                          'preprocessing': 'unit', 'labels': 'classes.json'})
+    _add_version(tmp_path, 'chest', '3', {'preprocessing': 'bogus'})
+    (tmp_path / 'registry' / 'chest' / 'empty').mkdir()
+
+    specs = discover(str(tmp_path / 'registry'))
+    assert [spec.version for spec in specs['chest']] == ['1', '2']
+    spec = specs['chest'][1]
+    assert spec.key == 'chest@2'
+    assert (spec.last_conv_layer, spec.input_size, spec.preprocessing) == ('block5', 256, 'unit')
+    assert spec.class_index.endswith(os.path.join('2', 'classes.json'))
+
+def test_legacy_model_path_is_served_without_registry(tmp_path):
+    registry = ModelRegistry(_config(tmp_path), _build)
+    assert registry.refresh() == ['chest@imagenet']
+    assert registry.active().spec.path.endswith('missing.h5')
+
+def test_new_version_is_swapped_in_and_old_one_drains(tmp_path):
+    _add_version(tmp_path, 'chest', '1')
+    registry = ModelRegistry(_config(tmp_path), _build)
+    registry.refresh()
+    lease = registry.lease()
+    assert lease.key == 'chest@1'
+
+    _add_version(tmp_path, 'chest', '2')
+    assert registry.refresh() == ['chest@2']
+    assert registry.lease().key == 'chest@2'
+    # The request still on version 1 keeps it open until it finishes
+    assert lease.state == 'draining' and not lease.batcher.closed
+    with pytest.raises(UnknownModel):
+        registry.lease('chest@1')
+    lease.release()
+    assert lease.state == 'closed' and lease.batcher.closed
+    assert registry.refresh() == []
+
+def test_keep_leaves_previous_version_routable(tmp_path):
+    _add_version(tmp_path, 'chest', '1')
+    _add_version(tmp_path, 'chest', '2')
+    _add_version(tmp_path, 'chest', '3')
+    _add_version(tmp_path, 'knee', 'a')
+    registry = ModelRegistry(_config(tmp_path), _build, keep=2)
+    registry.refresh()
+
+    stats = registry.stats()
+    assert stats['active'] == {'chest': 'chest@3', 'knee': 'knee@a'}
+    assert sorted(stats['versions']) == ['chest@2', 'chest@3', 'knee@a']
+    assert registry.lease('@2').key == 'chest@2'
+    assert registry.lease('knee').key == 'knee@a'
+    with pytest.raises(UnknownModel):
+        registry.lease('chest@1')
+    with pytest.raises(UnknownModel):
+        registry.lease('spine')
+
+def test_failed_version_is_retried_only_when_replaced(tmp_path):
+    _add_version(tmp_path, 'chest', '1')
+    attempts = []
+    def build(spec):
+        attempts.append(spec.key)
+        return None
+    registry = ModelRegistry(_config(tmp_path), build)
+    registry.refresh()
+    registry.refresh()
+    assert attempts == ['chest@1']
+    assert registry.active() is None
+
+    model_file = tmp_path / 'registry' / 'chest' / '1' / 'model.h5'
+    model_file.write_bytes(b'fixed weights')
+    registry.refresh()
+    assert attempts == ['chest@1', 'chest@1']
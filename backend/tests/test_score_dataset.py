@@ -0,0 +1,62 @@
+import csv
+import json
+import cv2
+import numpy as np
+import pytest
+from config import Config
+from scripts import score_dataset
+
+@pytest.fixture
+def dataset(tmp_path):
+    folder = tmp_path / 'studies'
+    (folder / 'b').mkdir(parents=True)
+    rng = np.random.default_rng(0)
+    for name in ('a1.png', 'a2.png', 'b/b1.png', 'b/b2.jpg'):
+        cv2.imwrite(str(folder / name), rng.integers(0, 255, (40, 48, 3), dtype=np.uint8))
+    (folder / 'notes.txt').write_text('not an image')
+    (folder / 'broken.png').write_bytes(b'not a png')
+    return folder
+
+@pytest.fixture
+def registry_model(tmp_path, monkeypatch, stub_model):
+    folder = tmp_path / 'registry' / 'chest' / '1'
+    folder.mkdir(parents=True)
+    stub_model.save(str(folder / 'model.keras'))
+    (folder / 'model.json').write_text(json.dumps({'last_conv_layer': 'last_conv', 'input_size': 32}))
+    monkeypatch.setattr(Config, 'MODEL_REGISTRY_DIR', str(tmp_path / 'registry'))
+    monkeypatch.setattr(Config, 'MODEL_NAME', 'chest')
+    monkeypatch.setattr(Config, 'INFERENCE_BACKEND', 'keras')
+    monkeypatch.setattr(Config, 'MODEL_WARMUP', False)
+
+def _score(dataset, output, *extra):
+    return score_dataset.main([str(dataset), '--output', str(output), '--workers', '0',
+                               '--chunk-size', '2', '--batch-size', '2', *extra])
+
+def test_lists_images_recursively_in_order(dataset):
+    assert score_dataset.list_images(str(dataset)) == ['a1.png', 'a2.png', 'broken.png', 'b/b1.png', 'b/b2.jpg']
+
+def test_scores_to_csv_and_resumes(dataset, registry_model, tmp_path):
+    output = tmp_path / 'scores.csv'
+    summary = _score(dataset, output, '--limit', '3')
+    assert (summary['model'], summary['scored'], summary['failed']) == ('chest@1', 2, 1)
+
+    summary = _score(dataset, output, '--gradcam')
+    assert (summary['scored'], summary['failed']) == (2, 0)
+
+    with open(output) as f:
+        rows = list(csv.DictReader(f))
+    assert [row['path'] for row in rows] == ['a1.png', 'a2.png', 'b/b1.png', 'b/b2.jpg']
+    assert all(row['model_version'] == 'chest@1' for row in rows)
+    assert len(json.loads(rows[0]['differential'])) == 3
+    assert not rows[0]['gradcam_path'] and rows[-1]['gradcam_path'] == 'b/b2.jpg.jpg'
+    assert (tmp_path / 'scores.csv.gradcam' / 'b' / 'b2.jpg.jpg').exists()
+
+    manifest = [json.loads(line) for line in open(str(output) + '.manifest.jsonl')]
+    assert manifest[0]['model'] == 'chest@1'
+    assert {entry['path']: entry['status'] for entry in manifest[1:]}['broken.png'] == 'failed'
+
+def test_refuses_manifest_for_another_model(dataset, registry_model, tmp_path):
+    manifest = tmp_path / 'scores.csv.manifest.jsonl'
+    manifest.write_text(json.dumps({'dataset': str(dataset), 'model': 'chest@0'}) + '\n')
+    with pytest.raises(SystemExit):
+        _score(dataset, tmp_path / 'scores.csv')
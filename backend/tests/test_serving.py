@@ -0,0 +1,60 @@
+import multiprocessing
+import queue
+from types import SimpleNamespace
+import numpy as np
+import pytest
+from app import serving
+from app.admission import Deadline, DeadlineExceeded, Overloaded
+from app.inference import InferenceEngine
+from config import Config
+
+def test_inference_server_shares_model_across_workers(tmp_path, stub_model):
+    model_path = str(tmp_path / 'stub.keras')
+    stub_model.save(model_path)
+    config = {name: getattr(Config, name) for name in dir(Config) if name.isupper()}
+    config.update(MODEL_PATH=model_path, MODEL_INPUT_SIZE=32, MODEL_WARMUP=False)
+
+    server = serving.InferenceServer(multiprocessing.get_context('spawn'), config, workers=2, slots=4)
+    server.start()
+    try:
+        images = np.random.uniform(-1, 1, (6, 32, 32, 3)).astype(np.float32)
+        clients = [server.client(0), server.client(1)]
+        futures = [clients[i % 2].submit('predict_and_explain', image) for i, image in enumerate(images)]
+        results = [future.result(timeout=60) for future in futures]
+
+        expected_predictions, expected_heatmaps = InferenceEngine(
+            stub_model, 'last_conv', explain_classes=config['GRADCAM_CLASSES']).predict_and_explain(images)
+        for (prediction, heatmap, embedding), expected, expected_heatmap in zip(results, expected_predictions, expected_heatmaps):
+            np.testing.assert_allclose(prediction, expected, rtol=1e-4, atol=1e-5)
+            np.testing.assert_allclose(heatmap, expected_heatmap, atol=1e-3)
+            assert embedding.shape == (8,)
+
+        prediction, heatmap, _ = clients[0].batcher('predict').submit(images[0]).result(timeout=60)
+        assert heatmap is None
+        assert clients[1].batcher('predict').stats()['remote'] is True
+        # A group is explained only as far as asked
+        predictions, heatmaps, _ = clients[0].batcher('predict_and_explain').submit_many(
+            images[:3], explain=1).result(timeout=60)
+        np.testing.assert_allclose(predictions, expected_predictions[:3], rtol=1e-4, atol=1e-5)
+        np.testing.assert_allclose(heatmaps[0], expected_heatmaps[0], atol=1e-3)
+        assert not heatmaps[1:].any()
+        # Every slot was handed back
+        assert server.pool.free.qsize() == 4
+    finally:
+        server.stop()
+
+def test_client_slot_wait_honours_the_deadline():
+    pool = SimpleNamespace(input_shape=(4, 4, 3), free=queue.Queue(), views=None)
+    client = serving.InferenceClient(pool, queue.Queue(), queue.Queue(), 0)
+    image = np.zeros((4, 4, 3), np.float32)
+
+    # Already expired: rejected before waiting for a slot
+    with pytest.raises(DeadlineExceeded):
+        client.submit('predict', image, deadline=Deadline.after(-1))
+    # Expires while every slot is taken
+    with pytest.raises(DeadlineExceeded):
+        client.submit('predict', image, deadline=Deadline.after(0.05))
+    # No deadline: the slot wait itself times out
+    with pytest.raises(Overloaded) as excinfo:
+        client.submit('predict', image, slot_timeout=0.01)
+    assert type(excinfo.value) is Overloaded
@@ -0,0 +1,24 @@
+import io
+import hashlib
+from app.storage import ContentStore
+
+def test_stream_is_hashed_sharded_and_deduplicated(tmp_path):
+    store = ContentStore(str(tmp_path))
+    data = b'\x89PNG\r\n\x1a\n' + b'x' * 200000
+    digest = hashlib.sha256(data).hexdigest()
+
+    name, stream_digest, created = store.save_stream(io.BytesIO(data), chunk_size=4096)
+    assert (name, stream_digest, created) == (f'{digest}.png', digest, True)
+    assert store.resolve(name) == str(tmp_path / digest[:2] / digest[2:4] / name)
+    assert open(store.resolve(name), 'rb').read() == data
+
+    assert store.save_bytes(data) == (name, digest, False)
+    assert store.save_stream(io.BytesIO(data))[2] is False
+    assert list((tmp_path / '.tmp').iterdir()) == []
+
+def test_resolve_finds_legacy_flat_files(tmp_path):
+    (tmp_path / 'legacy-uuid.jpg').write_bytes(b'old')
+    store = ContentStore(str(tmp_path))
+    assert store.resolve('legacy-uuid.jpg') == str(tmp_path / 'legacy-uuid.jpg')
+    assert store.resolve('../etc/passwd') is None
+    assert store.resolve('missing.jpg') is None
@@ -0,0 +1,30 @@
+import cv2
+import numpy as np
+import pytest
+from app import tta
+
+def test_views_resampled_in_one_step():
+    image = np.random.default_rng(0).random((40, 32, 3), dtype=np.float32)
+    transforms = tta.TTAConfig(views=12, rotation=10, crop=0.5).transforms()
+    assert transforms[0] == (False, 0.0, 1.0) and len(set(transforms)) == 12
+
+    views = tta.augment(image, transforms)
+    assert views.shape == (12, 40, 32, 3)
+    np.testing.assert_array_equal(views[0], image)
+    np.testing.assert_array_equal(views[1], image[:, ::-1])
+    # Rotation about the centre, edges repeated
+    matrix = cv2.getRotationMatrix2D((15.5, 19.5), 10, 1)
+    rotated = cv2.warpAffine(image, matrix, (32, 40), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+    np.testing.assert_allclose(views[2], rotated, atol=0.05)
+    # The crop zooms into the central half
+    centre = cv2.resize(image[10:30, 8:24], (32, 40), interpolation=cv2.INTER_LINEAR)
+    np.testing.assert_allclose(views[6][4:-4, 4:-4], centre[4:-4, 4:-4], atol=0.2)
+
+def test_aggregate_and_config():
+    mean, variance = tta.aggregate([[0.8, 0.2], [0.6, 0.4]])
+    np.testing.assert_allclose(mean, [0.7, 0.3])
+    assert variance == pytest.approx(0.01)
+    assert tta.TTAConfig(8).identity != tta.TTAConfig(4).identity
+    for bad in ({'views': 1}, {'views': tta.MAX_VIEWS + 1}, {'crop': 0}):
+        with pytest.raises(ValueError):
+            tta.TTAConfig(**bad)
@@ -23,6 +23,24 @@ const Index = () => {
     setAnalysisResult(null);
   };
 
+  const pollGradcam = async (statusUrl: string) => {
+    for (let attempt = 0; attempt < 10; attempt++) {
+      try {
+        const response = await fetch(`${statusUrl}?wait=25`);
+        if (!response.ok) return;
+        const status = await response.json();
+        if (status.status === "done") {
+          setAnalysisResult((prev: any) => prev && ({ ...prev, gradcam_image: status.gradcam_image }));
+          return;
+        }
+        if (status.status !== "pending" && status.status !== "running") return;
+      } catch (error) {
+        console.error(error);
+        return;
+      }
+    }
+  };
+
   const handleAnalyze = async () => {
     if (!imageFile) return;
 
@@ -45,6 +63,11 @@ const Index = () => {
       setAnalysisResult(data);
       setShowResults(true);
       toast.success("Analysis complete");
+
+      // Grad-CAM is rendered in the background; long-poll until it's ready
+      if (data.gradcam_status && !data.gradcam_image) {
+        pollGradcam(data.gradcam_status);
+      }
     } catch (error) {
       console.error(error);
       toast.error("Failed to analyze image. Ensure backend is running.");